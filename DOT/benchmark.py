@@ -0,0 +1,588 @@
+"""Micro-benchmarks for DOT octree operations on synthetic trees.
+
+Usage:
+
+python -m DOT.benchmark --device cuda prune --init_refine 4 --refine_rounds 3
+python -m DOT.benchmark query --policy morton --n_points 1000000
+python -m DOT.benchmark lookup --n_points 10000000 --threads 8
+python -m DOT.benchmark io --threads 8
+python -m DOT.benchmark render --size 800 --threads 8
+"""
+import argparse
+import copy
+import json
+import math
+import os
+import os.path as osp
+import tempfile
+import time
+
+import torch
+
+from DOT.synthetic import (make_synthetic_tree, make_synthetic_weights,
+                           make_synthetic_scene, look_at_center)
+from DOT.utils import DOT_N3Tree, prune_func, prune_func_bottom_up
+import svox
+from svox import treefile
+
+
+def _sync(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def _timeit(device, fn, *args, **kwargs):
+    _sync(device)
+    start = time.perf_counter()
+    out = fn(*args, **kwargs)
+    _sync(device)
+    return out, time.perf_counter() - start
+
+
+def bench_prune(args):
+    tree = make_synthetic_tree(args.init_refine, args.refine_rounds, args.refine_frac,
+                               device=args.device, seed=args.seed)
+    weights = make_synthetic_weights(tree, args.weight_scale, seed=args.seed)
+    print(tree, 'leaves', tree.n_leaves)
+    kwargs = dict(thresh_type=args.thresh_type, thresh_val=args.thresh_val,
+                  thresh_tol=args.thresh_tol, recursive=args.recursive)
+
+    t_fast = copy.deepcopy(tree)
+    w_fast, dt_fast = _timeit(args.device, prune_func_bottom_up,
+                              t_fast, weights.clone(), **kwargs)
+    print(f'bottom_up: {dt_fast:.4f}s, leaves {t_fast.n_leaves}')
+    if args.skip_reference:
+        return
+
+    t_ref = tree
+    w_ref, dt_ref = _timeit(args.device, prune_func, t_ref, weights.clone(), **kwargs)
+    print(f'loop:      {dt_ref:.4f}s, leaves {t_ref.n_leaves}')
+    print(f'speedup:   {dt_ref / max(dt_fast, 1e-9):.1f}x')
+
+    leaves = (*t_ref._all_leaves().long().T,)
+    match = (torch.equal(t_ref.child, t_fast.child) and
+             torch.equal(t_ref.parent_depth, t_fast.parent_depth) and
+             torch.equal(t_ref.data.data, t_fast.data.data) and
+             torch.allclose(w_ref[leaves], w_fast[leaves], equal_nan=True))
+    print('outputs match:', match)
+
+
+def _merge_nids_reference(tree, nids):
+    # Former DOT_N3Tree.merge_nids: one membership scan per frontier node
+    nids = nids.to(tree.data.device)
+    idxs = [f in nids for f in tree._frontier]
+    return tree.merge(idxs)
+
+
+def bench_merge(args):
+    tree = make_synthetic_tree(args.init_refine, args.refine_rounds, args.refine_frac,
+                               device=args.device, seed=args.seed)
+    g = torch.Generator().manual_seed(args.seed + 2)
+    # Mix of frontier and non-frontier ids, as produced by prune_func
+    nids = torch.randperm(tree.n_internal, generator=g)[:args.n_merge]
+    print(tree, 'frontier', tree.n_frontier, 'query ids', nids.numel())
+
+    t_fast = copy.deepcopy(tree)
+    _, dt_fast = _timeit(args.device, t_fast.merge_nids, nids)
+    print(f'indexed:   {dt_fast:.4f}s, frontier {t_fast.n_frontier}')
+    if args.skip_reference:
+        return
+    _, dt_ref = _timeit(args.device, _merge_nids_reference, tree, nids)
+    print(f'reference: {dt_ref:.4f}s, frontier {tree.n_frontier}')
+    print(f'speedup:   {dt_ref / max(dt_fast, 1e-9):.1f}x')
+    print('outputs match:', torch.equal(tree.child, t_fast.child) and
+          torch.equal(tree.data.data, t_fast.data.data))
+
+
+def fragment_tree(tree, cycles=3, frac=0.1, seed=0):
+    """
+    Alternate merges and refines of random nodes, as DOT prune/sample rounds
+    do, so that node ids lose their spatial order
+    """
+    g = torch.Generator().manual_seed(seed + 3)
+    for _ in range(cycles):
+        frontier = tree._frontier
+        k = int(frontier.numel() * frac)
+        tree.merge_nids(frontier[torch.randperm(frontier.numel(), generator=g)[:k]])
+        leaves = tree._all_leaves()
+        k = int(leaves.size(0) * frac / tree.N ** 3)
+        idxs = leaves[torch.randperm(leaves.size(0), generator=g)[:k]]
+        tree.refine(sel=(*idxs.long().T,))
+    return tree
+
+
+def bench_query(args):
+    tree = make_synthetic_tree(args.init_refine, args.refine_rounds, args.refine_frac,
+                               device='cpu', seed=args.seed)
+    fragment_tree(tree, args.cycles, args.frag_frac, seed=args.seed)
+    g = torch.Generator().manual_seed(args.seed + 4)
+    points = torch.rand((args.n_points, 3), generator=g)
+    # Sorted queries, e.g. samples along rays, are where the layout matters most
+    if args.sorted_points:
+        points = points[torch.argsort(points[:, 0])]
+    print(tree, 'free', tree._n_free.item(), 'points', points.size(0))
+
+    def query():
+        with torch.no_grad():
+            return tree(points.clone(), cuda=False, world=False)
+
+    out_before, dt_before = _timeit('cpu', query)
+    print(f'before reorder:  {dt_before:.4f}s, {points.size(0) / dt_before / 1e6:.2f} M pts/s')
+    _, dt_reorder = _timeit('cpu', tree.reorder, args.policy)
+    print(f'reorder({args.policy}): {dt_reorder:.4f}s')
+    out_after, dt_after = _timeit('cpu', query)
+    print(f'after reorder:   {dt_after:.4f}s, {points.size(0) / dt_after / 1e6:.2f} M pts/s')
+    print(f'speedup:   {dt_before / max(dt_after, 1e-9):.2f}x')
+    tree.check_integrity()
+    print('outputs match:', torch.equal(out_before, out_after))
+
+
+def _query_reference(tree, indices):
+    # Former CPU path of N3Tree.forward (world=False)
+    N = tree.N
+    indices = indices.clamp(0.0, 1.0 - 1e-10)
+    n_queries = indices.shape[0]
+    node_ids = torch.zeros(n_queries, dtype=torch.long)
+    result = torch.empty((n_queries, tree.data_dim), dtype=tree.data.dtype)
+    remain_indices = torch.arange(n_queries, dtype=torch.long)
+    ind = indices.clone()
+    while remain_indices.numel():
+        ind *= N
+        ind_floor = torch.floor(ind)
+        ind_floor.clamp_max_(N - 1)
+        ind -= ind_floor
+        sel = (node_ids[remain_indices], *(ind_floor.long().T),)
+        deltas = tree.child[sel]
+        term_mask = deltas == 0
+        term_indices = remain_indices[term_mask]
+        result[term_indices] = tree.data.data[sel][term_mask]
+        node_ids[remain_indices] += deltas
+        remain_indices = remain_indices[~term_mask]
+        ind = ind[~term_mask]
+    return result
+
+
+def bench_lookup(args):
+    tree = make_synthetic_tree(args.init_refine, args.refine_rounds, args.refine_frac,
+                               device='cpu', seed=args.seed)
+    tree.cpu_query_threads = args.threads
+    tree.cpu_query_chunk = args.chunk
+    g = torch.Generator().manual_seed(args.seed + 4)
+    points = torch.rand((args.n_points, 3), generator=g)
+    print(tree, 'points', points.size(0), 'threads', args.threads)
+
+    with torch.no_grad():
+        out_fast, dt_fast = _timeit('cpu', tree, points, cuda=False, world=False)
+    print(f'engine:    {dt_fast:.4f}s, {points.size(0) / dt_fast / 1e6:.2f} M pts/s')
+    if args.skip_reference:
+        return
+    out_ref, dt_ref = _timeit('cpu', _query_reference, tree, points)
+    print(f'reference: {dt_ref:.4f}s, {points.size(0) / dt_ref / 1e6:.2f} M pts/s')
+    print(f'speedup:   {dt_ref / max(dt_fast, 1e-9):.1f}x')
+    print('outputs match:', torch.equal(out_ref, out_fast))
+
+
+def _corners_reference(tree, nodes):
+    # Former CPU path of N3Tree._calc_corners: walk up to the root per query
+    Q = nodes.shape[0]
+    curr = nodes.clone()
+    mask = torch.ones(Q, dtype=torch.bool)
+    output = torch.zeros(Q, 3, dtype=tree.data.dtype)
+    while True:
+        output[mask] += curr[:, 1:]
+        output[mask] /= tree.N
+        good_mask = curr[:, 0] != 0
+        if not good_mask.any():
+            break
+        mask[mask.clone()] = good_mask
+        curr = tree._unpack_index(tree.parent_depth[curr[good_mask, 0], 0].long())
+    return output
+
+
+def bench_corners(args):
+    tree = make_synthetic_tree(args.init_refine, args.refine_rounds, args.refine_frac,
+                               device='cpu', seed=args.seed)
+    leaves = tree._all_leaves().long()
+    print(tree, 'leaves', leaves.size(0))
+
+    _, dt_table = _timeit('cpu', tree._node_origins)
+    print(f'origin table: {dt_table:.4f}s')
+    out_fast, dt_fast = _timeit('cpu', tree._calc_corners, leaves, cuda=False)
+    print(f'gather:    {dt_fast:.4f}s')
+    if args.skip_reference:
+        return
+    out_ref, dt_ref = _timeit('cpu', _corners_reference, tree, leaves)
+    print(f'reference: {dt_ref:.4f}s')
+    print(f'speedup:   {dt_ref / max(dt_fast + dt_table, 1e-9):.1f}x (including the table)')
+    print('outputs match:', torch.allclose(out_ref, out_fast))
+
+
+def bench_io(args):
+    tree = make_synthetic_tree(args.init_refine, args.refine_rounds, args.refine_frac,
+                               device=args.device, seed=args.seed)
+    n_bytes = tree.data.numel() * 2 + tree.child.numel() * 4  # As stored, data in half
+    print(tree, f'{n_bytes / 2 ** 20:.1f} MiB to save')
+    configs = [('npz', '.npz', False), ('npz compressed', '.npz', True),
+               ('n3t', treefile.EXT, False)]
+    configs += [(f'n3t {codec}', treefile.EXT, codec) for codec in treefile.available_codecs()
+                if codec != 'lzma' or args.lzma]
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp:
+        for name, ext, compress in configs:
+            path = osp.join(tmp, 'tree' + ext)
+            _, dt_save = _timeit(args.device, tree.save, path, compress=compress,
+                                 n_threads=args.threads)
+            size = os.path.getsize(path)
+            t_load, dt_load = _timeit(args.device, DOT_N3Tree.load, path, device=args.device)
+            # Memory-mapped loads are lazy, touch the data to compare fairly
+            _, dt_touch = _timeit(args.device, lambda: t_load.data.sum().item())
+            print(f'{name:16s} save {dt_save:.3f}s ({n_bytes / dt_save / 2 ** 20:.0f} MiB/s), '
+                  f'load {dt_load + dt_touch:.3f}s, size {size / 2 ** 20:.1f} MiB')
+            os.remove(path)
+
+
+def bench_render(args):
+    tree = make_synthetic_scene(args.init_refine, data_format=args.data_format, seed=args.seed)
+    r = svox.VolumeRenderer(tree)
+    r.cpu_threads = args.threads
+    c2w = look_at_center()
+    print(tree, f'{args.size}x{args.size}, threads {args.threads}')
+    with torch.no_grad():
+        r.render_persp(c2w, args.size, args.size, fx=args.focal, cuda=False, fast=args.fast)
+        dts = []
+        for _ in range(args.repeats):
+            im, dt = _timeit('cpu', r.render_persp, c2w, args.size, args.size,
+                             fx=args.focal, cuda=False, fast=args.fast)
+            dts.append(dt)
+    dt = min(dts)
+    print(f'cpu:  {dt:.3f}s/frame, {1.0 / dt:.2f} FPS')
+    if args.compare_skip:
+        r.cpu_skip_empty = False
+        with torch.no_grad():
+            im_noskip, dt_noskip = _timeit('cpu', r.render_persp, c2w, args.size, args.size,
+                                           fx=args.focal, cuda=False, fast=args.fast)
+        r.cpu_skip_empty = True
+        print(f'cpu without empty-space skipping: {dt_noskip:.3f}s/frame, '
+              f'speedup {dt_noskip / dt:.2f}x, max abs diff {(im - im_noskip).abs().max().item():.2e}')
+    if args.compare_shading:
+        r.cpu_shading = 'leaf'
+        r.cpu_shading_tol = args.shading_tol
+        with torch.no_grad():
+            im_leaf, dt_leaf = _timeit('cpu', r.render_persp, c2w, args.size, args.size,
+                                       fx=args.focal, cuda=False, fast=args.fast)
+        r.cpu_shading = 'exact'
+        err = (im - im_leaf).abs()
+        psnr = -10.0 * torch.log10(((im - im_leaf) ** 2).mean()).item()
+        print(f'cpu with leaf shading (tol {args.shading_tol} rad): {dt_leaf:.3f}s/frame, '
+              f'speedup {dt / dt_leaf:.2f}x, max abs diff {err.max().item():.2e}, '
+              f'mean abs diff {err.mean().item():.2e}, PSNR vs exact {psnr:.2f}')
+    if args.mip_footprint > 0:
+        r.cpu_mip_footprint = args.mip_footprint
+        with torch.no_grad():
+            _, dt_mip_build = _timeit('cpu', tree.mip)
+            im_mip, dt_mip = _timeit('cpu', r.render_persp, c2w, args.size, args.size,
+                                     fx=args.focal, cuda=False, fast=args.fast)
+        r.cpu_mip_footprint = 0.0
+        psnr = -10.0 * torch.log10(((im.clamp(0, 1) - im_mip.clamp(0, 1)) ** 2).mean()).item()
+        print(f'cpu with mip footprint {args.mip_footprint} px: {dt_mip:.3f}s/frame, '
+              f'speedup {dt / dt_mip:.2f}x, PSNR vs leaves {psnr:.2f} '
+              f'(mip built in {dt_mip_build:.3f}s)')
+    if torch.cuda.is_available():
+        tree_cuda = copy.deepcopy(tree).cuda()
+        with torch.no_grad():
+            im_cuda = svox.VolumeRenderer(tree_cuda).render_persp(
+                    c2w.cuda(), args.size, args.size, fx=args.focal, fast=args.fast).cpu()
+        print('max abs diff vs CUDA:', (im - im_cuda).abs().max().item())
+    if args.batch > 1:
+        c2ws = torch.stack([look_at_center(angle=2 * math.pi * k / args.batch)
+                            for k in range(args.batch)])
+        with torch.no_grad():
+            ims, dt_batch = _timeit('cpu', r.render_persp_batch, c2ws, args.size, args.size,
+                                    fx=args.focal, cuda=False, fast=args.fast)
+            dt_loop = sum(_timeit('cpu', r.render_persp, c2w, args.size, args.size,
+                                  fx=args.focal, cuda=False, fast=args.fast)[1]
+                          for c2w in c2ws)
+        print(f'cpu batch of {args.batch}: {dt_batch / args.batch:.3f}s/frame, '
+              f'{args.batch / dt_batch:.2f} FPS, speedup {dt_loop / dt_batch:.2f}x over render_persp, '
+              f'max abs diff {(ims[0] - im).abs().max().item():.2e}')
+
+
+def bench_tiles(args):
+    tree = make_synthetic_scene(args.init_refine, data_format=args.data_format, seed=args.seed)
+    r = svox.VolumeRenderer(tree)
+    r.cpu_tile_size = args.tile_size
+    c2w = look_at_center()
+    print(tree, f'{args.size}x{args.size}, tiles of {args.tile_size} rays')
+    all_stats = {}
+    dt_base = None
+    with torch.no_grad():
+        r.render_persp(c2w, args.size, args.size, fx=args.focal, cuda=False)
+        for scheduler in args.schedulers:
+            r.cpu_scheduler = scheduler
+            for n_threads in args.threads:
+                r.cpu_threads = n_threads
+                dts = []
+                for _ in range(args.repeats):
+                    r.cpu_tile_stats = []
+                    _, dt = _timeit('cpu', r.render_persp, c2w, args.size, args.size,
+                                    fx=args.focal, cuda=False)
+                    dts.append(dt)
+                stats = r.cpu_tile_stats
+                r.cpu_tile_stats = None
+                all_stats[f'{scheduler}_{n_threads}'] = stats
+                dt = min(dts)
+                if dt_base is None:
+                    dt_base = dt
+                tile_times = sorted(st['time'] for st in stats)
+                busy = {}
+                for st in stats:
+                    busy[st['worker']] = busy.get(st['worker'], 0.0) + st['time']
+                imbalance = max(busy.values()) / (sum(busy.values()) / len(busy))
+                print(f'{scheduler:8s} threads {n_threads:3d}: {dt:.3f}s/frame, '
+                      f'speedup {dt_base / dt:5.2f}x, {len(stats)} tiles '
+                      f'(min {tile_times[0] * 1e3:.1f} / median '
+                      f'{tile_times[len(tile_times) // 2] * 1e3:.1f} / max '
+                      f'{tile_times[-1] * 1e3:.1f} ms), worker imbalance {imbalance:.2f}')
+    if args.stats_out:
+        with open(args.stats_out, 'w') as f:
+            json.dump(all_stats, f)
+        print('per-tile timings written to', args.stats_out)
+
+
+def bench_orbit(args):
+    tree = make_synthetic_scene(args.init_refine, data_format=args.data_format, seed=args.seed)
+    r = svox.VolumeRenderer(tree)
+    r.cpu_threads = args.threads
+    path = [look_at_center(angle=2 * math.pi * k / args.frames_per_orbit)
+            for k in range(args.frames)]
+    cache = svox.ReprojectionCache(margin=args.margin, refresh_every=args.refresh_every)
+    print(tree, f'{args.size}x{args.size}, {args.frames} frames')
+    dt_full = dt_cache = 0.0
+    worst_psnr = float('inf')
+    with torch.no_grad():
+        r.render_persp(path[0], args.size, args.size, fx=args.focal, cuda=False, fast=args.fast)
+        for k, c2w in enumerate(path):
+            im, dt_f = _timeit('cpu', r.render_persp, c2w, args.size, args.size,
+                               fx=args.focal, cuda=False, fast=args.fast)
+            dt_full += dt_f
+            im_cache, dt = _timeit('cpu', cache.render, r, c2w, args.size, args.size,
+                                   fx=args.focal, fast=args.fast)
+            dt_cache += dt
+            mse = ((im - im_cache) ** 2).mean().item()
+            psnr = -10.0 * math.log10(mse) if mse > 0 else float('inf')
+            worst_psnr = min(worst_psnr, psnr)
+            print(f'frame {k:3d}: full {dt_f:.3f}s, cached {dt:.3f}s, '
+                  f'{cache.valid_fraction * 100:5.1f}% pixels reprojected, '
+                  f'max abs diff {(im - im_cache).abs().max().item():.2e}, PSNR {psnr:.2f}')
+    print(f'orbit: {dt_full / args.frames:.3f}s/frame full, {dt_cache / args.frames:.3f}s/frame '
+          f'with reprojection, speedup {dt_full / dt_cache:.2f}x, worst PSNR {worst_psnr:.2f}')
+
+
+def bench_preview(args):
+    tree = make_synthetic_scene(args.init_refine, data_format=args.data_format, seed=args.seed)
+    r = svox.VolumeRenderer(tree)
+    r.cpu_threads = args.threads
+    c2w = look_at_center()
+    print(tree, f'{args.size}x{args.size}')
+    with torch.no_grad():
+        im_full, dt_full = _timeit('cpu', r.render_persp, c2w, args.size, args.size,
+                                   fx=args.focal, cuda=False)
+    print(f'full render: {dt_full:.3f}s')
+    start = time.perf_counter()
+    gen = r.render_persp_progressive(c2w, args.size, args.size, fx=args.focal, cuda=False,
+                                     start_stride=args.start_stride, threshold=args.threshold,
+                                     time_budget=args.time_budget)
+    for level, im in enumerate(gen):
+        dt = time.perf_counter() - start
+        mse = ((im - im_full) ** 2).mean().item()
+        psnr = -10.0 * math.log10(mse) if mse > 0 else float('inf')
+        print(f'level {level}: {dt:.3f}s ({dt / dt_full * 100:5.1f}% of full), '
+              f'PSNR vs full {psnr:.2f}')
+
+
+def bench_lod(args):
+    if args.input:
+        tree = DOT_N3Tree.load(args.input, device=args.device)
+    else:
+        tree = make_synthetic_scene(args.init_refine, data_format=args.data_format,
+                                    device=args.device, seed=args.seed)
+    assert tree.data_format.format == svox.helpers.DataFormat.SH, 'Needs an SH tree'
+    c2w = look_at_center(args.dist)
+    c2w[:3, 3] = tree.tree2world(c2w[:3, 3].to(args.device)).cpu()
+    c2w = c2w.to(args.device)
+    cuda = torch.device(args.device).type == 'cuda'
+    print(tree, f'{args.size}x{args.size}')
+
+    def run(r):
+        with torch.no_grad():
+            r.render_persp(c2w, args.size, args.size, fx=args.focal, cuda=cuda)
+            dts = []
+            for _ in range(args.repeats):
+                im, dt = _timeit(args.device, r.render_persp, c2w, args.size, args.size,
+                                 fx=args.focal, cuda=cuda)
+                dts.append(dt)
+        return im.clamp(0.0, 1.0), min(dts)
+
+    im_ref, dt_ref = run(svox.VolumeRenderer(tree))
+    basis_dim = tree.data_format.basis_dim
+    print(f'SH{basis_dim:<3d} (full)       {1.0 / dt_ref:8.2f} FPS')
+    for deg in range(int(basis_dim ** 0.5) - 2, -1, -1):
+        tree_lod = copy.deepcopy(tree)
+        tree_lod.shrink(f'SH{(deg + 1) ** 2}')
+        im, dt = run(svox.VolumeRenderer(tree_lod))
+        psnr = -10.0 * torch.log10(((im - im_ref) ** 2).mean()).item()
+        print(f'SH{(deg + 1) ** 2:<3d} (truncated)  {1.0 / dt:8.2f} FPS, PSNR {psnr:6.2f}, '
+              f'data {tree_lod.data.numel() / tree.data.numel():.2f}x')
+    if not cuda:
+        for footprint in args.footprints:
+            r = svox.VolumeRenderer(tree, sh_lod=svox.SHLod(footprint=footprint))
+            im, dt = run(r)
+            psnr = -10.0 * torch.log10(((im - im_ref) ** 2).mean()).item()
+            print(f'footprint {footprint:<6g}     {1.0 / dt:8.2f} FPS, PSNR {psnr:6.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str,
+                        default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--seed', type=int, default=0)
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+
+    prune = subparsers.add_parser('prune', help='prune_func vs prune_func_bottom_up')
+    prune.add_argument('--init_refine', type=int, default=4)
+    prune.add_argument('--refine_rounds', type=int, default=3)
+    prune.add_argument('--refine_frac', type=float, default=0.2)
+    prune.add_argument('--weight_scale', type=float, default=0.3)
+    prune.add_argument('--thresh_type', type=str, default='weight',
+                       choices=['weight', 'sigma'])
+    prune.add_argument('--thresh_val', type=float, default=1.0)
+    prune.add_argument('--thresh_tol', type=float, default=0.8)
+    prune.add_argument('--no_recursive', dest='recursive', action='store_false')
+    prune.add_argument('--skip_reference', action='store_true',
+                       help='Only time the bottom-up engine (the loop is slow on big trees)')
+    prune.set_defaults(func=bench_prune)
+
+    merge = subparsers.add_parser('merge', help='DOT_N3Tree.merge_nids')
+    merge.add_argument('--init_refine', type=int, default=5)
+    merge.add_argument('--refine_rounds', type=int, default=2)
+    merge.add_argument('--refine_frac', type=float, default=0.2)
+    merge.add_argument('--n_merge', type=int, default=100000)
+    merge.add_argument('--skip_reference', action='store_true',
+                       help='Only time the indexed merge')
+    merge.set_defaults(func=bench_merge)
+
+    query = subparsers.add_parser('query', help='CPU point queries before/after N3Tree.reorder')
+    query.add_argument('--init_refine', type=int, default=4)
+    query.add_argument('--refine_rounds', type=int, default=3)
+    query.add_argument('--refine_frac', type=float, default=0.2)
+    query.add_argument('--cycles', type=int, default=3,
+                       help='Merge/refine rounds scrambling the node layout')
+    query.add_argument('--frag_frac', type=float, default=0.1)
+    query.add_argument('--n_points', type=int, default=1000000)
+    query.add_argument('--sorted_points', action='store_true')
+    query.add_argument('--policy', type=str, default='morton', choices=['morton', 'bfs'])
+    query.set_defaults(func=bench_query)
+
+    lookup = subparsers.add_parser('lookup', help='CPU point queries (N3Tree.forward, cuda=False)')
+    lookup.add_argument('--init_refine', type=int, default=4)
+    lookup.add_argument('--refine_rounds', type=int, default=3)
+    lookup.add_argument('--refine_frac', type=float, default=0.2)
+    lookup.add_argument('--n_points', type=int, default=10000000)
+    lookup.add_argument('--threads', type=int, default=0)
+    lookup.add_argument('--chunk', type=int, default=1 << 20)
+    lookup.add_argument('--skip_reference', action='store_true')
+    lookup.set_defaults(func=bench_lookup)
+
+    corners = subparsers.add_parser('corners', help='N3Tree._calc_corners on CPU for all leaves')
+    corners.add_argument('--init_refine', type=int, default=4)
+    corners.add_argument('--refine_rounds', type=int, default=3)
+    corners.add_argument('--refine_frac', type=float, default=0.2)
+    corners.add_argument('--skip_reference', action='store_true')
+    corners.set_defaults(func=bench_corners)
+
+    io = subparsers.add_parser('io', help='N3Tree save/load throughput per format and codec')
+    io.add_argument('--init_refine', type=int, default=5)
+    io.add_argument('--refine_rounds', type=int, default=2)
+    io.add_argument('--refine_frac', type=float, default=0.2)
+    io.add_argument('--threads', type=int, default=4)
+    io.add_argument('--lzma', action='store_true', help='Also time lzma (slow)')
+    io.add_argument('--tmp_dir', type=str, default=None)
+    io.set_defaults(func=bench_io)
+
+    render = subparsers.add_parser('render', help='CPU volume rendering FPS of a synthetic scene')
+    render.add_argument('--init_refine', type=int, default=6)
+    render.add_argument('--size', type=int, default=800)
+    render.add_argument('--focal', type=float, default=1111.111)
+    render.add_argument('--threads', type=int, default=None)
+    render.add_argument('--repeats', type=int, default=3)
+    render.add_argument('--fast', action='store_true', help='sigma_thresh/stop_thresh 1e-2')
+    render.add_argument('--compare_skip', action='store_true',
+                        help='Also time without empty-space skipping')
+    render.add_argument('--data_format', type=str, default='SH9')
+    render.add_argument('--compare_shading', action='store_true',
+                        help='Also time per-leaf SH shading and its error against exact shading')
+    render.add_argument('--shading_tol', type=float, default=0.02)
+    render.add_argument('--mip_footprint', type=float, default=0.0,
+                        help='Also time rendering that stops at cells below this many pixels '
+                             '(try with a small --size)')
+    render.add_argument('--batch', type=int, default=1,
+                        help='Also time render_persp_batch over this many views around the scene')
+    render.set_defaults(func=bench_render)
+
+    tiles = subparsers.add_parser('tiles', help='CPU renderer thread scaling and per-tile timing by tile scheduler')
+    tiles.add_argument('--init_refine', type=int, default=6)
+    tiles.add_argument('--data_format', type=str, default='SH9')
+    tiles.add_argument('--size', type=int, default=800)
+    tiles.add_argument('--focal', type=float, default=1111.111)
+    tiles.add_argument('--tile_size', type=int, default=1 << 14)
+    tiles.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    tiles.add_argument('--schedulers', type=str, nargs='+', default=['static', 'dynamic', 'steal'],
+                       choices=['static', 'dynamic', 'steal'])
+    tiles.add_argument('--repeats', type=int, default=3)
+    tiles.add_argument('--stats_out', type=str, default=None,
+                       help='Write the per-tile timings (last repeat) as json')
+    tiles.set_defaults(func=bench_tiles)
+
+    orbit = subparsers.add_parser('orbit', help='CPU orbit video rendering with svox.ReprojectionCache')
+    orbit.add_argument('--init_refine', type=int, default=6)
+    orbit.add_argument('--data_format', type=str, default='SH9')
+    orbit.add_argument('--size', type=int, default=400)
+    orbit.add_argument('--focal', type=float, default=555.555)
+    orbit.add_argument('--threads', type=int, default=None)
+    orbit.add_argument('--frames', type=int, default=24)
+    orbit.add_argument('--frames_per_orbit', type=int, default=120)
+    orbit.add_argument('--margin', type=float, default=0.02)
+    orbit.add_argument('--refresh_every', type=int, default=8)
+    orbit.add_argument('--fast', action='store_true', help='sigma_thresh/stop_thresh 1e-2')
+    orbit.set_defaults(func=bench_orbit)
+
+    preview = subparsers.add_parser('preview', help='Progressive CPU preview rendering, time and PSNR per level')
+    preview.add_argument('--init_refine', type=int, default=6)
+    preview.add_argument('--data_format', type=str, default='SH9')
+    preview.add_argument('--size', type=int, default=800)
+    preview.add_argument('--focal', type=float, default=1111.111)
+    preview.add_argument('--threads', type=int, default=None)
+    preview.add_argument('--start_stride', type=int, default=8)
+    preview.add_argument('--threshold', type=float, default=0.03)
+    preview.add_argument('--time_budget', type=float, default=None)
+    preview.set_defaults(func=bench_preview)
+
+    lod = subparsers.add_parser('lod', help='PSNR vs FPS of SH level of detail (truncated bands, footprint policy)')
+    lod.add_argument('--input', type=str, default=None,
+                     help='SH tree (npz or .n3t), default: a synthetic scene')
+    lod.add_argument('--init_refine', type=int, default=6)
+    lod.add_argument('--data_format', type=str, default='SH16')
+    lod.add_argument('--dist', type=float, default=2.0,
+                     help='Camera distance from the center, in units of the tree size')
+    lod.add_argument('--size', type=int, default=400)
+    lod.add_argument('--focal', type=float, default=555.555)
+    lod.add_argument('--repeats', type=int, default=3)
+    lod.add_argument('--footprints', type=float, nargs='*', default=[0.5, 1.0, 2.0, 4.0],
+                     help='svox.SHLod footprints (pixels) to try, CPU engine only')
+    lod.set_defaults(func=bench_lod)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
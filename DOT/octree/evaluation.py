@@ -66,6 +66,13 @@ flags.DEFINE_string(
     None,
     "If specified, writes images to given path (*.png)",
 )
+flags.DEFINE_string(
+    "write_path_vid",
+    None,
+    "If specified, writes a video of the camera path to given path (*.mp4); "
+    "the generated path with --render_path, else the test cameras in order. "
+    "--reproject applies on CPU-only hosts",
+)
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
@@ -94,5 +101,10 @@ def main(unused_argv):
         for idx, frame in tqdm(enumerate(out_frames)):
             imageio.imwrite(os.path.join(FLAGS.write_images, f"{idx:03d}.png"), frame)
 
+    if FLAGS.write_path_vid is not None:
+        path_frames = utils.render_path_octree(t, dataset, FLAGS)
+        print('Writing to', FLAGS.write_path_vid)
+        imageio.mimwrite(FLAGS.write_path_vid, path_frames)
+
 if __name__ == "__main__":
     app.run(main)
@@ -18,7 +18,11 @@
 """Utility functions."""
 import collections
 import os
+import queue
+import threading
+import time
 from os import path
+from warnings import warn
 from absl import flags
 import math
 
@@ -217,6 +221,16 @@ def define_flags():
         'no_early_stop',
         False,
         'If set, does not use early stopping; slows down rendering slightly')
+    flags.DEFINE_integer(
+        'render_batch_size',
+        4,
+        'number of views rendered per renderer call during evaluation/validation')
+    flags.DEFINE_bool(
+        'reproject',
+        False,
+        'If set and the tree is on the CPU, path rendering (octree.evaluation --write_path_vid) '
+        'reuses the ray start/stop windows of the previous frame (svox.ReprojectionCache); '
+        'ignored on the GPU')
 
 
 def update_flags(args):
@@ -247,6 +261,26 @@ def set_random_seed(seed):
     np.random.seed(seed)
 
 
+def get_rng_state():
+    """RNG states of torch (CPU and CUDA) and numpy, as tensors and numbers only."""
+    kind, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        "numpy": (kind, torch.from_numpy(keys.astype(np.int64)), int(pos),
+                  int(has_gauss), float(cached_gaussian)),
+    }
+
+
+def set_rng_state(state):
+    """Restore RNG states from get_rng_state()."""
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+    kind, keys, pos, has_gauss, cached_gaussian = state["numpy"]
+    np.random.set_state((kind, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+
+
 def open_file(pth, mode="r"):
     if not INTERNAL:
         pth = path.expanduser(pth)
@@ -445,6 +479,99 @@ def generate_rays(w, h, focal, camtoworlds, equirect=False):
     return rays
 
 
+class ImagePrefetcher:
+    """
+    Iterates :code:`(index, image)` over :code:`images[order]` as float tensors on
+    device. A background thread stages up to depth images ahead: on a GPU they are
+    copied into a ring of pinned buffers and sent on a side stream, so the transfers
+    overlap with rendering and backward of the current image; on CPU the images are
+    only converted and queued. depth=0 loads synchronously, as before.
+
+    stats holds, for the last iteration, the number of images, the total time spent
+    waiting for the queue (stall_time, seconds) and the sum of the queue depths seen
+    before each get (mean with :code:`stats['queue_depth'] / stats['n']`).
+    """
+    def __init__(self, images, device, depth=2, order=None):
+        self.images = images
+        self.device = torch.device(device)
+        self.depth = max(int(depth), 0)
+        self.order = range(len(images)) if order is None else order
+        self.stats = {'n': 0, 'stall_time': 0.0, 'queue_depth': 0}
+
+    def __len__(self):
+        return len(self.order)
+
+    def _load(self, j):
+        return torch.as_tensor(self.images[j]).float()
+
+    def _stage(self, q, stop):
+        cuda = self.device.type == 'cuda'
+        try:
+            if cuda:
+                stream = torch.cuda.Stream(self.device)
+                bufs = [None] * (self.depth + 1)
+                events = [None] * (self.depth + 1)
+            for k, j in enumerate(self.order):
+                if stop.is_set():
+                    return
+                im = self._load(j)
+                event = None
+                if cuda:
+                    b = k % len(bufs)
+                    if bufs[b] is None:
+                        bufs[b] = torch.empty(im.shape, dtype=im.dtype, pin_memory=True)
+                    else:
+                        # Buffer is free once its last copy has landed
+                        events[b].synchronize()
+                    bufs[b].copy_(im)
+                    with torch.cuda.stream(stream):
+                        im = bufs[b].to(self.device, non_blocking=True)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                    events[b] = event
+                else:
+                    im = im.to(self.device)
+                q.put((j, im, event))
+        except BaseException as e:
+            q.put(e)
+
+    def __iter__(self):
+        self.stats = {'n': 0, 'stall_time': 0.0, 'queue_depth': 0}
+        if self.depth == 0:
+            for j in self.order:
+                yield j, self._load(j).to(self.device)
+            return
+        q = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._stage, args=(q, stop), daemon=True)
+        thread.start()
+        try:
+            for _ in range(len(self.order)):
+                depth = q.qsize()
+                start = time.perf_counter()
+                item = q.get()
+                self.stats['stall_time'] += time.perf_counter() - start
+                self.stats['queue_depth'] += depth
+                self.stats['n'] += 1
+                if isinstance(item, BaseException):
+                    raise item
+                j, im, event = item
+                if event is not None:
+                    cur = torch.cuda.current_stream(self.device)
+                    cur.wait_event(event)
+                    # im was allocated on the side stream
+                    im.record_stream(cur)
+                yield j, im
+        finally:
+            stop.set()
+            while thread.is_alive():
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+                thread.join(timeout=0.01)
+
+
 def eval_octree(t, dataset, args, want_lpips=True, want_frames=False):
     import svox
     w, h, focal = dataset.w, dataset.h, dataset.focal
@@ -466,31 +593,33 @@ def eval_octree(t, dataset, args, want_lpips=True, want_frames=False):
     avg_ssim = 0.0
     avg_lpips = 0.0
     out_frames = []
-    for idx in tqdm(range(dataset.size)):
-        c2w = torch.from_numpy(dataset.camtoworlds[idx]).float().to(device)
-        im_gt_ten = torch.from_numpy(dataset.images[idx]).float().to(device)
-
-        im = r.render_persp(
-            c2w, width=w, height=h, fx=focal, fast=not args.no_early_stop)
-        im.clamp_(0.0, 1.0)
-
-        mse = ((im - im_gt_ten) ** 2).mean()
-        psnr = compute_psnr(mse).mean()
-        ssim = compute_ssim(im, im_gt_ten, max_val=1.0).mean()
-
-        avg_psnr += psnr.item()
-        avg_ssim += ssim.item()
-        if want_lpips:
-            lpips_i = lpips_vgg(im_gt_ten.permute([2, 0, 1]).contiguous(),
-                    im.permute([2, 0, 1]).contiguous(), normalize=True)
-            avg_lpips += lpips_i.item()
-
-        if want_frames:
-            im = im.cpu()
-            # vis = np.hstack((im_gt_ten.cpu().numpy(), im.cpu().numpy()))
-            vis = im.cpu().numpy()  # for lpips calculation
-            vis = (vis * 255).astype(np.uint8)
-            out_frames.append(vis)
+    batch_size = max(getattr(args, 'render_batch_size', 1), 1)
+    for start in tqdm(range(0, dataset.size, batch_size)):
+        end = min(start + batch_size, dataset.size)
+        c2ws = torch.from_numpy(dataset.camtoworlds[start:end]).float().to(device)
+        ims = r.render_persp_batch(
+            c2ws, width=w, height=h, fx=focal, fast=not args.no_early_stop)
+        ims.clamp_(0.0, 1.0)
+        for idx, im in zip(range(start, end), ims):
+            im_gt_ten = torch.from_numpy(dataset.images[idx]).float().to(device)
+
+            mse = ((im - im_gt_ten) ** 2).mean()
+            psnr = compute_psnr(mse).mean()
+            ssim = compute_ssim(im, im_gt_ten, max_val=1.0).mean()
+
+            avg_psnr += psnr.item()
+            avg_ssim += ssim.item()
+            if want_lpips:
+                lpips_i = lpips_vgg(im_gt_ten.permute([2, 0, 1]).contiguous(),
+                        im.permute([2, 0, 1]).contiguous(), normalize=True)
+                avg_lpips += lpips_i.item()
+
+            if want_frames:
+                im = im.cpu()
+                # vis = np.hstack((im_gt_ten.cpu().numpy(), im.cpu().numpy()))
+                vis = im.cpu().numpy()  # for lpips calculation
+                vis = (vis * 255).astype(np.uint8)
+                out_frames.append(vis)
 
     avg_psnr /= dataset.size
     avg_ssim /= dataset.size
@@ -498,6 +627,50 @@ def eval_octree(t, dataset, args, want_lpips=True, want_frames=False):
     return avg_psnr, avg_ssim, avg_lpips, out_frames
 
 
+def render_path_octree(t, dataset, args):
+    """
+    Render a camera path as uint8 frames: the generated render_poses of the
+    dataset with --render_path (llff), else its cameras in order.
+    With --reproject and the tree on the CPU, consecutive frames reuse the ray
+    windows of the previous one (svox.ReprojectionCache); on the GPU the flag is
+    ignored, as the CUDA renderer is faster than the cached CPU engine.
+    """
+    import svox
+    w, h, focal = dataset.w, dataset.h, dataset.focal
+    if 'llff' in args.config and (not args.spherify):
+        ndc_config = svox.NDCConfig(width=w, height=h, focal=focal)
+    else:
+        ndc_config = None
+
+    r = svox.VolumeRenderer(
+        t, step_size=args.renderer_step_size, ndc=ndc_config)
+
+    poses = getattr(dataset, 'render_poses', None) if args.render_path else None
+    if poses is None:
+        poses = dataset.camtoworlds
+    device = t.data.device
+    cache = None
+    if args.reproject:
+        if device.type == 'cpu':
+            cache = svox.ReprojectionCache()
+        else:
+            warn('--reproject is ignored with the tree on the GPU, '
+                 'rendering the path with the CUDA renderer')
+
+    print('Rendering path of', poses.shape[0], 'frames')
+    frames = []
+    for c2w in tqdm(torch.from_numpy(poses).float().to(device)):
+        if cache is not None:
+            im = cache.render(r, c2w, width=w, height=h, fx=focal,
+                              fast=not args.no_early_stop)
+        else:
+            im = r.render_persp(c2w, width=w, height=h, fx=focal,
+                                fast=not args.no_early_stop)
+        im = im.clamp_(0.0, 1.0).cpu().numpy()
+        frames.append((im * 255).astype(np.uint8))
+    return frames
+
+
 def memlog(device='cuda'):
     # Memory debugging
     print(torch.cuda.memory_summary(device))
@@ -42,6 +42,10 @@ import numpy as np
 import imageio
 import os.path as osp
 import os
+import itertools
+import queue
+import time
+import traceback
 from tqdm import tqdm
 
 from pathlib import Path
@@ -170,6 +174,39 @@ flags.DEFINE_boolean(
     'Recursive prunning for DOT.'
 )
 
+flags.DEFINE_enum(
+    "prune_engine",
+    "bottom_up",
+    ["bottom_up", "loop"],
+    "Pruning implementation: tensorized bottom-up sweep or the reference loop."
+)
+
+flags.DEFINE_float(
+    "geom_resize_fact",
+    1.5,
+    "Geometric capacity growth factor of the tree storage (1.0 = grow by exactly what is needed)."
+)
+
+flags.DEFINE_integer(
+    "max_resize_step",
+    1 << 17,
+    "Max number of extra nodes reserved by one capacity growth (0 = no limit). "
+    "The default bounds the spare capacity to about 120MB of SH9 data."
+)
+
+flags.DEFINE_enum(
+    "node_order",
+    "none",
+    ["none", "morton", "bfs"],
+    "If set, reorders and compacts the tree nodes in this layout before each sampling round."
+)
+
+flags.DEFINE_boolean(
+    "save_compress",
+    False,
+    "Compress saved trees. Fast and multi-threaded when the output ends with .n3t, slow for npz."
+)
+
 flags.DEFINE_boolean(
     "continue_on_decrease",
     True,
@@ -211,12 +248,199 @@ flags.DEFINE_string(
     "weight",
     "Input thresh type",
 )
+flags.DEFINE_integer(
+    "prefetch_depth",
+    2,
+    "Ground truth images staged ahead on a background thread (pinned, async copies on GPU), 0 to load synchronously."
+)
+flags.DEFINE_boolean(
+    "async_val",
+    False,
+    "Validate snapshots of the tree in a worker process instead of stalling training. "
+    "Results arrive late but the best snapshot is still the one saved."
+)
+flags.DEFINE_integer(
+    "async_val_pending",
+    2,
+    "Max snapshots waiting for async validation, training waits for the worker beyond that."
+)
+flags.DEFINE_integer(
+    "keep_best",
+    1,
+    "Number of best validated snapshots kept in host memory; the best one is saved at the end."
+)
+flags.DEFINE_integer(
+    "checkpoint_every",
+    0,
+    "Save the training state every .. epochs (atomically, in the background), 0 to disable."
+)
+flags.DEFINE_string(
+    "checkpoint_path",
+    None,
+    "Training state file, by default the output path with a _train.ckpt suffix."
+)
+flags.DEFINE_boolean(
+    "resume",
+    False,
+    "Resume from the training state file if it exists."
+)
+flags.DEFINE_enum(
+    "train_mode",
+    "image",
+    ["image", "rays"],
+    "Train on one full image per step, or on shuffled batches of rays drawn from all training images."
+)
+flags.DEFINE_integer(
+    "ray_batch_size",
+    1 << 16,
+    "Rays per step in rays train mode. The optimizer step updates the whole tree, so keep this large."
+)
+flags.DEFINE_float(
+    "ray_importance",
+    0.0,
+    "In [0, 1). If > 0, rays mode samples rays by their last squared error mixed with this weight "
+    "against uniform sampling, and reweights the loss to stay unbiased."
+)
 
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 # device = "cuda" 
 torch.autograd.set_detect_anomaly(True)
 
+
+def render_validation(r, c2ws, gts, height, width, focal, step=0, batch_size=4,
+                      prefetch_depth=2, render_interval=0, vis_dir=None):
+    """
+    Render the validation views and score them on the renderer's device.
+    Every render_interval-th view is written next to its ground truth
+    as :code:`{vis_dir}/{step:04}_{j:04}.png`.
+
+    :return: mean PSNR
+    """
+    device = r.tree.data.device
+    with torch.no_grad():
+        # PSNR on device, only the images written out come back to the host
+        tpsnr = torch.zeros((), device=device, dtype=torch.float64)
+        batch_size = max(batch_size, 1)
+        test_gts = iter(utils.ImagePrefetcher(gts, device, prefetch_depth))
+        for start in range(0, len(c2ws), batch_size):
+            ims = r.render_persp_batch(c2ws[start:start + batch_size],
+                                       height=height, width=width, fx=focal, fast=False, cuda=True)
+            ims = ims.clamp_(0.0, 1.0)
+            for j, im in enumerate(ims, start):
+                _, im_gt = next(test_gts)
+
+                mse = ((im - im_gt) ** 2).mean()
+                psnr = -10.0 * torch.log10(mse.double())
+                tpsnr += psnr
+
+                if render_interval > 0 and j % render_interval == 0:
+                    vis = torch.cat((im_gt, im), dim=1).cpu()
+                    vis = (vis * 255).numpy().astype(np.uint8)
+                    imageio.imwrite(f"{vis_dir}/{step:04}_{j:04}.png", vis)
+        return tpsnr.item() / len(c2ws)
+
+
+def _validation_worker(jobs, results, device, c2ws, gts, renderer_kwargs, kwargs):
+    torch.autograd.set_detect_anomaly(False)
+    c2ws = c2ws.to(device=device)
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        step, snap = job
+        try:
+            tree = DOT_N3Tree.from_snapshot(snap, device=device)
+            snap = None
+            r = svox.VolumeRenderer(tree, **renderer_kwargs)
+            psnr = render_validation(r, c2ws, gts, step=step, **kwargs)
+            results.put((step, psnr))
+        except Exception:
+            results.put((step, traceback.format_exc()))
+        tree = r = None
+
+
+class AsyncValidator:
+    """
+    Validation in a worker process. :code:`submit` snapshots the tree into shared
+    memory and queues it; results come back in submission order, each with the
+    snapshot it scored, so the best tree can be kept however late the result is.
+
+    :param device: device the worker renders on
+    :param c2ws: validation poses
+    :param gts: validation images (CPU), shared with the worker
+    :param renderer_kwargs: svox.VolumeRenderer options (step_size, ndc)
+    :param kwargs: render_validation options
+    :param max_pending: submit waits for results beyond this many pending snapshots
+    """
+    def __init__(self, device, c2ws, gts, renderer_kwargs, kwargs, max_pending=2):
+        ctx = torch.multiprocessing.get_context('spawn')
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.pending = {}
+        self.done = []
+        self.max_pending = max(max_pending, 1)
+        self.worker = ctx.Process(target=_validation_worker,
+                                  args=(self.jobs, self.results, device, c2ws.cpu(),
+                                        gts.share_memory_(), renderer_kwargs, kwargs),
+                                  daemon=True)
+        self.worker.start()
+
+    def _get(self, block):
+        while True:
+            try:
+                step, psnr = self.results.get(timeout=1.0) if block else \
+                             self.results.get_nowait()
+            except queue.Empty:
+                if not self.worker.is_alive():
+                    raise RuntimeError('Validation worker exited')
+                if not block:
+                    return None
+                continue
+            if isinstance(psnr, str):
+                raise RuntimeError('Validation failed in worker\n' + psnr)
+            snap, info = self.pending.pop(step)
+            return step, psnr, snap, info
+
+    def submit(self, step, tree, info=None):
+        """
+        Snapshot tree and queue it for validation.
+
+        :param step: int, identifies the result
+        :param info: returned with the result
+        """
+        while len(self.pending) >= self.max_pending:
+            self.done.append(self._get(block=True))
+        snap = tree.snapshot(share_memory=True)
+        self.pending[step] = (snap, info)
+        self.jobs.put((step, snap))
+
+    def poll(self, wait=False):
+        """
+        :param wait: wait for all pending results
+
+        :return: list of :code:`(step, psnr, snapshot, info)`, in submission order
+        """
+        while self.pending:
+            res = self._get(block=wait)
+            if res is None:
+                break
+            self.done.append(res)
+        done, self.done = self.done, []
+        return done
+
+    def close(self):
+        """
+        Wait for pending results and stop the worker.
+
+        :return: the remaining results, as :code:`poll`
+        """
+        done = self.poll(wait=True)
+        self.jobs.put(None)
+        self.worker.join()
+        return done
+
+
 def main(unused_argv):
     utils.set_random_seed(20200823)
     utils.update_flags(FLAGS)
@@ -253,10 +477,24 @@ def main(unused_argv):
     vis_dir = osp.splitext(FLAGS.input)[0] + '_render'
     os.makedirs(vis_dir, exist_ok=True)
     
-    print('N3Tree load')
-    t = DOT_N3Tree.load(FLAGS.input, map_location=device)
+    ckpt_path = FLAGS.checkpoint_path or osp.splitext(FLAGS.output)[0] + '_train.ckpt'
+    state = None
+    if FLAGS.resume and osp.isfile(ckpt_path):
+        print('Resuming from', ckpt_path)
+        state = torch.load(ckpt_path, map_location='cpu')
+        t = DOT_N3Tree.from_snapshot(state['tree'], device=device)
+        if state['basis_rms'] is not None:
+            # Otherwise optim_basis_all_step would silently restart RMSprop from zeros
+            assert state['basis_rms'].shape == t.data.shape, \
+                   'basis_rms in the training state does not match the tree'
+            t.basis_rms = state['basis_rms'].to(device=device)
+    else:
+        print('N3Tree load')
+        t = DOT_N3Tree.load(FLAGS.input, map_location=device)
     
     t.set_depth_limit(FLAGS.depth_limit)
+    t.geom_resize_fact = FLAGS.geom_resize_fact
+    t.max_resize_step = FLAGS.max_resize_step
     
     if 'llff' in FLAGS.config:
         ndc_config = svox.NDCConfig(width=W, height=H, focal=focal)
@@ -277,36 +515,212 @@ def main(unused_argv):
     #     optimizer = AdamW(t.parameters(), lr=FLAGS.lr, eps=adam_eps)
 
     n_train_imgs = len(train_c2w)
-    n_test_imgs = len(test_c2w)
+    prune = prune_func_bottom_up if FLAGS.prune_engine == 'bottom_up' else prune_func
+
+    def reorder_nodes(tree, weights):
+        # Right before sampling, so that the node ids in sel stay valid
+        if FLAGS.node_order == 'none':
+            return weights
+        return weights[tree.reorder(FLAGS.node_order)]
+
+    def make_train_rays_gt():
+        """
+        Ground truth of all training rays flattened once on the device,
+        view-major then row major, after checking that rays mode fits in memory.
+        The rays themselves are built per batch by train_ray_batch.
+        """
+        n_rays = n_train_imgs * H * W
+        # Per ray: the ground truth color, and the shuffle permutation or the
+        # last error with its float64 sampling weights and cdf
+        need = n_rays * (12 + (20 if FLAGS.ray_importance > 0 else 8))
+        if device == 'cuda':
+            free, _ = torch.cuda.mem_get_info()
+            assert need < free, \
+                f'train_mode rays needs about {need / 2 ** 30:.2f} GiB for {n_rays} rays, ' \
+                f'only {free / 2 ** 30:.2f} GiB are free; use --train_mode image'
+        return train_gt.reshape(-1, 3).to(device=device)
+
+    def train_ray_batch(idx):
+        # Rays of flat indices idx from one origin per view and the cached
+        # camera-space directions, rotated in float64 as in persp_rays.
+        # NDC scenes are converted here, so that batches go through forward() as is
+        view = idx // (H * W)
+        cam_dirs = svox.VolumeRenderer.camera_dirs(W, H, focal, device=device)[idx % (H * W)]
+        dirs = torch.einsum('bj,bij->bi', cam_dirs, train_rot[view]).float()
+        origins = train_c2w[view, :3, 3]
+        if ndc_config is None:
+            return svox.Rays(origins=origins, dirs=dirs, viewdirs=dirs)
+        o, d = svox.renderer.convert_to_ndc(origins, dirs, ndc_config.focal,
+                                            ndc_config.width, ndc_config.height)
+        return svox.Rays(origins=o, dirs=d, viewdirs=dirs)
+
+    def run_ray_epoch(s1):
+        """
+        One pass worth of ray batches (n_rays / ray_batch_size steps), shuffled,
+        or with ray_importance drawn with replacement from the mixture of uniform
+        and last-error sampling with the loss reweighted by 1 / (n_rays * p).
+
+        :return: sum of the batch MSEs, mean batch PSNR
+        """
+        n_rays = train_rays_gt.size(0)
+        batch_size = min(FLAGS.ray_batch_size, n_rays)
+        n_steps = (n_rays + batch_size - 1) // batch_size
+        if FLAGS.ray_importance > 0:
+            # Unnormalized p, uniform part at the mean error so the mix is by mass
+            p = ray_err.double().mul(FLAGS.ray_importance).add_(
+                (1.0 - FLAGS.ray_importance) * ray_err.double().mean())
+            cdf = torch.cat((p.new_zeros(1), torch.cumsum(p, dim=0)))
+            p_mean = cdf[-1].item() / n_rays
+            del p
+        else:
+            perm = torch.randperm(n_rays, device=device)
+        all_mse, tpsnr = 0.0, 0.0
+        for k in tqdm(range(n_steps)):
+            if FLAGS.ray_importance > 0:
+                u = torch.rand(batch_size, device=device, dtype=cdf.dtype) * cdf[-1]
+                idx = (torch.searchsorted(cdf, u, right=True) - 1).clamp_(0, n_rays - 1)
+                loss_w = (p_mean / (cdf[idx + 1] - cdf[idx]).clamp_(min=1e-12)).float()
+            else:
+                idx = perm[k * batch_size:(k + 1) * batch_size]
+                loss_w = None
+            rays = train_ray_batch(idx)
+            with t.accumulate_weights(op="sum") as accum:
+                rgb = r(rays, cuda=True)
+            with torch.no_grad():
+                s1 += accum.value
+            rgb = torch.clamp(rgb, 0.0, 1.0)
+            err = ((rgb - train_rays_gt[idx]) ** 2).sum(-1)
+            mse = (err if loss_w is None else err * loss_w).mean() / 3.0
+            mse.backward()
+            t.optim_basis_all_step(FLAGS.lr_sigma, FLAGS.lr_sh, rate_sel=1, sel=sel)
+            if ray_err is not None:
+                ray_err[idx] = err.detach()
+            mse_val = (err.detach().mean() / 3.0).cpu()
+            all_mse += mse_val.item()
+            tpsnr += (-10.0 * np.log(mse_val) / np.log(10.0)).item()
+        return all_mse, tpsnr / n_steps
+
+    val_kwargs = dict(height=H, width=W, focal=focal, batch_size=FLAGS.render_batch_size,
+                      prefetch_depth=FLAGS.prefetch_depth,
+                      render_interval=FLAGS.render_interval, vis_dir=vis_dir)
 
     def run_test_step(i):
         print('Evaluating')
+        tpsnr = render_validation(r, test_c2w, test_gt, step=i, **val_kwargs)
+        summary_writer.add_scalar(
+            'test/psnr', tpsnr, i)             
+        return tpsnr
+
+    def record_validation(step, validation_psnr, val_time, tree=None, snap=None):
+        # Returns False if training should stop
+        nonlocal best_validation_psnr
+        summary_writer.add_scalar('test/psnr_time', validation_psnr, int(round(val_time)))
+        print('** val psnr ', validation_psnr, 'best', best_validation_psnr)
+        if validation_psnr > best_validation_psnr:
+            best_validation_psnr = validation_psnr
+            # A training state being written may hold the buffers add() reuses
+            saver.wait()
+            ckpt.add(step, validation_psnr, tree=tree, snap=snap)
+            # best_t.save(FLAGS.output+'best.npz', compress=False)
+            print('')
+        elif not FLAGS.continue_on_decrease:
+            print('Stop since overfitting')
+            return False
+        return True
+
+    # Pinned buffers of the training state by name, reused while the shapes stay
+    # the same (the node count only changes when the capacity grows)
+    state_bufs = {}
+
+    def state_buffer(name, shape, dtype):
+        buf = state_bufs.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = torch.empty(shape, dtype=dtype, pin_memory=torch.cuda.is_available())
+            state_bufs[name] = buf
+        return buf
+
+    def save_training_state(epoch, s1):
+        # Everything to resume after epoch; tensors are copied to pinned memory
+        # without waiting and written by a background thread once they land
+        saver.wait()  # the previous state may still be written from the buffers
+
+        def host(name, x):
+            return state_buffer(name, x.shape, x.dtype).copy_(x, non_blocking=True)
+        tree_fields = itertools.count()
         with torch.no_grad():
-            tpsnr = 0.0
-            for j, (c2w, im_gt) in enumerate(zip(test_c2w, test_gt)):
-                im = r.render_persp(c2w, height=H, width=W, fx=focal, fast=False, cuda=True)
-                im = im.cpu().clamp_(0.0, 1.0)
-
-                mse = ((im - im_gt) ** 2).mean()
-                psnr = -10.0 * np.log(mse) / np.log(10.0)
-                tpsnr += psnr.item()
-
-                if FLAGS.render_interval > 0 and j % FLAGS.render_interval == 0:
-                    vis = torch.cat((im_gt, im), dim=1)
-                    vis = (vis * 255).numpy().astype(np.uint8)
-                    imageio.imwrite(f"{vis_dir}/{i:04}_{j:04}.png", vis)
-            
-            tpsnr /= n_test_imgs
-            summary_writer.add_scalar(
-                f'test/psnr', tpsnr, i)             
-            return tpsnr
+            train_state = {
+                'epoch': epoch,
+                'tree': t.snapshot(alloc=lambda shape, dtype: state_buffer(
+                    f'tree{next(tree_fields)}', shape, dtype), non_blocking=True),
+                # Rows of the snapshot only, as from_snapshot restores them
+                'basis_rms': host('basis_rms', t.basis_rms[:t.n_internal])
+                             if t.basis_rms is not None else None,
+                's1': host('s1', s1),
+                'sel': host('sel', sel) if sel is not None else None,
+                'ray_err': host('ray_err', ray_err)
+                           if FLAGS.train_mode == 'rays' and ray_err is not None else None,
+                'best_validation_psnr': best_validation_psnr,
+                'best': ckpt.state(),
+                'pre_mse': np.asarray(pre_mse).item(),
+                'train_time': train_time,
+                'rng': utils.get_rng_state(),
+            }
+        event = None
+        if t.data.is_cuda:
+            event = torch.cuda.Event()
+            event.record()
+        saver.save(train_state, ckpt_path, event=event)
+        print('Saving training state to', ckpt_path)
+
+    def poll_validation(wait=False):
+        keep_going = True
+        for step, validation_psnr, snap, val_time in async_val.poll(wait=wait):
+            print('** async val of epoch', step - 1)
+            summary_writer.add_scalar('test/psnr', validation_psnr, step)
+            keep_going = record_validation(step, validation_psnr, val_time,
+                                           snap=snap) and keep_going
+        return keep_going
         
     r = svox.VolumeRenderer(t, step_size=FLAGS.renderer_step_size, ndc=ndc_config)
-    best_validation_psnr = run_test_step(0)
-    print('** initial val psnr ', best_validation_psnr)
-    best_t = None
+    # Training time excluding validation, test/psnr_time is the PSNR against it (seconds)
+    # to compare train modes by wall clock
+    train_time = 0.0
+    if state is None:
+        best_validation_psnr = run_test_step(0)
+        print('** initial val psnr ', best_validation_psnr)
+        summary_writer.add_scalar('test/psnr_time', best_validation_psnr, 0)
+    else:
+        best_validation_psnr = state['best_validation_psnr']
+        train_time = state['train_time']
+    if FLAGS.train_mode == 'rays':
+        assert 0.0 <= FLAGS.ray_importance < 1.0, 'ray_importance must be in [0, 1)'
+        train_rays_gt = make_train_rays_gt()
+        train_rot = train_c2w[:, :3, :3].double()
+        # Last squared error of each ray, for ray_importance
+        ray_err = torch.ones(train_rays_gt.size(0), device=device) \
+                  if FLAGS.ray_importance > 0 else None
+        print('Training on', train_rays_gt.size(0), 'rays, batch', FLAGS.ray_batch_size)
+    async_val = None
+    if FLAGS.async_val:
+        async_val = AsyncValidator(device, test_c2w, test_gt,
+                                   dict(step_size=FLAGS.renderer_step_size, ndc=ndc_config),
+                                   val_kwargs, max_pending=FLAGS.async_val_pending)
+    # Best trees, copied to host asynchronously
+    ckpt = CheckpointManager(keep=FLAGS.keep_best)
+    saver = BackgroundSaver()
     pre_mse = 0
     sel = None
+    start_epoch = 0
+    if state is not None:
+        ckpt.load_state(state['best'])
+        pre_mse = state['pre_mse']
+        sel = state['sel'].to(device=device) if state['sel'] is not None else None
+        if FLAGS.train_mode == 'rays' and ray_err is not None and state['ray_err'] is not None:
+            ray_err.copy_(state['ray_err'])
+        utils.set_rng_state(state['rng'])
+        start_epoch = state['epoch'] + 1
+        print('Resuming at epoch', start_epoch, 'best val psnr', best_validation_psnr)
+        state = None
     # delta_mse_count = 0
     # prune =False
     # pre_delta_mse = 0
@@ -317,58 +731,73 @@ def main(unused_argv):
     # lr_sh_func=expon_lr(FLAGS.lr_sh, FLAGS.lr_sh_final, FLAGS.lr_sh_delay_steps*n_train_imgs,
     #                                 FLAGS.lr_sh_delay_mult, FLAGS.sample_every*n_train_imgs, periodic=True)  
          
-    for i in range(FLAGS.num_epochs):
+    for i in range(start_epoch, FLAGS.num_epochs):
         print('epoch', i)
         tpsnr = 0.0
         s1 = torch.zeros_like(t.child, dtype=t.data.dtype)  # E(x)
         all_mse = np.zeros(1)
-        for j, (c2w, im_gt) in tqdm(enumerate(zip(train_c2w, train_gt)), total=n_train_imgs):
-            # step=i*n_train_imgs+j
-            # if FLAGS.use_postierior:
-                # im = r.render_persp(c2w, height=H, width=W, fx=focal, cuda=True)
-                # dif = im-im_gt.to(device)
-                # error = (dif*dif).sum(-1)
-                # weight = reweight_image(t, error, c2w, r._get_options(), width=W, height=H, fx=focal)   
-            # else:   
-            with t.accumulate_weights(op="sum") as accum:
-                im = r.render_persp(c2w, height=H, width=W, fx=focal, cuda=True)
-            weight = accum.value
+        epoch_start = time.time()
+        if FLAGS.train_mode == 'rays':
+            ray_mse, tpsnr = run_ray_epoch(s1)
+            all_mse += ray_mse
+        else:
+            train_gts = utils.ImagePrefetcher(train_gt, device, FLAGS.prefetch_depth)
+            for (j, im_gt), c2w in tqdm(zip(train_gts, train_c2w), total=n_train_imgs):
+                # step=i*n_train_imgs+j
+                # if FLAGS.use_postierior:
+                    # im = r.render_persp(c2w, height=H, width=W, fx=focal, cuda=True)
+                    # dif = im-im_gt.to(device)
+                    # error = (dif*dif).sum(-1)
+                    # weight = reweight_image(t, error, c2w, r._get_options(), width=W, height=H, fx=focal)   
+                # else:   
+                with t.accumulate_weights(op="sum") as accum:
+                    im = r.render_persp(c2w, height=H, width=W, fx=focal, cuda=True)
+                weight = accum.value
+
+                with torch.no_grad():
+                    # weight -= weight.min()
+                    # weight /= weight.max()                
+                    s1 += weight
+                weight = None    
+                im = torch.clamp(im, 0.0, 1.0)
+                mse = ((im - im_gt) ** 2).mean()
+                im_gt = None
 
-            with torch.no_grad():
-                # weight -= weight.min()
-                # weight /= weight.max()                
-                s1 += weight
-            weight = None    
-            im_gt_ten = im_gt.to(device=device)
-            im = torch.clamp(im, 0.0, 1.0)
-            mse = ((im - im_gt_ten) ** 2).mean()
-            im_gt_ten = None
-
-            # optimizer.zero_grad()
-            # t.data.grad = None  # This helps save memory weirdly enough
-            mse.backward()
+                # optimizer.zero_grad()
+                # t.data.grad = None  # This helps save memory weirdly enough
+                mse.backward()
             
-            # lr_sigma = lr_sigma_func.step(step)
-            # lr_sh = lr_sh_func.step(step)
+                # lr_sigma = lr_sigma_func.step(step)
+                # lr_sh = lr_sh_func.step(step)
             
-            # summary_writer.add_scalar(
-            #     f'train/lr_sigma', lr_sigma, step
-            # )
-            # summary_writer.add_scalar(
-            #     f'train/lr_sh', lr_sh, step
-            # )
-            t.optim_basis_all_step(FLAGS.lr_sigma, FLAGS.lr_sh, rate_sel=1, sel=sel)
-            # t.optim_basis_all_step(lr_sigma, lr_sh, rate_sel=2, sel=sel)
-            # optimizer.step()
-            mse_val = mse.detach().cpu()
-            if mse_val < 0:
-                assert False, 'Invalid mse'
-            all_mse += mse_val.item()
-            psnr = -10.0 * np.log(mse_val) / np.log(10.0)
-            tpsnr += psnr.item()
-            
-        tpsnr /= n_train_imgs
-        print('** train_psnr', tpsnr)
+                # summary_writer.add_scalar(
+                #     f'train/lr_sigma', lr_sigma, step
+                # )
+                # summary_writer.add_scalar(
+                #     f'train/lr_sh', lr_sh, step
+                # )
+                t.optim_basis_all_step(FLAGS.lr_sigma, FLAGS.lr_sh, rate_sel=1, sel=sel)
+                # t.optim_basis_all_step(lr_sigma, lr_sh, rate_sel=2, sel=sel)
+                # optimizer.step()
+                mse_val = mse.detach().cpu()
+                if mse_val < 0:
+                    assert False, 'Invalid mse'
+                all_mse += mse_val.item()
+                psnr = -10.0 * np.log(mse_val) / np.log(10.0)
+                tpsnr += psnr.item()
+            tpsnr /= n_train_imgs
+            if train_gts.stats['n'] > 0:
+                summary_writer.add_scalar(
+                    'prefetch/stall_time', train_gts.stats['stall_time'], i)
+                summary_writer.add_scalar(
+                    'prefetch/queue_depth', train_gts.stats['queue_depth'] / train_gts.stats['n'], i)
+
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        train_time += time.time() - epoch_start
+        print('** train_psnr', tpsnr, 'train time', train_time)
+        summary_writer.add_scalar(
+            f'train/wall_time', train_time, i)
         summary_writer.add_scalar(
             f'train/train_psnr', tpsnr, i) 
 
@@ -384,23 +813,28 @@ def main(unused_argv):
         # )        
         pre_mse = all_mse
        
-        if i % FLAGS.val_interval == FLAGS.val_interval - 1 or i == FLAGS.num_epochs - 1:
-            validation_psnr = run_test_step(i + 1)
-            print('** val psnr ', validation_psnr, 'best', best_validation_psnr)
-            if validation_psnr > best_validation_psnr:
-                best_validation_psnr = validation_psnr
-                best_t = t.clone(device='cpu')# SVOX 0.2.22
-                # best_t.save(FLAGS.output+'best.npz', compress=False)
-                print('')
-            elif not FLAGS.continue_on_decrease:
-                print('Stop since overfitting')
-                break
+        last_epoch = i == FLAGS.num_epochs - 1
+        keep_going = True
+        if i % FLAGS.val_interval == FLAGS.val_interval - 1 or last_epoch:
+            if async_val is None:
+                validation_psnr = run_test_step(i + 1)
+                keep_going = record_validation(i + 1, validation_psnr, train_time, tree=t)
+            else:
+                async_val.submit(i + 1, t, train_time)
+        if async_val is not None:
+            # On the last epoch, wait so that the best is known before saving
+            keep_going = poll_validation(wait=last_epoch)
+        if not keep_going:
+            break
             
-            if i == FLAGS.num_epochs - 1:
-                print('Save the best')
-                # name = FLAGS.output
-                best_t.save(FLAGS.output, compress=False)     
-                return 
+        if last_epoch:
+            if async_val is not None:
+                async_val.close()
+            saver.wait()
+            print('Save the best')
+            # name = FLAGS.output
+            ckpt.save(FLAGS.output, compress=FLAGS.save_compress)     
+            return 
         
         # if i == 0:
         #     s1 = prune_func(t, s1, summary_writer=summary_writer, gstep_id=i, thresh_val=FLAGS.thresh_val)
@@ -410,15 +844,17 @@ def main(unused_argv):
         #     delta_mse_count = 0  
         if FLAGS.prune_only:
             if i%FLAGS.prune_every == 0:
-                prune_func(t, s1, summary_writer=summary_writer, gstep_id=i, thresh_val=FLAGS.thresh_val, recursive=FLAGS.recursive_prune, thresh_type=FLAGS.thresh_type)
+                prune(t, s1, summary_writer=summary_writer, gstep_id=i, thresh_val=FLAGS.thresh_val, recursive=FLAGS.recursive_prune, thresh_type=FLAGS.thresh_type)
         elif FLAGS.sample_only:
             if i%FLAGS.sample_every == 0:
+                s1 = reorder_nodes(t, s1)
                 sel = sample_func(t, FLAGS.sample_rate, s1) 
         else:
             if i%FLAGS.prune_every == 0:
-                prune_func(t, s1, summary_writer=summary_writer, gstep_id=i, thresh_val=FLAGS.thresh_val, thresh_type=FLAGS.thresh_type, recursive=FLAGS.recursive_prune)
+                prune(t, s1, summary_writer=summary_writer, gstep_id=i, thresh_val=FLAGS.thresh_val, thresh_type=FLAGS.thresh_type, recursive=FLAGS.recursive_prune)
             if i%FLAGS.sample_every == 0:
             # prune_func(t, s1, summary_writer=summary_writer, gstep_id=i, thresh_val=FLAGS.thresh_val)
+                s1 = reorder_nodes(t, s1)
                 sel = sample_func(t, FLAGS.sample_rate, s1) 
             
         # t.shrink_to_fit()
@@ -435,13 +871,30 @@ def main(unused_argv):
         
         summary_writer.add_scalar(
             f'train/num_nodes', t.n_leaves, i)     
+        frag = t.fragmentation_stats()
+        for key in ['capacity', 'n_free', 'n_reused', 'n_appended']:
+            summary_writer.add_scalar(f'memory/{key}', frag[key], i)
         # summary_writer.add_scalar(
         #     f'train/lr', get_lr(optimizer), i)
+
+        if FLAGS.checkpoint_every > 0 and (i + 1) % FLAGS.checkpoint_every == 0:
+            # Late validation results are not part of the state, collect them first
+            if async_val is not None and not poll_validation(wait=True):
+                break
+            save_training_state(i, s1)
         
+    saver.wait()
+    if async_val is not None:
+        # Snapshots validated after stopping can still be the best
+        for step, validation_psnr, snap, val_time in async_val.close():
+            summary_writer.add_scalar('test/psnr', validation_psnr, step)
+            record_validation(step, validation_psnr, val_time, snap=snap)
     if not FLAGS.nosave:
-        if best_t is not None:
+        if ckpt.best is not None:
             print('Saving best model to', FLAGS.output)
-            best_t.save(FLAGS.output+'best.npz', compress=False)
+            # Same format as the output, so .n3t and --save_compress use the parallel writer
+            ckpt.save(FLAGS.output + 'best' + osp.splitext(FLAGS.output)[1],
+                      compress=FLAGS.save_compress)
         else:
             print('Did not improve upon initial model')
 
@@ -0,0 +1,64 @@
+"""Synthetic DOT trees, weights and cameras, for benchmarks and tests."""
+import torch
+
+from DOT.utils import DOT_N3Tree
+
+
+def make_synthetic_tree(init_refine=4, refine_rounds=3, refine_frac=0.2,
+                        data_format='SH9', depth_limit=15, device='cpu', seed=0):
+    """
+    Build a random DOT_N3Tree: a uniform grid followed by several rounds of
+    refinement on random subsets of the leaves, with random data.
+    """
+    g = torch.Generator().manual_seed(seed)
+    tree = DOT_N3Tree(init_refine=init_refine, data_format=data_format,
+                      depth_limit=depth_limit, device=device)
+    for _ in range(refine_rounds):
+        leaves = tree._all_leaves()
+        k = int(leaves.size(0) * refine_frac)
+        idxs = leaves[torch.randperm(leaves.size(0), generator=g)[:k]]
+        tree.refine(sel=(*idxs.long().T,))
+    tree.data.data.copy_(torch.randn(tree.data.shape, generator=g))
+    return tree
+
+
+def make_synthetic_weights(tree, scale=0.3, seed=0):
+    """
+    Exponentially distributed per-leaf weights, most of them small
+    """
+    g = torch.Generator().manual_seed(seed + 1)
+    w = -torch.log(torch.rand(tree.child.shape, generator=g)) * scale
+    return w.to(device=tree.data.device, dtype=tree.data.dtype)
+
+
+def make_synthetic_scene(init_refine=6, data_format='SH9', device='cpu', seed=0,
+                         radius=0.3, sigma=50.0):
+    """
+    Uniform DOT_N3Tree holding an opaque ball of random SH colors centered
+    in the (mostly empty) volume, for rendering benchmarks
+    """
+    g = torch.Generator().manual_seed(seed)
+    tree = DOT_N3Tree(init_refine=init_refine, data_format=data_format, device='cpu')
+    leaves = tree._all_leaves().long()
+    centers = tree._calc_corners(leaves, cuda=False) + 0.5 / tree.N ** (init_refine + 1)
+    inside = (centers - 0.5).norm(dim=-1) < radius
+    vals = torch.randn((leaves.size(0), tree.data_dim), generator=g)
+    vals[:, -1] = torch.where(inside, torch.tensor(sigma), torch.tensor(0.0))
+    tree.data.data[(*leaves.T,)] = vals
+    return tree.to(device)
+
+
+def look_at_center(dist=2.0, angle=0.0, height=0.5):
+    """
+    (4, 4) c2w on a circle around the center of :code:`[0,1]^3`, looking at it
+    """
+    theta = torch.tensor(angle)
+    eye = torch.tensor([0.5 + dist * torch.sin(theta), 0.5 + height, 0.5 + dist * torch.cos(theta)])
+    back = eye - 0.5
+    back = back / back.norm()
+    right = torch.cross(torch.tensor([0.0, 1.0, 0.0]), back, dim=0)
+    right = right / right.norm()
+    up = torch.cross(back, right, dim=0)
+    c2w = torch.eye(4)
+    c2w[:3, 0], c2w[:3, 1], c2w[:3, 2], c2w[:3, 3] = right, up, back, eye
+    return c2w
@@ -0,0 +1,83 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("skimage")
+
+from DOT.synthetic import make_synthetic_tree
+from DOT.octree.nerf import utils
+from DOT.utils import BackgroundSaver, CheckpointManager, DOT_N3Tree, save_atomic
+
+
+def _assert_same_tree(a, b):
+    n = a.n_internal
+    assert b.n_internal == n
+    assert torch.equal(a.child[:n], b.child[:n])
+    assert torch.equal(a.parent_depth[:n], b.parent_depth[:n])
+    assert torch.equal(a.data.data[:n], b.data.data[:n])
+    assert a.n_leaves == b.n_leaves
+    points = torch.rand(256, 3, generator=torch.Generator().manual_seed(0))
+    assert torch.equal(a(points), b(points))
+
+
+def test_snapshot_roundtrip():
+    tree = make_synthetic_tree(init_refine=2, refine_rounds=2, seed=0)
+    restored = DOT_N3Tree.from_snapshot(tree.snapshot())
+    _assert_same_tree(tree, restored)
+
+
+def test_resume_keeps_basis_rms(tmp_path):
+    tree = make_synthetic_tree(init_refine=2, refine_rounds=2, seed=1)
+    tree.reserve(100)  # capacity above n_internal, as during training
+    tree.basis_rms = torch.rand_like(tree.data.data)
+    path = str(tmp_path / 'state.ckpt')
+    saver = BackgroundSaver()
+    saver.save({'tree': tree.snapshot(),
+                'basis_rms': tree.basis_rms[:tree.n_internal].clone(),
+                'rng': utils.get_rng_state()}, path)
+    saver.wait()
+    expected = torch.rand(8)
+
+    state = torch.load(path)
+    restored = DOT_N3Tree.from_snapshot(state['tree'])
+    _assert_same_tree(tree, restored)
+    assert state['basis_rms'].shape == restored.data.shape
+    assert torch.equal(state['basis_rms'], tree.basis_rms[:tree.n_internal])
+    utils.set_rng_state(state['rng'])
+    assert torch.equal(torch.rand(8), expected)
+
+
+def test_save_atomic_replaces(tmp_path):
+    path = str(tmp_path / 'x.ckpt')
+    save_atomic({'a': 1}, path)
+    save_atomic({'a': 2}, path)
+    assert torch.load(path) == {'a': 2}
+    assert [p.name for p in tmp_path.iterdir()] == ['x.ckpt']
+
+
+def test_checkpoint_manager_keeps_best(tmp_path):
+    tree = make_synthetic_tree(init_refine=1, refine_rounds=1, seed=2)
+    ckpt = CheckpointManager(keep=2)
+    best = None
+    for step, score in enumerate([20.0, 22.0, 21.0, 19.0]):
+        tree.data.data.add_(0.1)
+        if ckpt.add(step, score, tree=tree) and score == 22.0:
+            best = copy.deepcopy(tree)
+    assert ckpt.best == (1, 22.0)
+    assert [s[1] for s in ckpt.snapshots] == [1, 2]
+    path = str(tmp_path / 'best.npz')
+    ckpt.save(path, compress=False)
+    assert torch.equal(DOT_N3Tree.load(path).data.data,
+                       best.data.data[:best.n_internal].half().float())
+
+
+def test_checkpoint_state_is_exact_size():
+    tree = make_synthetic_tree(init_refine=1, refine_rounds=1, seed=4)
+    ckpt = CheckpointManager(keep=1, headroom=0.25)
+    ckpt.add(0, 1.0, tree=tree)
+    (score, step, snap), = ckpt.state()
+    data = snap['data']
+    # No headroom left in the storage torch.save writes
+    assert data.untyped_storage().nbytes() == data.numel() * data.element_size()
+    assert torch.equal(data, tree.data.data[:tree.n_internal])
@@ -0,0 +1,33 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("skimage")
+
+from DOT.synthetic import make_synthetic_tree
+
+
+def test_merge_nids_matches_merge():
+    tree = make_synthetic_tree(init_refine=2, refine_rounds=2, refine_frac=0.3, seed=5)
+    frontier = tree._frontier
+    pos = torch.arange(0, frontier.numel(), 3)
+    # Duplicates and nodes off the frontier (the root, an internal node) are ignored
+    nids = torch.cat([frontier[pos], frontier[pos[:2]], torch.tensor([0, 1])])
+
+    t_ref, t_ids = copy.deepcopy(tree), copy.deepcopy(tree)
+    t_ref.merge(pos)
+    assert t_ids.merge_nids(nids)
+
+    assert torch.equal(t_ids.child, t_ref.child)
+    assert torch.equal(t_ids.parent_depth, t_ref.parent_depth)
+    assert torch.equal(t_ids.data.data, t_ref.data.data)
+    t_ids.check_integrity()
+    t_ids.check_index_consistency()
+
+
+def test_merge_nids_off_frontier_is_noop():
+    tree = make_synthetic_tree(init_refine=2, refine_rounds=1, refine_frac=0.3, seed=6)
+    child = tree.child.clone()
+    assert not tree.merge_nids(torch.tensor([0]))
+    assert torch.equal(tree.child, child)
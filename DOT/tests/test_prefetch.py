@@ -0,0 +1,34 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+pytest.importorskip("absl")
+pytest.importorskip("yaml")
+pytest.importorskip("PIL")
+
+from DOT.octree.nerf.utils import ImagePrefetcher
+
+
+@pytest.mark.parametrize("depth", [0, 1, 3])
+def test_prefetcher_yields_images_in_order(depth):
+    images = np.random.RandomState(0).rand(6, 4, 5, 3).astype(np.float32)
+    order = [4, 0, 5, 2, 2, 1]
+    prefetcher = ImagePrefetcher(images, 'cpu', depth=depth, order=order)
+    seen = []
+    for j, im in prefetcher:
+        assert im.dtype == torch.float32
+        assert torch.equal(im, torch.from_numpy(images[j]))
+        seen.append(j)
+    assert seen == order
+    assert len(prefetcher) == len(order)
+
+
+def test_prefetcher_stops_early():
+    images = np.zeros((50, 2, 2, 3), dtype=np.float32)
+    prefetcher = ImagePrefetcher(images, 'cpu', depth=2)
+    for k, _ in enumerate(prefetcher):
+        if k == 3:
+            break
+    # A new pass starts over
+    assert [j for j, _ in prefetcher] == list(range(50))
+
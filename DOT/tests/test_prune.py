@@ -0,0 +1,49 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("skimage")
+
+from DOT.synthetic import make_synthetic_tree, make_synthetic_weights
+from DOT.utils import prune_func, prune_func_bottom_up
+
+
+def _leaf_weights(tree, weights):
+    # Leaf (depth, corner) -> weight, independent of the node layout
+    leaves = tree._all_leaves().long()
+    corners = tree._calc_corners(leaves, cuda=False)
+    depths = tree.parent_depth[leaves[:, 0], 1]
+    vals = weights[(*leaves.T,)]
+    return {(int(d), *[round(c, 6) for c in corner]): v
+            for d, corner, v in zip(depths.tolist(), corners.tolist(), vals.tolist())}
+
+
+@pytest.mark.parametrize("recursive", [False, True])
+@pytest.mark.parametrize("thresh_type", ["weight", "sigma"])
+def test_bottom_up_matches_loop(recursive, thresh_type):
+    tree = make_synthetic_tree(init_refine=2, refine_rounds=2, refine_frac=0.3, seed=3)
+    weights = make_synthetic_weights(tree, scale=0.3, seed=3)
+    kwargs = dict(thresh_type=thresh_type, thresh_val=1.0, thresh_tol=0.8,
+                  recursive=recursive)
+
+    t_ref, t_fast = copy.deepcopy(tree), copy.deepcopy(tree)
+    w_ref = prune_func(t_ref, weights.clone(), **kwargs)
+    w_fast = prune_func_bottom_up(t_fast, weights.clone(), **kwargs)
+
+    assert t_ref.n_leaves == t_fast.n_leaves
+    ref, fast = _leaf_weights(t_ref, w_ref), _leaf_weights(t_fast, w_fast)
+    assert ref.keys() == fast.keys()
+    for key in ref:
+        assert ref[key] == pytest.approx(fast[key], rel=1e-5, abs=1e-6)
+
+
+def test_loop_reduces_into_parent_slot():
+    tree = make_synthetic_tree(init_refine=1, refine_rounds=0, seed=1)
+    weights = torch.full(tree.child.shape, 0.01)
+    n_before = tree.n_leaves
+    w = prune_func(tree, weights, thresh_val=1.0, recursive=False)
+    assert tree.n_leaves < n_before
+    # The merged nodes' weight sums land on the new leaves, not on the root slot
+    leaves = tree._all_leaves().long()
+    assert torch.allclose(w[(*leaves.T,)], torch.tensor(0.01 * tree.N ** 3))
@@ -0,0 +1,76 @@
+import math
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("skimage")
+svox = pytest.importorskip("svox")
+np = pytest.importorskip("numpy")
+
+from DOT.synthetic import make_synthetic_scene, look_at_center
+
+
+@pytest.fixture(scope="module")
+def renderer():
+    tree = make_synthetic_scene(init_refine=4, data_format='SH4', seed=1)
+    return svox.VolumeRenderer(tree)
+
+
+def test_first_frame_is_full(renderer):
+    cache = svox.ReprojectionCache()
+    c2w = look_at_center(angle=0.0)
+    with torch.no_grad():
+        im = cache.render(renderer, c2w, 32, 32, fx=40.0)
+        ref = renderer.render_persp(c2w, 32, 32, fx=40.0, cuda=False)
+    assert cache.valid_fraction == 0.0
+    assert torch.allclose(im, ref, atol=1e-5)
+
+
+def test_path_matches_full_render(renderer):
+    cache = svox.ReprojectionCache(refresh_every=4)
+    path = [look_at_center(angle=2 * math.pi * k / 90) for k in range(6)]
+    with torch.no_grad():
+        for k, c2w in enumerate(path):
+            im = cache.render(renderer, c2w, 32, 32, fx=40.0)
+            ref = renderer.render_persp(c2w, 32, 32, fx=40.0, cuda=False)
+            if k % 4 != 0:
+                # Small steps along the orbit keep most pixels reprojectable
+                assert cache.valid_fraction > 0.5
+            mse = ((im - ref) ** 2).mean().item()
+            assert mse < 1e-4
+
+
+def test_windows_skip_borders_and_cut(renderer):
+    cache = svox.ReprojectionCache()
+    with torch.no_grad():
+        cache.render(renderer, look_at_center(angle=0.0), 16, 16, fx=20.0)
+        start, stop = cache._warp(look_at_center(angle=0.02), 16, 16, 20.0, 20.0)
+    start, stop = start.view(16, 16), stop.view(16, 16)
+    # Border pixels have an incomplete neighborhood and are marched in full
+    assert (start[0] == 0).all() and torch.isinf(stop[0]).all()
+    assert (start <= stop).all()
+
+    cache.reset()
+    assert cache._prev is None and cache.valid_fraction == 0.0
+
+
+def test_path_frames_match_plain_renders():
+    pytest.importorskip("absl")
+    pytest.importorskip("yaml")
+    pytest.importorskip("PIL")
+    from DOT.octree.nerf.utils import render_path_octree
+
+    tree = make_synthetic_scene(init_refine=4, data_format='SH4', seed=2)
+    poses = torch.stack([look_at_center(angle=2 * math.pi * k / 120) for k in range(10)])
+    dataset = SimpleNamespace(w=24, h=24, focal=30.0, camtoworlds=poses.numpy())
+    args = SimpleNamespace(config='blender', spherify=False, render_path=False,
+                           renderer_step_size=1e-4, no_early_stop=False)
+    with torch.no_grad():
+        plain = render_path_octree(tree, dataset, SimpleNamespace(reproject=False, **vars(args)))
+        cached = render_path_octree(tree, dataset, SimpleNamespace(reproject=True, **vars(args)))
+    # Frame 8 is a refresh, the others past the first reuse the previous windows
+    assert len(cached) == len(plain) == 10
+    for a, b in zip(cached, plain):
+        diff = np.abs(a.astype(np.float32) - b.astype(np.float32))
+        assert diff.mean() < 1.0 and diff.max() <= 32
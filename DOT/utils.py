@@ -7,7 +7,10 @@ from skimage.filters._gaussian import gaussian
 import torch.nn as nn
 from svox import N3Tree
 from svox.helpers import DataFormat
+from svox import treefile
 from warnings import warn
+import os
+import threading
 
 _C = _get_c_extension()
 
@@ -62,10 +65,17 @@ def prune_func(DOT, instant_weights,
             # discover the fronts whose all children are included in sel
             mask = (counts >= int(DOT.N**3*thresh_tol)).numpy()
             sel_nids = nids[mask]
-            if sel_nids.size(0) == 0 or not DOT.merge_nids(sel_nids):
+            # Only frontier nodes other than the root are merged, so only they get reduced
+            # weights. Their parent slots must be read before merge_nids frees their rows
+            sel_nids = sel_nids[(DOT._frontier_index(sel_nids) >= 0).to(sel_nids.device) &
+                                (sel_nids != 0)]
+            if sel_nids.size(0) == 0:
                 break
             parent_sel = (*DOT._unpack_index(
                 DOT.parent_depth[sel_nids, 0]).long().T,)
+            reduced = instant_weights[sel_nids].view(-1, DOT.N ** 3).sum(-1)
+            if not DOT.merge_nids(sel_nids):
+                break
             # if pre_sel is not None:
                 # if sel_nids.size(0) == 0 or torch.equal(pre_sel, sel_nids):
                 #     break
@@ -75,7 +85,6 @@ def prune_func(DOT, instant_weights,
             toltal += n
             print(f'Prune {n}/{leaves.size(0)}')
             
-            reduced = instant_weights[sel_nids].view(-1, DOT.N ** 3).sum(-1)
             instant_weights[parent_sel] = reduced
 
             if not recursive:
@@ -96,6 +105,87 @@ def update_val_leaves(DOT, instant_weights, thresh_type='weight'):
     val = torch.nan_to_num(val, nan=0)
     return val, leaves
 
+def prune_func_bottom_up(DOT, instant_weights,
+                         thresh_type='weight',
+                         thresh_val=5e-3,
+                         thresh_tol=0.8,
+                         summary_writer=None,
+                         gstep_id=None,
+                         recursive=True,
+                         ):
+    """
+    Tensorized equivalent of :code:`prune_func`.
+
+    Instead of re-scanning the leaves after every round of merges, the nodes
+    which collapse are decided level by level from the deepest one upwards:
+    a node collapses when each of its children is a leaf or collapses itself,
+    and enough of those children fall under the threshold. The weight
+    reductions are written in the same sweep, and the tree is edited once
+    with :code:`DOT.collapse`.
+
+    The resulting tree and the weights at its leaves match :code:`prune_func`.
+    As there, recursive rounds after the first one threshold on the weights
+    even if :code:`thresh_type == 'sigma'`. The root is never merged.
+    """
+    non_writer = summary_writer is None
+    if not non_writer:
+        assert gstep_id is not None
+    with torch.no_grad():
+        N3 = DOT.N ** 3
+        n_int = DOT.n_internal
+        device = instant_weights.device
+        min_count = int(N3 * thresh_tol)
+
+        child = DOT.child[:n_int].to(device).view(n_int, N3)
+        parent_depth = DOT.parent_depth[:n_int].to(device)
+        is_leaf = child == 0
+        live = parent_depth[:, 0] != -1
+        live[0] = False
+
+        if thresh_type == 'sigma':
+            val = DOT.data.data[:n_int, ..., -1].to(device).reshape(n_int, N3)
+        elif thresh_type == 'weight':
+            val = instant_weights[:n_int].view(n_int, N3)
+        val = torch.nan_to_num(val, nan=0)
+        # Nodes merged by the first round of prune_func
+        first = live & is_leaf.all(dim=1) & ((val < thresh_val).sum(dim=1) >= min_count)
+        val = None
+
+        def reduce_weights(nids):
+            parent_sel = (*DOT._unpack_index(parent_depth[nids, 0]).long().T,)
+            instant_weights[parent_sel] = instant_weights[nids].view(-1, N3).sum(-1)
+
+        if recursive and first.any():
+            collapse = first.clone()
+            ids = live.nonzero(as_tuple=False).reshape(-1)
+            depths = parent_depth[ids, 1]
+            order = torch.argsort(depths, descending=True)
+            ids = ids[order]
+            _, counts = torch.unique_consecutive(depths[order], return_counts=True)
+            for nids in torch.split(ids, counts.tolist()):
+                # Children on deeper levels are final by now
+                child_ids = nids[:, None] + child[nids].long()
+                leafish = is_leaf[nids] | collapse[child_ids]
+                val = torch.nan_to_num(instant_weights[nids].view(-1, N3), nan=0)
+                good = leafish.all(dim=1) & ((val < thresh_val).sum(dim=1) >= min_count)
+                good |= first[nids]
+                collapse[nids] = good
+                if good.any():
+                    reduce_weights(nids[good])
+            sel_nids = collapse.nonzero(as_tuple=False).reshape(-1)
+        else:
+            sel_nids = first.nonzero(as_tuple=False).reshape(-1)
+            if sel_nids.numel():
+                reduce_weights(sel_nids)
+
+        total = sel_nids.numel() * (N3 - 1)
+        if sel_nids.numel():
+            DOT.collapse(sel_nids)
+        print(f'Prune {total} nodes in total.')
+        if not non_writer:
+            summary_writer.add_scalar('train/number_prune', total, gstep_id)
+        return instant_weights
+
 def sample_func(tree, sampling_rate, VAL, repeats=1, self_cp=True):
     with torch.no_grad():
         val, leaves = update_val_leaves(tree, VAL)
@@ -104,6 +194,9 @@ def sample_func(tree, sampling_rate, VAL, repeats=1, self_cp=True):
         print(f'Start sampling {sample_k} nodes, and increase {delta} nodes.')
         idxs = select(sample_k, val, leaves)
         interval = idxs.size(0)//repeats
+        # Group i refines its nodes i times: interval * (1 + N^3 + ... + N^(3(i-1)))
+        tree.reserve(sum(interval * (tree.N ** (3 * r))
+                         for i in range(1, repeats+1) for r in range(i)))
         
         for i in range(1, repeats+1):
             start = (i-1)*interval
@@ -148,6 +241,7 @@ def get_lr(optimizer):
 class DOT_N3Tree(N3Tree):
     def __init__(self, N=2, data_dim=None, depth_limit=10,
                  init_reserve=1, init_refine=0, geom_resize_fact=1.0,
+                 max_resize_step=0, resize_chunk=0,
                  radius=0.5, center=[0.5, 0.5, 0.5],
                  data_format="SH9",
                  extra_data=None,
@@ -173,6 +267,9 @@ class DOT_N3Tree(N3Tree):
                             inital resolution will be :code:`[N^(init_refine + 1)]^3`.
                             initial max_depth will be init_refine.
         :param geom_resize_fact: float geometric resizing factor
+        :param max_resize_step: int max number of nodes added by one resize on top of the
+                                nodes actually needed (0 = no limit)
+        :param resize_chunk: int if > 0, the capacity grows in multiples of this many nodes
         :param radius: float or list, 1/2 side length of cube (possibly in each dim)
         :param center: list center of space
         :param data_format: a string to indicate the data format. :code:`RGBA | SH# | SG# | ASG#`
@@ -225,6 +322,8 @@ class DOT_N3Tree(N3Tree):
 
         self.depth_limit = depth_limit
         self.geom_resize_fact = geom_resize_fact
+        self.max_resize_step = max_resize_step
+        self.resize_chunk = resize_chunk
 
         if extra_data is not None:
             assert isinstance(extra_data, torch.Tensor)
@@ -234,7 +333,11 @@ class DOT_N3Tree(N3Tree):
             self.extra_data = None
 
         self._ver = 0
+        self._data_ver = 0
+        self._last_mip = None
         self._invalidate()
+        self._n_reused_total = 0
+        self._n_appended_total = 0
         self._lock_tree_structure = False
         self._weight_accum = None
         self._weight_accum_op = None
@@ -248,18 +351,6 @@ class DOT_N3Tree(N3Tree):
             flat = torch.div(flat, self.N, rounding_mode='trunc')
         return torch.stack((flat, t[2], t[1], t[0]), dim=-1)
 
-    def _invalidate(self):
-        self._ver += 1
-        self._last_all_leaves = None
-        self._last_frontier = None
-        self._last_all_inter = None
-
-    def _all_internals(self):
-        if self._last_all_inter is None:
-            self._last_all_inter = (self.child[
-                :self.n_internal] != 0).nonzero(as_tuple=False).cpu()
-        return self._last_all_inter
-    
     def _spec(self, world=True):
         """
         Pack tree into a TreeSpec (for passing data to C++ extension)
@@ -281,14 +372,88 @@ class DOT_N3Tree(N3Tree):
             tree_spec._weight_accum_max = (self._weight_accum_op == 'max')
         return tree_spec    
                 
-    def merge_nids(self, nids):
-        device = self.data.device
-        nids = nids.to(device)
-        idxs = [f in nids for f in self._frontier]
-        return self.merge(idxs)
-    
+    def _frontier_index(self, nids):
+        """
+        Resolve node ids to positions in :code:`self._frontier`,
+        by binary search in the (sorted) cached frontier.
+
+        :param nids: tensor of node ids
+        :return: :code:`(len(nids))` long positions, -1 for nodes not on the frontier
+        """
+        frontier = self._frontier
+        nids = nids.to(device=frontier.device, dtype=frontier.dtype).reshape(-1)
+        if frontier.numel() == 0:
+            return torch.full_like(nids, -1)
+        pos = torch.searchsorted(frontier, nids).clamp_max_(frontier.numel() - 1)
+        return torch.where(frontier[pos] == nids, pos, torch.full_like(pos, -1))
+
+    def merge_nids(self, nids, op=torch.mean):
+        """
+        Merge the given nodes into their parents.
+        Ids of nodes which are not on the frontier are ignored.
+
+        :param nids: tensor of node ids
+        :param op: reduction to combine child leaves into node, see :code:`merge()`
+
+        :return: True iff any node was merged
+        """
+        pos = self._frontier_index(nids)
+        return self.merge(torch.unique(pos[pos >= 0]), op=op)
+
+    def collapse(self, nids, op=torch.mean):
+        """
+        Merge a set of nodes into their parents in one structural edit.
+        Unlike :code:`merge()`, the nodes may be nested: each child of a node
+        in :code:`nids` must be a leaf or in :code:`nids` as well.
+        Deeper nodes are reduced first, so the result equals repeated merges
+        of the frontier.
+
+        :param nids: 1D tensor of node ids to merge, excluding the root
+        :param op: reduction to combine child leaves into node, see :code:`merge()`
+
+        :return: True iff any node was merged
+        """
+        if self._lock_tree_structure:
+            raise RuntimeError("Tree locked")
+        nids = nids.to(device=self.data.device, dtype=torch.long).reshape(-1)
+        if nids.numel() == 0:
+            return False
+        with torch.no_grad():
+            parent_ids = self.parent_depth[nids, 0]
+            depths = self.parent_depth[nids, 1]
+            order = torch.argsort(depths, descending=True)
+            nids = nids[order]
+            _, counts = torch.unique_consecutive(depths[order], return_counts=True)
+            for level in torch.split(nids, counts.tolist()):
+                data = self.data.data[level]
+                reduced_vals = op(data.view(-1, self.N ** 3, self.data_dim), dim=1)
+                if isinstance(reduced_vals, tuple):
+                    reduced_vals = reduced_vals[0]
+                parent_sel = (*self._unpack_index(
+                    self.parent_depth[level, 0]).long().T,)
+                self.data.data[parent_sel] = reduced_vals
+                self.child[parent_sel] = 0
+            self.parent_depth[nids] = -1
+            self.child[nids] = -1
+            self._n_free += nids.shape[0]
+            self._release_nodes(nids)
+            self._record_delta(**self._merge_delta(nids, parent_ids[order]))
+        return True
+
     def set_depth_limit(self, depth):
         self.depth_limit = depth
+
+    def reorder(self, policy='morton'):
+        """
+        N3Tree.reorder() which also permutes the RMSprop state (basis_rms)
+        """
+        if self._lock_tree_structure:
+            raise RuntimeError("Tree locked")
+        order = self._node_order(policy)
+        if self.basis_rms is not None and self.basis_rms.shape == self.data.shape:
+            self.basis_rms = self.basis_rms[order]
+        self._apply_node_order(order)
+        return order
     
     def optim_basis_all_step(self, lr_sigma: float, lr_sh: float, beta: float = 0.9, epsilon: float = 1e-8,
                              optim: str = 'rmsprop', rate_sel=1e1, sel=None):
@@ -330,15 +495,20 @@ class DOT_N3Tree(N3Tree):
             raise NotImplementedError(f'Unsupported optimizer {optim}')
         
         data.grad.zero_()
+        self._data_ver += 1
     @classmethod
-    def load(cls, path, device='cpu', dtype=torch.float32, map_location=None):
+    def load(cls, path, device='cpu', dtype=torch.float32, map_location=None, mmap=True):
         """
-        Load from npz file
+        Load from npz file or tree file (see :code:`svox.treefile`)
 
-        :param path: npz path
+        :param path: npz or tree file path
         :param device: str device to put data
         :param dtype: str torch.float32 (default) | torch.float64
         :param map_location: str DEPRECATED old name for device
+        :param mmap: memory-map tree files; on CPU, arrays already of the
+                     right dtype are then used in place without being copied.
+                     data stored in float16 (npz, or .n3t saved with half=True)
+                     is always converted, so it is copied in full on load
 
         """
         if map_location is not None:
@@ -346,11 +516,11 @@ class DOT_N3Tree(N3Tree):
             device = map_location
         assert dtype == torch.float32 or dtype == torch.float64, 'Unsupported dtype'
         tree = cls(dtype=dtype, device=device)
-        z = np.load(path)
+        z = treefile.load_fields(path, mmap=mmap)
         tree.data_dim = int(z["data_dim"])
-        tree.child = torch.from_numpy(z["child"]).to(device)
+        tree.child = treefile.to_tensor(z["child"], device=device)
         tree.N = tree.child.shape[-1]
-        tree.parent_depth = torch.from_numpy(z["parent_depth"]).to(device)
+        tree.parent_depth = treefile.to_tensor(z["parent_depth"], device=device)
         tree._n_internal.fill_(z["n_internal"].item())
         if "invradius3" in z.files:
             tree.invradius = torch.from_numpy(z["invradius3"].astype(
@@ -360,15 +530,16 @@ class DOT_N3Tree(N3Tree):
         tree.offset = torch.from_numpy(z["offset"].astype(np.float32)).to(device)
         tree.depth_limit = int(z["depth_limit"])
         tree.geom_resize_fact = float(z["geom_resize_fact"])
-        tree.data.data = torch.from_numpy(z["data"].astype(np.float32)).to(device)
+        tree.data.data = treefile.to_tensor(z["data"], dtype=dtype, device=device)
         if 'n_free' in z.files:
             tree._n_free.fill_(z["n_free"].item())
         else:
             tree._n_free.zero_()
         tree.data_format = DataFormat(z['data_format'].item()) if \
                 'data_format' in z.files else None
-        tree.extra_data = torch.from_numpy(z['extra_data']).to(device) if \
+        tree.extra_data = treefile.to_tensor(z['extra_data'], device=device) if \
                           'extra_data' in z.files else None
+        tree._invalidate()
         return tree      
     # Leaf refinement & memory management methods
     def refine(self, repeats=1, sel=None, self_cp=True):
@@ -408,40 +579,42 @@ class DOT_N3Tree(N3Tree):
                 if num_nc == 0:
                     # Nothing to do
                     return False
-                new_filled = filled + num_nc
+                # Reuse slots freed by merge() first, append the rest
+                new_idxs, num_append = self._alloc_nodes(leaf_node[:, 0])
+                new_filled = filled + num_append
 
                 cap_needed = new_filled - self.capacity
                 if cap_needed > 0:
                     self._resize_add_cap(cap_needed)
                     resized = True
 
-                new_idxs = torch.arange(filled, filled + num_nc,
-                        device=leaf_node.device, dtype=self.child.dtype) # NNC
-
-                self.child[filled:new_filled] = 0
-                self.child[sel] = new_idxs - leaf_node[:, 0].to(torch.int32)
+                self.child[new_idxs] = 0
+                self.child[sel] = (new_idxs - leaf_node[:, 0]).to(self.child.dtype)
                 if self_cp:
-                    self.data.data[filled:new_filled] = self.data.data[
+                    self.data.data[new_idxs] = self.data.data[
                             sel][:, None, None, None]
-                self.parent_depth[filled:new_filled, 0] = self._pack_index(leaf_node)  # parent
-                self.parent_depth[filled:new_filled, 1] = self.parent_depth[
+                else:
+                    # Reused slots still hold the values of merged nodes
+                    self.data.data[new_idxs[new_idxs < filled]] = 0
+                self.parent_depth[new_idxs, 0] = self._pack_index(leaf_node).to(
+                        self.parent_depth.dtype)  # parent
+                self.parent_depth[new_idxs, 1] = self.parent_depth[
                         leaf_node[:, 0], 1] + 1  # depth
+                if self.basis_rms is not None and self.basis_rms.shape == self.data.shape:
+                    # Do not inherit optimizer state of merged nodes
+                    self.basis_rms[new_idxs] = 0
+                self._record_delta(**self._refine_delta(leaf_node, new_idxs))
 
                 if repeat_id < repeats - 1:
                     # Infer new selector
-                    t1 = torch.arange(filled, new_filled,
-                            device=self.data.device).repeat_interleave(self.N ** 3)
+                    t1 = new_idxs.repeat_interleave(self.N ** 3)
                     rangen = torch.arange(self.N, device=self.data.device)
-                    t2 = rangen.repeat_interleave(self.N ** 2).repeat(
-                            new_filled - filled)
-                    t3 = rangen.repeat_interleave(self.N).repeat(
-                            (new_filled - filled) * self.N)
-                    t4 = rangen.repeat((new_filled - filled) * self.N ** 2)
+                    t2 = rangen.repeat_interleave(self.N ** 2).repeat(num_nc)
+                    t3 = rangen.repeat_interleave(self.N).repeat(num_nc * self.N)
+                    t4 = rangen.repeat(num_nc * self.N ** 2)
                     sel = (t1, t2, t3, t4)
-                self._n_internal += num_nc
-                
-        if repeats > 0:
-            self._invalidate()
+                self._n_internal += num_append
+                self._n_free -= num_nc - num_append
         return resized
     
     # def to_grid(self):
@@ -525,6 +698,170 @@ class expon_lr():
         log_lerp = np.exp(np.log(self.lr_init) * (1 - t) + np.log(self.lr_final) * t)
         return delay_rate * log_lerp        
     
+
+class CheckpointManager():
+    """
+    Best tree snapshots for training, kept in host memory.
+
+    :code:`add` copies the tree with non-blocking device-to-host copies into pinned
+    buffers on the current CUDA stream, so the host does not wait; later kernels on
+    the stream are ordered after the copy, so training can go on updating the tree.
+    The buffers of dropped snapshots are reused by later ones (with some headroom
+    since the tree grows), instead of allocating and pinning new memory every time.
+
+    :param keep: int number of snapshots retained, the best by score
+    :param headroom: float extra fraction allocated on new buffers
+    """
+    def __init__(self, keep=1, headroom=0.25):
+        self.keep = max(int(keep), 1)
+        self.headroom = headroom
+        # [score, step, snapshot, event, buffers], best first
+        self.snapshots = []
+        self._free = []
+
+    def _alloc(self, shape, dtype, bufs):
+        numel = int(np.prod(shape))
+        fits = [k for k, buf in enumerate(self._free) if buf.dtype == dtype and buf.numel() >= numel]
+        if fits:
+            buf = self._free.pop(min(fits, key=lambda k: self._free[k].numel()))
+        else:
+            buf = torch.empty(int(numel * (1.0 + self.headroom)) + 1, dtype=dtype,
+                              pin_memory=torch.cuda.is_available())
+        bufs.append(buf)
+        return buf[:numel].view(shape)
+
+    def add(self, step, score, tree=None, snap=None):
+        """
+        Add a candidate, if it ranks within keep.
+
+        :param step: int identifies the snapshot
+        :param score: float, higher is better
+        :param tree: N3Tree to snapshot
+        :param snap: or an existing :code:`N3Tree.snapshot()`, stored as is
+
+        :return: True if retained
+        """
+        if len(self.snapshots) >= self.keep and score <= self.snapshots[-1][0]:
+            return False
+        bufs, event = [], None
+        if snap is None:
+            snap = tree.snapshot(alloc=lambda shape, dtype: self._alloc(shape, dtype, bufs),
+                                 non_blocking=True)
+            if tree.data.is_cuda:
+                event = torch.cuda.Event()
+                event.record()
+        self.snapshots.append([score, step, snap, event, bufs])
+        self.snapshots.sort(key=lambda x: -x[0])
+        while len(self.snapshots) > self.keep:
+            self._free.extend(self.snapshots.pop()[4])
+        # Bound the pool, a snapshot takes 5 or 6 buffers
+        del self._free[8:]
+        return True
+
+    @property
+    def best(self):
+        """
+        :return: (step, score) of the best snapshot, or None
+        """
+        if not self.snapshots:
+            return None
+        return self.snapshots[0][1], self.snapshots[0][0]
+
+    def tree(self, index=0, device='cpu'):
+        """
+        Materialize a snapshot, waiting for its copy if needed.
+        On CPU the tree uses the snapshot buffers, it is only valid until
+        the next :code:`add`.
+
+        :param index: int rank of the snapshot, 0 is the best
+        :param device: str device to put data
+        """
+        score, step, snap, event, bufs = self.snapshots[index]
+        if event is not None:
+            event.synchronize()
+        return DOT_N3Tree.from_snapshot(snap, device=device)
+
+    def save(self, path, compress=False):
+        """
+        Save the best snapshot (see :code:`N3Tree.save`)
+
+        :return: step of the saved snapshot
+        """
+        self.tree().save(path, compress=compress)
+        return self.snapshots[0][1]
+
+    def state(self):
+        """
+        Retained snapshots for a training checkpoint, waiting for their copies.
+        The tensors are cloned out of the pooled buffers: torch.save writes whole
+        storages, so views into buffers with headroom would bloat the file.
+
+        :return: list of (score, step, snapshot), best first
+        """
+        state = []
+        for score, step, snap, event, bufs in self.snapshots:
+            if event is not None:
+                event.synchronize()
+            snap = {k: v.clone() if torch.is_tensor(v) else v for k, v in snap.items()}
+            state.append((score, step, snap))
+        return state
+
+    def load_state(self, state):
+        """
+        Restore snapshots from :code:`state()`
+        """
+        for score, step, snap in state:
+            self.add(step, score, snap=snap)
+
+
+def save_atomic(obj, path):
+    """
+    torch.save through a temporary file in the same directory, then renamed,
+    so path always holds either the previous or the new complete file.
+    """
+    tmp = f'{path}.tmp{os.getpid()}'
+    with open(tmp, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class BackgroundSaver():
+    """
+    Runs :code:`save_atomic` on a thread, one save at a time:
+    a new save first waits for the previous one.
+    Errors are raised by the next :code:`save` or :code:`wait`.
+    """
+    def __init__(self):
+        self._thread = None
+        self._error = None
+
+    def save(self, obj, path, event=None):
+        """
+        :param event: torch.cuda.Event to wait for before writing,
+                      when obj holds tensors still being copied from the GPU
+        """
+        self.wait()
+
+        def run():
+            try:
+                if event is not None:
+                    event.synchronize()
+                save_atomic(obj, path)
+            except Exception as e:
+                self._error = e
+        self._thread = threading.Thread(target=run)
+        self._thread.start()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
   
 def vis_dif(path_1, path_2, out_path):
     m1 = DOT_N3Tree.load(path_1, map_location="cuda")
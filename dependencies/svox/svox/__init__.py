@@ -29,5 +29,6 @@ CUDA accelerated PyTorch N^3 tree library.
 from .version import __version__
 
 from .svox import N3Tree
-from .renderer import VolumeRenderer, NDCConfig, Rays
+from .renderer import VolumeRenderer, NDCConfig, Rays, SHLod
 from .helpers import N3TreeView, LocalIndex
+from .reproject import ReprojectionCache
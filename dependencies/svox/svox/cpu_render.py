@@ -0,0 +1,679 @@
+#  Copyright 2021 PlenOctree Authors.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  1. Redistributions of source code must retain the above copyright notice,
+#  this list of conditions and the following disclaimer.
+#
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#  this list of conditions and the following disclaimer in the documentation
+#  and/or other materials provided with the distribution.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+#  LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#  CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#  SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#  INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#  CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#  ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+"""
+PyTorch volume rendering engine, used by VolumeRenderer when the CUDA
+extension is not available or the tree is on CPU.
+
+It follows the CUDA kernel (rt_kernel.cu trace_ray) step by step, but marches
+all rays of a tile together: each step descends the tree for the rays still
+active, accumulates color, then drops rays which left the volume or reached
+full opacity (stop_thresh) from the compacted active set. Subtrees with no
+density above sigma_thresh are crossed in a single step.
+Optionally (shading='leaf'), SH colors are baked once per visited leaf and
+view instead of once per sample, see LeafShading. For far or downscaled
+renders, rays can stop at cells smaller than a pixel and use the subtree
+aggregates of N3Tree.mip() (mip_footprint).
+
+Tiles run on a thread pool (PyTorch releases the GIL inside its kernels).
+Images are cut into square pixel tiles; the 'steal' scheduler gives every
+worker a contiguous run of tiles and lets idle workers take tiles from the
+end of others' queues, so tiles full of dense geometry do not leave cores idle.
+"""
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+from svox.helpers import DataFormat
+from svox import sh
+
+# Serializes weight accumulation across tiles
+_accum_lock = threading.Lock()
+
+
+class RenderOptions:
+    """
+    Stand-in for the extension's RenderOptions struct when it is not built,
+    with the same fields (set by VolumeRenderer._get_options)
+    """
+    step_size = 1e-3
+    background_brightness = 1.0
+    format = DataFormat.RGBA
+    basis_dim = 1
+    min_comp = 0
+    max_comp = 0
+    density_softplus = False
+    rgb_padding = 0.0
+    ndc_width = -1
+    ndc_height = -1
+    ndc_focal = -1.0
+    sigma_thresh = 0.0
+    stop_thresh = 0.0
+
+
+def _dda_unit(cen, invdir):
+    """
+    Intersect rays with the unit cube :code:`[0,1]^3`
+
+    :param cen: :code:`(B, 3)` origins
+    :param invdir: :code:`(B, 3)` 1 / dir
+
+    :return: tmin :code:`(B)` at least 0, tmax :code:`(B)`
+    """
+    t1 = -cen * invdir
+    t2 = t1 + invdir
+    tmin = torch.clamp_min(torch.minimum(t1, t2).amax(dim=-1), 0.0)
+    tmax = torch.clamp_max(torch.maximum(t1, t2).amin(dim=-1), 1e9)
+    return tmin, tmax
+
+
+def _world2ndc(origins, dirs, opt, near=1.0):
+    # Batched maybe_world2ndc of rt_kernel.cu
+    t = -(near + origins[:, 2]) / dirs[:, 2]
+    cen = origins + t[:, None] * dirs
+    sx = -(2 * opt.ndc_focal) / opt.ndc_width
+    sy = -(2 * opt.ndc_focal) / opt.ndc_height
+    new_dirs = torch.stack([
+        sx * (dirs[:, 0] / dirs[:, 2] - cen[:, 0] / cen[:, 2]),
+        sy * (dirs[:, 1] / dirs[:, 2] - cen[:, 1] / cen[:, 2]),
+        -2 * near / cen[:, 2]], dim=-1)
+    new_origins = torch.stack([
+        sx * (cen[:, 0] / cen[:, 2]),
+        sy * (cen[:, 1] / cen[:, 2]),
+        1 + 2 * near / cen[:, 2]], dim=-1)
+    return new_origins, new_dirs / new_dirs.norm(dim=-1, keepdim=True)
+
+
+def empty_nodes(tree, opt):
+    """
+    Which nodes hold no leaf with density above opt.sigma_thresh,
+    i.e. subtrees that contribute nothing to any ray
+
+    :return: :code:`(n_internal)` bool
+    """
+    sigma = tree.data.data[..., -1]
+    child = tree.child
+    node_max = torch.full((tree.n_internal,), -float('inf'), dtype=sigma.dtype,
+                          device=sigma.device)
+    # Bottom-up: max over the cells of each node, children are done first
+    for ids in reversed(tree._live_levels()):
+        cell_max = sigma[ids]
+        skip = child[ids]
+        internal = skip != 0
+        if internal.any():
+            cell_ids = ids.view(-1, 1, 1, 1).expand_as(skip)[internal] + skip[internal]
+            cell_max[internal] = node_max[cell_ids]
+        node_max[ids] = cell_max.reshape(ids.numel(), -1).amax(dim=-1)
+    if opt.density_softplus:
+        node_max = torch.nn.functional.softplus(node_max - 1)
+    return node_max <= opt.sigma_thresh
+
+
+def _descend(child, N, pos, node_empty=None, max_cube=None):
+    """
+    Find the leaf containing each point, like query_single_from_root.
+    With node_empty, stops early at a cell whose subtree is empty.
+    With max_cube, also stops at the first cell at least as large as
+    1 / max_cube, even if it is not a leaf.
+
+    :param child: flattened tree.child
+    :param pos: :code:`(B, 3)` points in :code:`[0,1]^3`
+    :param node_empty: optional :code:`(n_internal)` bool, see empty_nodes()
+    :param max_cube: optional :code:`(B)` inverse size of the coarsest cell
+                     at which to stop
+
+    :return: packed cell index :code:`(B)`, position within the cell
+             :code:`(B, 3)` in :code:`[0,1]^3`, inverse cell size :code:`(B)`,
+             whether the cell is an empty subtree rather than a leaf :code:`(B)`,
+             and with max_cube, the child node of a coarse (internal) cell,
+             else -1 :code:`(B)`
+    """
+    B = pos.shape[0]
+    flat_out = torch.empty(B, dtype=torch.long, device=pos.device)
+    local_out = torch.empty_like(pos)
+    cube_out = torch.empty(B, dtype=pos.dtype, device=pos.device)
+    empty_out = torch.zeros(B, dtype=torch.bool, device=pos.device)
+    coarse_out = None
+    if max_cube is not None:
+        coarse_out = torch.full((B,), -1, dtype=torch.long, device=pos.device)
+    remain = torch.arange(B, device=pos.device)
+    node = torch.zeros(B, dtype=torch.long, device=pos.device)
+    pos = pos.clamp(0.0, 1.0 - 1e-6)
+    cube_sz = float(N)
+    while True:
+        pos = pos * N
+        floor = torch.floor(pos)
+        pos = pos - floor
+        xyz = floor.long()
+        flat = ((node * N + xyz[:, 0]) * N + xyz[:, 1]) * N + xyz[:, 2]
+        skip = child[flat]
+        nonterm = skip != 0
+        if node_empty is not None:
+            empty = nonterm & node_empty[node + skip]
+            if empty.any():
+                empty_out[remain[empty]] = True
+                nonterm &= ~empty
+        if max_cube is not None:
+            coarse = nonterm & (max_cube <= cube_sz)
+            if coarse.any():
+                coarse_out[remain[coarse]] = (node + skip)[coarse]
+                nonterm &= ~coarse
+        nonterm = nonterm.nonzero(as_tuple=False).reshape(-1)
+        if nonterm.numel() < remain.numel():
+            # Rays not at a leaf yet are overwritten at a later depth
+            flat_out[remain] = flat
+            local_out[remain] = pos
+            cube_out[remain] = cube_sz
+            if nonterm.numel() == 0:
+                return flat_out, local_out, cube_out, empty_out, coarse_out
+            remain = remain[nonterm]
+            pos = pos[nonterm]
+            node = node[nonterm]
+            skip = skip[nonterm]
+            if max_cube is not None:
+                max_cube = max_cube[nonterm]
+        node = node + skip
+        cube_sz *= N
+
+
+def _colors(val, basis, opt, out_dim):
+    """
+    Colors :code:`(B, out_dim)` of leaf values :code:`(B, data_dim)`
+    """
+    if opt.format == DataFormat.RGBA:
+        tmp = val[:, :out_dim]
+    else:
+        coeffs = val[:, :-1].reshape(-1, out_dim, opt.basis_dim)
+        lo, hi = opt.min_comp, opt.max_comp + 1
+        tmp = (coeffs[..., lo:hi] * basis[:, None, lo:hi]).sum(-1)
+    return torch.sigmoid(tmp) * (1 + 2 * opt.rgb_padding) - opt.rgb_padding
+
+
+def _colors_lod(data, flat, basis, degree, opt, out_dim):
+    """
+    SH colors :code:`(B, out_dim)` of cells flat :code:`(B)`, each using
+    only its first :code:`(degree + 1)^2` basis functions (the others
+    are not even read)
+    """
+    coeffs = data[:, :-1].view(-1, out_dim, opt.basis_dim)
+    tmp = basis.new_empty((flat.numel(), out_dim))
+    lo, hi = opt.min_comp, opt.max_comp + 1
+    for d in torch.unique(degree).tolist():
+        sel = (degree == d).nonzero(as_tuple=False).reshape(-1)
+        d_hi = min(hi, (d + 1) ** 2)
+        tmp[sel] = (coeffs[flat[sel], :, lo:d_hi] * basis[sel, None, lo:d_hi]).sum(-1)
+    return torch.sigmoid(tmp) * (1 + 2 * opt.rgb_padding) - opt.rgb_padding
+
+
+def _lod_degree(cube_sz, t, lod):
+    """
+    SH degree of samples in cells of inverse size cube_sz :code:`(B)` at
+    distance t :code:`(B)`: the full degree when the cell covers at least
+    lod footprint pixels, one band less for every halving below that
+    """
+    pixel_angle, footprint, min_degree, max_degree = lod
+    pixels = 1.0 / (cube_sz * t.clamp_min(1e-9) * pixel_angle)
+    degree = max_degree + torch.floor(torch.log2(pixels / footprint))
+    return degree.clamp(min_degree, max_degree).long()
+
+
+def _ndc2world(pts, opt, near=1.0):
+    # Inverse of the point mapping of _world2ndc
+    z = 2 * near / (pts[:, 2] - 1)
+    sx = -(2 * opt.ndc_focal) / opt.ndc_width
+    sy = -(2 * opt.ndc_focal) / opt.ndc_height
+    return torch.stack([pts[:, 0] * z / sx, pts[:, 1] * z / sy, z], dim=-1)
+
+
+class LeafShading:
+    """
+    Per-frame cache of SH leaf colors for render_rays(shading='leaf').
+
+    The color of a leaf is evaluated once per view, for the direction from
+    the camera center to the leaf center, and reused by every sample in the
+    leaf whose own view direction is within :code:`tol` radians of it;
+    other samples are shaded exactly. The color error of a sample is thus
+    at most :code:`(1 + 2 rgb_padding) / 4 * L * tol`, where L is the
+    Lipschitz constant (in the view direction) of the leaf's SH colors.
+
+    Tables are dense over :code:`(view, cell)`: out_dim + 4 values per
+    tree cell per view, and are filled concurrently by the tiles
+    (racing tiles write identical values).
+    """
+    def __init__(self, tree, opt, eyes, out_dim, tol, ndc=False):
+        """
+        :param eyes: :code:`(V, 3)` world space camera centers
+        :param tol: float max angle (radians) between a sample's view direction
+                    and the one its cached color was evaluated for
+        :param ndc: whether the tree space is NDC (leaf centers are mapped back)
+        """
+        self.tree = tree
+        self.opt = opt
+        self.eyes = eyes
+        self.out_dim = out_dim
+        self.ndc = ndc
+        self.cos_tol = math.cos(tol)
+        self.sh_order = int(opt.basis_dim ** 0.5) - 1
+        n_cells = tree.n_internal * tree.N ** 3
+        self.n_cells = n_cells
+        V = eyes.shape[0]
+        dtype, device = tree.data.dtype, tree.data.device
+        self.valid = torch.zeros(V * n_cells, dtype=torch.bool, device=device)
+        self.color = torch.empty((V * n_cells, out_dim), dtype=dtype, device=device)
+        self.vdir = torch.empty((V * n_cells, 3), dtype=dtype, device=device)
+
+    def _bake(self, keys, data):
+        view, flat = keys // self.n_cells, keys % self.n_cells
+        tree, N = self.tree, self.tree.N
+        node = flat // N ** 3
+        xyz = torch.stack([(flat // (N * N)) % N, (flat // N) % N, flat % N], dim=-1)
+        cell_size = torch.pow(float(N), -1.0 - tree.parent_depth[node, 1].to(data.dtype))
+        cen = tree._node_origins()[node] + (xyz + 0.5) * cell_size[:, None]
+        cen = tree.tree2world(cen)
+        if self.ndc:
+            cen = _ndc2world(cen, self.opt)
+        vdir = cen - self.eyes[view]
+        vdir = vdir / vdir.norm(dim=-1, keepdim=True).clamp_min(1e-9)
+        basis = sh.eval_sh_bases(self.sh_order, vdir)
+        self.color[keys] = _colors(data[flat], basis, self.opt, self.out_dim)
+        self.vdir[keys] = vdir
+        self.valid[keys] = True
+
+    def colors(self, data, flat, view, viewdirs, basis):
+        """
+        Colors :code:`(B, out_dim)` of samples in cells flat :code:`(B)`
+        seen from views :code:`(B)` along viewdirs :code:`(B, 3)`
+        """
+        keys = view * self.n_cells + flat
+        miss = keys[~self.valid[keys]]
+        if miss.numel() > 0:
+            self._bake(torch.unique(miss), data)
+        rgb = self.color[keys]
+        exact = ((self.vdir[keys] * viewdirs).sum(-1) < self.cos_tol).nonzero(
+                as_tuple=False).reshape(-1)
+        if exact.numel() > 0:
+            rgb[exact] = _colors(data[flat[exact]], basis[exact], self.opt, self.out_dim)
+        return rgb
+
+
+def _trace_tile(tree, origins, dirs, delta_scale, basis, tmin, tmax, opt, out_dim,
+                node_empty=None, shading=None, viewdirs=None, view=None, lod=None,
+                mip=None, t_stop=None, stop_light=0.0, depth=None):
+    """
+    March a tile of rays which hit the tree, all in tree coordinates.
+    With node_empty, a ray crosses an empty subtree in one step.
+    With shading (LeafShading), colors come from its cache, which needs
+    the world space viewdirs :code:`(B, 3)` and view ids :code:`(B)` of the rays.
+    With lod (pixel_angle, footprint, min_degree, max_degree), the SH degree
+    of each sample follows its cell's footprint (see _lod_degree).
+    With mip (tree.mip() mean values, pixel_angle * footprint), rays stop
+    descending at cells covering fewer than footprint pixels and use the
+    aggregate of the subtree below (excludes shading and lod).
+    With t_stop :code:`(B)`, a ray past its t_stop stops (like at full
+    opacity) as soon as its transmittance is at most stop_light.
+    With depth (t_first, t_term), both :code:`(B)` filled with inf, records
+    the t of the first sample with density above sigma_thresh and the t at
+    which transmittance first drops to max(stop_light, stop_thresh).
+
+    :return: :code:`(B, out_dim)`
+    """
+    N = tree.N
+    data = tree.data.view(-1, tree.data_dim)
+    child = tree.child.view(-1)
+    accum = tree._weight_accum
+    B = origins.shape[0]
+    out = torch.zeros((B, out_dim), dtype=origins.dtype, device=origins.device)
+    bg = opt.background_brightness
+
+    ids = torch.arange(B, device=origins.device)
+    invdir = 1.0 / (dirs + 1e-9)
+    t = tmin
+    light = torch.ones(B, dtype=origins.dtype, device=origins.device)
+    while ids.numel() > 0:
+        pos = origins + t[:, None] * dirs
+        max_cube = None
+        if mip is not None:
+            max_cube = 1.0 / (t.clamp_min(1e-9) * mip[1])
+        flat, local, cube_sz, empty, coarse = _descend(child, N, pos, node_empty, max_cube)
+        sub_tmin, sub_tmax = _dda_unit(local, invdir)
+        delta_t = (sub_tmax - sub_tmin) / cube_sz + opt.step_size
+
+        if shading is None and lod is None:
+            val = data[flat]
+            if coarse is not None:
+                coarse_ids = (coarse >= 0).nonzero(as_tuple=False).reshape(-1)
+                if coarse_ids.numel() > 0:
+                    val = val.index_put((coarse_ids,), mip[0][coarse[coarse_ids]])
+            sigma = val[:, -1]
+        else:
+            sigma = data[flat, -1]
+        if opt.density_softplus:
+            sigma = torch.nn.functional.softplus(sigma - 1)
+
+        keep = None
+        hit = ((sigma > opt.sigma_thresh) & ~empty).nonzero(as_tuple=False).reshape(-1)
+        if hit.numel() > 0:
+            att = torch.exp(-delta_t[hit] * delta_scale[hit] * sigma[hit])
+            light_hit = light[hit]
+            weight = light_hit * (1.0 - att)
+            if shading is not None:
+                rgb = shading.colors(data, flat[hit], view[hit], viewdirs[hit], basis[hit])
+            elif lod is not None:
+                rgb = _colors_lod(data, flat[hit], basis[hit],
+                                  _lod_degree(cube_sz[hit], t[hit], lod), opt, out_dim)
+            else:
+                rgb = _colors(val[hit], basis[hit] if basis is not None else None,
+                              opt, out_dim)
+            out = out.index_add(0, ids[hit], weight[:, None] * rgb)
+            light_hit = light_hit * att
+            light = light.index_put((hit,), light_hit)
+
+            if depth is not None:
+                t_first, t_term = depth
+                hit_ids = ids[hit]
+                new = torch.isinf(t_first[hit_ids])
+                t_first[hit_ids[new]] = t[hit[new]]
+                ended = (light_hit <= max(stop_light, opt.stop_thresh)) & \
+                        torch.isinf(t_term[hit_ids])
+                t_term[hit_ids[ended]] = (t + delta_t)[hit[ended]]
+
+            if accum is not None:
+                with _accum_lock:
+                    if tree._weight_accum_op == 'max':
+                        accum.view(-1).scatter_reduce_(0, flat[hit], weight.detach(),
+                                                       reduce='amax')
+                    else:
+                        accum.view(-1).index_add_(0, flat[hit], weight.detach())
+
+            # Full opacity: renormalize and stop, without background
+            stopped = hit[light_hit <= opt.stop_thresh]
+            if stopped.numel() > 0:
+                scale = 1.0 / (1.0 - light[stopped])
+                out = out.index_put((ids[stopped],), out[ids[stopped]] * scale[:, None])
+                keep = torch.ones(ids.numel(), dtype=torch.bool, device=ids.device)
+                keep[stopped] = False
+
+        t = t + delta_t
+        if t_stop is not None:
+            # End of the window: stop if (nearly) opaque, else march on
+            win = (t >= t_stop) & (light <= stop_light)
+            if keep is not None:
+                win &= keep
+            win = win.nonzero(as_tuple=False).reshape(-1)
+            if win.numel() > 0:
+                scale = 1.0 / (1.0 - light[win])
+                out = out.index_put((ids[win],), out[ids[win]] * scale[:, None])
+                if keep is None:
+                    keep = torch.ones(ids.numel(), dtype=torch.bool, device=ids.device)
+                keep[win] = False
+        inside = t < tmax
+        done = ~inside if keep is None else (~inside & keep)
+        done = done.nonzero(as_tuple=False).reshape(-1)
+        if done.numel() > 0:
+            out = out.index_add(0, ids[done], light[done, None].expand(-1, out_dim) * bg)
+        alive = inside if keep is None else (inside & keep)
+        if done.numel() > 0 or keep is not None:
+            alive = alive.nonzero(as_tuple=False).reshape(-1)
+            ids, origins, dirs, invdir = ids[alive], origins[alive], dirs[alive], invdir[alive]
+            delta_scale, t, tmax, light = delta_scale[alive], t[alive], tmax[alive], light[alive]
+            if basis is not None:
+                basis = basis[alive]
+            if shading is not None:
+                viewdirs, view = viewdirs[alive], view[alive]
+            if t_stop is not None:
+                t_stop = t_stop[alive]
+    return out
+
+
+def _image_tiles(hit, tile_size, image_size):
+    """
+    Split the ids of hit rays of images (view-major, then row-major) into
+    square pixel tiles of about tile_size rays, in the order of the tiles
+    """
+    H, W = image_size
+    side = max(int(tile_size ** 0.5), 1)
+    pix = hit % (H * W)
+    tiles_x = (W + side - 1) // side
+    tile_id = ((hit // (H * W)) * ((H + side - 1) // side) + (pix // W) // side) * tiles_x + \
+            (pix % W) // side
+    tile_id, order = torch.sort(tile_id, stable=True)
+    _, counts = torch.unique_consecutive(tile_id, return_counts=True)
+    return list(torch.split(hit[order], counts.tolist()))
+
+
+def _run_tiles(run, sizes, n_threads, scheduler='steal', tile_stats=None):
+    """
+    Run run(i) for each tile i, of sizes[i] rays, on n_threads threads
+
+    :param scheduler: 'steal': each worker starts on a contiguous run of tiles
+                      and, once done, takes tiles from the end of other workers'
+                      queues; 'dynamic': one shared queue in tile order;
+                      'static': contiguous runs without stealing
+    :param tile_stats: optional list, gets a dict per tile with its index,
+                       worker, number of rays, start and duration (s)
+
+    :return: list of the results in tile order
+    """
+    assert scheduler in ['steal', 'dynamic', 'static'], "Unsupported tile scheduler"
+    n_tiles = len(sizes)
+    results = [None] * n_tiles
+    t0 = time.perf_counter()
+    def run_timed(i, worker):
+        start = time.perf_counter()
+        results[i] = run(i)
+        if tile_stats is not None:
+            tile_stats.append({'tile': i, 'worker': worker, 'n_rays': sizes[i],
+                               'start': start - t0, 'time': time.perf_counter() - start})
+
+    if n_threads <= 1 or n_tiles <= 1:
+        for i in range(n_tiles):
+            run_timed(i, 0)
+        return results
+    n_threads = min(n_threads, n_tiles)
+    # The intra-op thread count is process-global and left as is: workers share
+    # it with the rest of the process, so callers wanting one core per tile
+    # worker set torch.set_num_threads themselves
+    with ThreadPoolExecutor(n_threads) as pool:
+        if scheduler == 'dynamic':
+            list(pool.map(lambda i: run_timed(i, threading.get_ident()), range(n_tiles)))
+        else:
+            _run_queues(run_timed, n_tiles, n_threads, scheduler == 'steal', pool)
+    return results
+
+
+def _run_queues(run_timed, n_tiles, n_threads, steal, pool):
+    """
+    Give each worker a contiguous run of tiles, optionally with stealing
+    """
+    bounds = [n_tiles * w // n_threads for w in range(n_threads + 1)]
+    queues = [deque(range(bounds[w], bounds[w + 1])) for w in range(n_threads)]
+    def worker(w):
+        while True:
+            try:
+                i = queues[w].popleft()
+            except IndexError:
+                i = None
+                if steal:
+                    # Victims in round-robin order, from the back of their queue
+                    for v in range(w + 1, w + n_threads):
+                        try:
+                            i = queues[v % n_threads].pop()
+                            break
+                        except IndexError:
+                            continue
+                if i is None:
+                    return
+            run_timed(i, w)
+    list(pool.map(worker, range(n_threads)))
+
+
+def render_rays(tree, origins, dirs, viewdirs, opt, ndc=False,
+                n_threads=None, tile_size=1 << 14, skip_empty=True,
+                shading='exact', shading_tol=0.02, sh_lod=None, pixel_angle=None,
+                mip_footprint=0.0, image_size=None, scheduler='steal', tile_stats=None,
+                t_window=None, stop_light=0.0, want_depth=False):
+    """
+    Volume render rays, same output as the CUDA renderer. Differentiable
+    with respect to tree.data.
+
+    :param tree: N3Tree
+    :param origins: :code:`(B, 3)` world space ray origins
+    :param dirs: :code:`(B, 3)` world space ray directions (need not be unit)
+    :param viewdirs: :code:`(B, 3)` unit view directions for the color basis
+    :param opt: RenderOptions, of the extension or of this module
+    :param ndc: whether to convert rays to NDC by opt.ndc_* first
+                (the CUDA renderer only does this for images)
+    :param n_threads: int threads working on tiles, default: torch.get_num_threads().
+                      The intra-op settings are not changed, tile workers use the
+                      process-wide torch thread pool
+    :param tile_size: int rays per tile
+    :param skip_empty: cross subtrees without density above opt.sigma_thresh
+                       in one step instead of leaf by leaf. The image matches up
+                       to step_size being added once per skipped subtree
+                       instead of once per leaf in it.
+    :param shading: 'exact' evaluates the SH colors of every sample,
+                    'leaf' bakes them once per visited leaf and camera center
+                    (see LeafShading). Not differentiable, ignored for RGBA
+    :param shading_tol: float max angle (radians) between a sample's view
+                        direction and the baked one for shading='leaf'
+    :param sh_lod: optional svox.SHLod; with sh_lod.footprint > 0 and pixel_angle,
+                   lowers the SH degree of cells covering few pixels
+                   (not in NDC, nor combined with shading='leaf')
+    :param pixel_angle: float angle (radians) covered by a pixel, i.e. 1 / focal
+    :param mip_footprint: float, if > 0 (with pixel_angle, not in NDC), rays stop
+                          descending at cells covering fewer than this many pixels
+                          and use the subtree aggregates of tree.mip().
+                          Overrides shading and sh_lod; not used while the tree
+                          accumulates weights
+    :param image_size: optional (H, W) if the rays are the pixels of images
+                       (view-major, then row-major), to use square tiles
+    :param scheduler: tile scheduler 'steal', 'dynamic' or 'static', see _run_tiles
+    :param tile_stats: optional list to append per-tile timing dicts to
+    :param t_window: optional (start, stop) :code:`(B)` each, in multiples of dirs:
+                     rays start marching at start, and stop past stop as soon as
+                     their transmittance is at most stop_light (inf: no stop).
+                     Not in NDC
+    :param stop_light: float, see t_window
+    :param want_depth: also return, in multiples of dirs, the first t with density
+                       and the t where transmittance drops to max(stop_light,
+                       opt.stop_thresh), inf where none
+
+    :return: :code:`(B, out_dim)`, and with want_depth, :code:`(B)`, :code:`(B)`
+    """
+    assert opt.format in [DataFormat.RGBA, DataFormat.SH], \
+        "Unsupported data format for CPU volume rendering"
+    assert shading in ['exact', 'leaf'], "Unsupported shading mode"
+    dtype = tree.data.dtype
+    origins = origins.to(dtype=dtype)
+    dirs = dirs.to(dtype=dtype)
+    eyes = view = None
+    if shading == 'leaf' and opt.format == DataFormat.SH:
+        assert not (torch.is_grad_enabled() and tree.data.requires_grad), \
+            "Leaf shading is not differentiable, use it under torch.no_grad()"
+        eyes, view = torch.unique(origins, dim=0, return_inverse=True)
+    if ndc and opt.ndc_width > 0:
+        origins, dirs = _world2ndc(origins, dirs, opt)
+    if opt.format == DataFormat.RGBA:
+        out_dim = tree.data_dim - 1
+    else:
+        out_dim = (tree.data_dim - 1) // opt.basis_dim
+
+    # To tree coordinates; delta_scale converts step lengths back to world
+    origins = tree.world2tree(origins)
+    dirs = dirs * tree.invradius
+    delta_scale = 1.0 / dirs.norm(dim=-1)
+    dirs = dirs * delta_scale[:, None]
+    basis = None
+    if opt.format == DataFormat.SH:
+        sh_order = int(opt.basis_dim ** 0.5) - 1
+        basis = sh.eval_sh_bases(sh_order, viewdirs.to(dtype=dtype))
+
+    tmin, tmax = _dda_unit(origins, 1.0 / (dirs + 1e-9))
+    t_stop = None
+    if t_window is not None:
+        tmin = torch.maximum(tmin, t_window[0].to(dtype=dtype) / delta_scale)
+        t_stop = t_window[1].to(dtype=dtype) / delta_scale
+    hit = ((tmax >= 0) & (tmin <= tmax)).nonzero(as_tuple=False).reshape(-1)
+    out = torch.full((origins.shape[0], out_dim), opt.background_brightness,
+                     dtype=dtype, device=origins.device)
+    t_first = t_term = None
+    if want_depth:
+        t_first = torch.full((origins.shape[0],), float('inf'), dtype=dtype,
+                             device=origins.device)
+        t_term = t_first.clone()
+    if hit.numel() == 0:
+        return (out, t_first, t_term) if want_depth else out
+
+    node_empty = empty_nodes(tree, opt) if skip_empty else None
+    mip = None
+    if mip_footprint > 0 and pixel_angle is not None and tree._weight_accum is None and \
+            not (ndc and opt.ndc_width > 0):
+        mip = (tree.mip()[0], pixel_angle * mip_footprint)
+    leaf_shading = None
+    if eyes is not None and mip is None:
+        viewdirs = viewdirs.to(dtype=dtype)
+        leaf_shading = LeafShading(tree, opt, eyes, out_dim, shading_tol,
+                                   ndc=ndc and opt.ndc_width > 0)
+    lod = None
+    if sh_lod is not None and sh_lod.footprint > 0 and pixel_angle is not None and \
+            basis is not None and mip is None and not (ndc and opt.ndc_width > 0):
+        max_degree = int(opt.basis_dim ** 0.5) - 1
+        lod = (pixel_angle, sh_lod.footprint, min(sh_lod.min_degree, max_degree), max_degree)
+    if image_size is not None:
+        tiles = _image_tiles(hit, tile_size, image_size)
+        hit = torch.cat(tiles)
+    else:
+        tiles = torch.split(hit, tile_size)
+    def run(i):
+        tile = tiles[i]
+        depth = None
+        if want_depth:
+            depth = (t_first.new_full((tile.numel(),), float('inf')),
+                     t_first.new_full((tile.numel(),), float('inf')))
+        if leaf_shading is None:
+            rgb = _trace_tile(tree, origins[tile], dirs[tile], delta_scale[tile],
+                              basis[tile] if basis is not None else None,
+                              tmin[tile], tmax[tile], opt, out_dim, node_empty,
+                              lod=lod, mip=mip,
+                              t_stop=t_stop[tile] if t_stop is not None else None,
+                              stop_light=stop_light, depth=depth)
+        else:
+            rgb = _trace_tile(tree, origins[tile], dirs[tile], delta_scale[tile],
+                              basis[tile], tmin[tile], tmax[tile], opt, out_dim, node_empty,
+                              leaf_shading, viewdirs[tile], view[tile],
+                              t_stop=t_stop[tile] if t_stop is not None else None,
+                              stop_light=stop_light, depth=depth)
+        return rgb if depth is None else (rgb, *depth)
+    if n_threads is None:
+        n_threads = torch.get_num_threads()
+    results = _run_tiles(run, [tile.numel() for tile in tiles], n_threads, scheduler,
+                         tile_stats)
+    if not want_depth:
+        return out.index_put((hit,), torch.cat(results))
+    out = out.index_put((hit,), torch.cat([res[0] for res in results]))
+    # Back to multiples of dirs
+    t_first[hit] = torch.cat([res[1] for res in results]) * delta_scale[hit]
+    t_term[hit] = torch.cat([res[2] for res in results]) * delta_scale[hit]
+    return out, t_first, t_term
@@ -88,6 +88,7 @@ class N3TreeView:
             self.tree.data.data[self.key[:-1]] = tmp
         else:
             self.tree.data.data[self.key] = value
+        self.tree._data_ver += 1
 
     def refine(self, repeats=1):
         """
@@ -25,13 +25,15 @@
 Volume rendering utilities
 """
 
+import time
 import torch
 import numpy as np
 from torch import nn, autograd
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from warnings import warn
 
-from svox.helpers import _get_c_extension, LocalIndex, DataFormat
+from svox.helpers import _get_c_extension, DataFormat
+from svox import cpu_render
 
 NDCConfig = namedtuple('NDCConfig', ["width", "height", "focal"])
 Rays = namedtuple('Rays', ["origins", "dirs", "viewdirs"])
@@ -111,10 +113,67 @@ def convert_to_ndc(origins, directions, focal, w, h, near=1.0):
     directions = torch.stack([d0, d1, d2], -1)
     return origins, directions
 
+class SHLod:
+    """
+    SH level of detail policy for VolumeRenderer (sh_lod), trading
+    view-dependent accuracy for speed on previews and distant views
+    """
+    def __init__(self, footprint=0.0, target_fps=None, min_degree=0, headroom=0.5):
+        """
+        :param footprint: float, if > 0 (CPU engine, render_persp only, no NDC),
+                          cells covering fewer than this many pixels lose one
+                          SH band per halving of their footprint
+        :param target_fps: float, if set, a global SH degree cap is lowered after
+                           each rendered frame slower than this and raised again
+                           after frames faster than :code:`headroom / target_fps`
+                           (CPU and CUDA)
+        :param min_degree: int lowest SH degree either policy goes down to
+        :param headroom: float, see target_fps
+        """
+        self.footprint = footprint
+        self.target_fps = target_fps
+        self.min_degree = min_degree
+        self.headroom = headroom
+        # Current global degree cap, None = all bands
+        self.degree = None
+
+    def update(self, frame_time, basis_dim):
+        """
+        Adjust the global degree cap given the time (s) of the last frame
+        """
+        if self.target_fps is None:
+            return
+        full = int(basis_dim ** 0.5) - 1
+        degree = full if self.degree is None else self.degree
+        if frame_time * self.target_fps > 1.0:
+            degree = max(degree - 1, min(self.min_degree, full))
+        elif frame_time * self.target_fps < self.headroom:
+            degree = min(degree + 1, full)
+        self.degree = degree
+
+
 class VolumeRenderer(nn.Module):
     """
     Volume renderer
     """
+    # CPU rendering (no CUDA): threads over tiles (None = torch.get_num_threads()),
+    # rays per tile (square pixel tiles for images), tile scheduler
+    # ('steal', 'dynamic' or 'static') and an optional list collecting
+    # per-tile timings (see cpu_render.render_rays)
+    cpu_threads = None
+    cpu_tile_size = 1 << 14
+    cpu_scheduler = 'steal'
+    cpu_tile_stats = None
+    # Cross empty subtrees in one step (see cpu_render.render_rays)
+    cpu_skip_empty = True
+    # SH shading 'exact' or baked per leaf and camera, 'leaf', within
+    # cpu_shading_tol radians of the exact view direction (inference only)
+    cpu_shading = 'exact'
+    cpu_shading_tol = 0.02
+    # Stop descending at cells covering fewer pixels than this and use the
+    # tree's mip aggregates (N3Tree.mip), 0 = always render leaves
+    cpu_mip_footprint = 0.0
+
     def __init__(self, tree,
             step_size : float=1e-3,
             background_brightness : float=1.0,
@@ -123,6 +182,7 @@ class VolumeRenderer(nn.Module):
             max_comp : int=-1,
             density_softplus : bool=False,
             rgb_padding : float=0.0,
+            sh_lod : SHLod=None,
         ):
         """
         Construct volume renderer associated with given N^3 tree.
@@ -163,6 +223,11 @@ class VolumeRenderer(nn.Module):
                         Please note the padding will NOT be compatible with volrend,
                         although most likely the effect is very small.
                         0.001 is a reasonable value to try.
+        :param sh_lod: SHLod, optional SH level of detail policy,
+                       lowering the SH degree by footprint or to meet a frame rate.
+                       Only used for SH data formats. To drop SH bands from the
+                       tree itself (memory and shading cost), use
+                       :code:`tree.shrink('SH#')`.
 
         """
         super().__init__()
@@ -174,6 +239,7 @@ class VolumeRenderer(nn.Module):
         self.max_comp = max_comp
         self.density_softplus = density_softplus
         self.rgb_padding = rgb_padding
+        self.sh_lod = sh_lod
         if isinstance(tree.data_format, DataFormat):
             self._data_format = None
         else:
@@ -193,7 +259,7 @@ class VolumeRenderer(nn.Module):
         :param rays: namedtuple :code:`svox.Rays` of origins
                      :code:`(B, 3)`, dirs :code:`(B, 3):, viewdirs :code:`(B, 3)`
         :param cuda: whether to use CUDA kernel if available. If false,
-                     uses only PyTorch version. *Only True supported right now*
+                     uses the PyTorch engine (svox.cpu_render).
         :param fast: if True, enables faster evaluation, potentially leading
                      to some loss of accuracy.
 
@@ -203,83 +269,8 @@ class VolumeRenderer(nn.Module):
                 or :code:`(tree.data_dim - 1) / tree.data_format.basis_dim` else.
         """
         if not cuda or _C is None or not self.tree.data.is_cuda:
-            assert self.data_format.format in [DataFormat.RGBA, DataFormat.SH], \
-                 "Unsupported data format for slow volume rendering"
-            warn("Using slow volume rendering, should only be used for debugging")
-            def dda_unit(cen, invdir):
-                """
-                voxel aabb ray tracing step
-                :param cen: jnp.ndarray [B, 3] center
-                :param invdir: jnp.ndarray [B, 3] 1/dir
-                :return: tmin jnp.ndarray [B] at least 0;
-                         tmax jnp.ndarray [B]
-                """
-                B = invdir.shape[0]
-                tmin = torch.zeros((B,), dtype=cen.dtype, device=cen.device)
-                tmax = torch.full((B,), fill_value=1e9, dtype=cen.dtype, device=cen.device)
-                for i in range(3):
-                    t1 = -cen[..., i] * invdir[..., i]
-                    t2 = t1 + invdir[..., i]
-                    tmin = torch.max(tmin, torch.min(t1, t2))
-                    tmax = torch.min(tmax, torch.max(t1, t2))
-                return tmin, tmax
-
-            origins, dirs, viewdirs = rays.origins, rays.dirs, rays.viewdirs
-            origins = self.tree.world2tree(origins)
-            B = dirs.size(0)
-            assert viewdirs.size(0) == B and origins.size(0) == B
-            dirs /= torch.norm(dirs, dim=-1, keepdim=True)
-
-            sh_mult = None
-            if self.data_format.format == DataFormat.SH:
-                from svox import sh
-                sh_order = int(self.data_format.basis_dim ** 0.5) - 1
-                sh_mult = sh.eval_sh_bases(sh_order, viewdirs)[:, None]
-
-            invdirs = 1.0 / (dirs + 1e-9)
-            t, tmax = dda_unit(origins, invdirs)
-            light_intensity = torch.ones(B, device=origins.device)
-            out_rgb = torch.zeros((B, 3), device=origins.device)
-
-            good_indices = torch.arange(B, device=origins.device)
-            delta_scale = (dirs / self.tree.invradius[None]).norm(dim=1)
-            while good_indices.numel() > 0:
-                pos = origins + t[:, None] * dirs
-                treeview = self.tree[LocalIndex(pos)]
-                rgba = treeview.values
-                cube_sz = treeview.lengths_local
-                pos_t = (pos - treeview.corners_local) / cube_sz[:, None]
-                treeview = None
-
-                subcube_tmin, subcube_tmax = dda_unit(pos_t, invdirs)
-
-                delta_t = (subcube_tmax - subcube_tmin) * cube_sz + self.step_size
-                att = torch.exp(- delta_t * torch.relu(rgba[..., -1]) * delta_scale[good_indices])
-                weight = light_intensity[good_indices] * (1.0 - att)
-                rgb = rgba[:, :-1]
-                if self.data_format.format != DataFormat.RGBA:
-                    # [B', 3, n_sh_coeffs]
-                    rgb_sh = rgb.reshape(-1, 3, self.data_format.basis_dim)
-                    rgb = torch.sigmoid(torch.sum(sh_mult * rgb_sh, dim=-1))   # [B', 3]
-                else:
-                    rgb = torch.sigmoid(rgb)
-                rgb = weight[:, None] * rgb[:, :3]
-
-                out_rgb[good_indices] += rgb
-                light_intensity[good_indices] *= att
-                t += delta_t
-
-                mask = t < tmax
-                good_indices = good_indices[mask]
-                origins = origins[mask]
-                dirs = dirs[mask]
-                invdirs = invdirs[mask]
-                t = t[mask]
-                if sh_mult is not None:
-                    sh_mult = sh_mult[mask]
-                tmax = tmax[mask]
-            out_rgb += light_intensity * self.background_brightness
-            return out_rgb
+            return cpu_render.render_rays(self.tree, rays.origins, rays.dirs, rays.viewdirs,
+                                          self._get_options(fast), **self._cpu_options())
         return _VolumeRenderFunction.apply(
             self.tree.data,
             self.tree._spec(),
@@ -298,7 +289,7 @@ class VolumeRenderer(nn.Module):
         :param fx: float output image focal length (x)
         :param fy: float output image focal length (y), if not specified uses fx
         :param cuda: whether to use CUDA kernel if available. If false,
-                     uses only PyTorch version. *Only True supported right now*
+                     uses the PyTorch engine (svox.cpu_render).
         :param fast: if True, enables faster evaluation, potentially leading
                      to some loss of accuracy.
 
@@ -308,18 +299,182 @@ class VolumeRenderer(nn.Module):
                 or :code:`(tree.data_dim - 1) / tree.data_format.basis_dim` else.
 
         """
+        start = time.perf_counter()
         if not cuda or _C is None or not self.tree.data.is_cuda:
-            return self(VolumeRenderer.persp_rays(c2w, width, height, fx, fy),
-                        cuda=False, fast=fast)
+            rays = VolumeRenderer.persp_rays(c2w, width, height, fx, fy)
+            im = cpu_render.render_rays(self.tree, rays.origins, rays.dirs, rays.viewdirs,
+                                        self._get_options(fast), ndc=True,
+                                        **self._cpu_options(height, width, fx, fy)
+                                        ).reshape(height, width, -1)
+        else:
+            if fy is None:
+                fy = fx
+            im = _VolumeRenderImageFunction.apply(
+                self.tree.data,
+                self.tree._spec(),
+                _make_camera_spec(c2w.to(dtype=self.tree.data.dtype),
+                                  width, height, fx, fy),
+                self._get_options(fast)
+            )
+        self._update_lod(start)
+        return im
+
+    def render_persp_batch(self, c2ws, width=800, height=800, fx=1111.111, fy=None,
+            cuda=True, fast=False):
+        """
+        Render perspective images from several cameras sharing the same
+        intrinsics. Differentiable.
+        Equivalent to stacking :code:`render_persp` over the cameras, but the
+        tree spec and render options are built once, and on the CPU engine
+        the rays of all views are traced as a single batch, so the tile
+        pool is shared across views.
+
+        :param c2ws: torch.Tensor (K, 3, 4) or (K, 4, 4) camera pose matrices
+                     (or a sequence of K (3, 4)/(4, 4) matrices)
+        :param width: int output image width
+        :param height: int output image height
+        :param fx: float output image focal length (x)
+        :param fy: float output image focal length (y), if not specified uses fx
+        :param cuda: whether to use CUDA kernel if available. If false,
+                     uses the PyTorch engine (svox.cpu_render).
+        :param fast: if True, enables faster evaluation, potentially leading
+                     to some loss of accuracy.
+
+        :return: :code:`(K, height, width, rgb_dim)`
+
+        """
+        start = time.perf_counter()
+        if not torch.is_tensor(c2ws):
+            c2ws = torch.stack(list(c2ws))
         if fy is None:
             fy = fx
-        return _VolumeRenderImageFunction.apply(
-            self.tree.data,
-            self.tree._spec(),
-            _make_camera_spec(c2w.to(dtype=self.tree.data.dtype),
-                              width, height, fx, fy),
-            self._get_options(fast)
-        )
+        opt = self._get_options(fast)
+        if not cuda or _C is None or not self.tree.data.is_cuda:
+            rays = VolumeRenderer.persp_rays_batch(c2ws, width, height, fx, fy)
+            ims = cpu_render.render_rays(self.tree, rays.origins, rays.dirs, rays.viewdirs,
+                                         opt, ndc=True,
+                                         **self._cpu_options(height, width, fx, fy)
+                                         ).reshape(c2ws.shape[0], height, width, -1)
+        else:
+            tree_spec = self.tree._spec()
+            c2ws = c2ws.to(dtype=self.tree.data.dtype)
+            ims = torch.stack([_VolumeRenderImageFunction.apply(
+                self.tree.data,
+                tree_spec,
+                _make_camera_spec(c2w, width, height, fx, fy),
+                opt) for c2w in c2ws])
+        self._update_lod(start, ims.shape[0])
+        return ims
+
+    def render_persp_progressive(self, c2w, width=800, height=800, fx=1111.111, fy=None,
+            cuda=True, fast=False, start_stride=8, threshold=0.03, time_budget=None):
+        """
+        Progressively render a perspective image, for interactive previews.
+        A generator: first renders one pixel in every start_stride x start_stride
+        block, then halves the stride until 1, each time only refining blocks
+        whose color differs from a neighboring block by more than threshold
+        (other blocks keep their color). Yields the full-size image,
+        upsampled by nearest neighbor, after each level.
+        Not differentiable.
+
+        Usage:
+        .. code-block:: python
+
+            for im in r.render_persp_progressive(c2w, time_budget=0.5):
+                show(im)
+
+        :param c2w: torch.Tensor (3, 4) or (4, 4) camera pose matrix (c2w)
+        :param width: int output image width
+        :param height: int output image height
+        :param fx: float output image focal length (x)
+        :param fy: float output image focal length (y), if not specified uses fx
+        :param cuda: whether to use CUDA kernel if available. If false,
+                     uses the PyTorch engine (svox.cpu_render).
+        :param fast: if True, enables faster evaluation, potentially leading
+                     to some loss of accuracy.
+        :param start_stride: int power of 2, pixel stride of the first image
+        :param threshold: float max abs color difference between neighboring
+                          blocks below which a block is not refined;
+                          negative to refine everything (the last image is then
+                          the same as render_persp)
+        :param time_budget: float seconds, optional: stop after the first image
+                            yielded past this time (the caller may also just stop
+                            iterating)
+
+        :return: generator of :code:`(height, width, rgb_dim)`
+        """
+        start = time.perf_counter()
+        if fy is None:
+            fy = fx
+        device = c2w.device
+        rays = VolumeRenderer.persp_rays(c2w, width, height, fx, fy)
+        stride = start_stride
+        # no_grad only around the renders: the caller runs between yields
+        rows = torch.arange(0, height, stride, device=device)
+        cols = torch.arange(0, width, stride, device=device)
+        with torch.no_grad():
+            grid = self._render_pixels(
+                rays, (rows[:, None] * width + cols[None, :]).reshape(-1), cuda, fast
+            ).view(rows.numel(), cols.numel(), -1)
+        exact = torch.ones(grid.shape[:2], dtype=torch.bool, device=device)
+        while True:
+            yield grid.repeat_interleave(stride, 0).repeat_interleave(
+                    stride, 1)[:height, :width]
+            if stride == 1 or (time_budget is not None and
+                               time.perf_counter() - start > time_budget):
+                return
+            refine = VolumeRenderer._block_edges(grid) > threshold
+            stride //= 2
+            gh, gw = (height + stride - 1) // stride, (width + stride - 1) // stride
+            grid = grid.repeat_interleave(2, 0).repeat_interleave(2, 1)[:gh, :gw]
+            refine = refine.repeat_interleave(2, 0).repeat_interleave(2, 1)[:gh, :gw]
+            exact = exact.repeat_interleave(2, 0).repeat_interleave(2, 1)[:gh, :gw]
+            # Block corners were rendered at the previous level, if at all
+            corner = torch.zeros_like(exact)
+            corner[::2, ::2] = exact[::2, ::2]
+            exact = corner
+            todo = (refine & ~exact).nonzero(as_tuple=False)
+            if todo.numel() > 0:
+                pix = todo[:, 0] * stride * width + todo[:, 1] * stride
+                with torch.no_grad():
+                    grid[todo[:, 0], todo[:, 1]] = self._render_pixels(
+                            rays, pix, cuda, fast).to(dtype=grid.dtype)
+                exact[todo[:, 0], todo[:, 1]] = True
+
+    @staticmethod
+    def _block_edges(grid):
+        """
+        Max abs color difference of each block of grid :code:`(H, W, C)`
+        to its 4 neighbors
+
+        :return: :code:`(H, W)`
+        """
+        edges = torch.zeros(grid.shape[:2], dtype=grid.dtype, device=grid.device)
+        diff = (grid[1:] - grid[:-1]).abs().amax(dim=-1)
+        edges[1:] = torch.maximum(edges[1:], diff)
+        edges[:-1] = torch.maximum(edges[:-1], diff)
+        diff = (grid[:, 1:] - grid[:, :-1]).abs().amax(dim=-1)
+        edges[:, 1:] = torch.maximum(edges[:, 1:], diff)
+        edges[:, :-1] = torch.maximum(edges[:, :-1], diff)
+        return edges
+
+    def _render_pixels(self, rays, pix, cuda=True, fast=False):
+        """
+        Render the subset pix of image rays from persp_rays, with the same
+        NDC handling as render_persp
+
+        :return: :code:`(pix.numel(), rgb_dim)`
+        """
+        origins, dirs, viewdirs = rays.origins[pix], rays.dirs[pix], rays.viewdirs[pix]
+        if not cuda or _C is None or not self.tree.data.is_cuda:
+            return cpu_render.render_rays(self.tree, origins, dirs, viewdirs,
+                                          self._get_options(fast), ndc=True,
+                                          **self._cpu_options())
+        if self.ndc_config is not None:
+            origins, dirs = convert_to_ndc(origins, dirs, self.ndc_config.focal,
+                                           self.ndc_config.width, self.ndc_config.height)
+        return self.forward(Rays(origins=origins, dirs=dirs, viewdirs=viewdirs),
+                            cuda=cuda, fast=fast)
 
     def se_grad(self, rays : Rays, colors):
         """
@@ -385,29 +540,97 @@ class VolumeRenderer(nn.Module):
             colors)
 
     @staticmethod
-    def persp_rays(c2w, width=800, height=800, fx=1111.111, fy=None):
+    def persp_rays(c2w, width=800, height=800, fx=1111.111, fy=None, out=None):
         """
         Generate perspective camera rays in row major order, then
         usable for renderer's forward method.
         *NDC is not supported currently.*
+        The camera-space unit directions are cached per intrinsics
+        (see :code:`camera_dirs`), so each call is a single 3x3 rotation.
 
         :param c2w: torch.Tensor (3, 4) or (4, 4) camera pose matrix (c2w)
         :param width: int output image width
         :param height: int output image height
         :param fx: float output image focal length (x)
         :param fy: float output image focal length (y), if not specified uses fx
+        :param out: optional preallocated svox.Rays to write into,
+                    e.g. from :code:`empty_persp_rays`; avoids per-frame
+                    allocation in render loops
 
         :return: rays namedtuple svox.Rays of origins
                      :code:`(H*W, 3)`, dirs :code:`(H*W, 3):, viewdirs :code:`(H*W, 3)`,
                      where H = W.
 
+        """
+        cam_dirs = VolumeRenderer.camera_dirs(width, height, fx, fy,
+                                              device=c2w.device)
+        dirs = torch.matmul(cam_dirs, c2w[:3, :3].double().T)
+        if out is None:
+            origins = c2w[None, :3, 3].expand(height * width, -1).contiguous()
+            dirs = dirs.float()
+            return Rays(
+                origins=origins,
+                dirs=dirs,
+                viewdirs=dirs
+            )
+        out.origins.copy_(c2w[None, :3, 3].expand(height * width, -1))
+        out.dirs.copy_(dirs)
+        if out.viewdirs is not out.dirs:
+            out.viewdirs.copy_(out.dirs)
+        return out
+
+    @staticmethod
+    def empty_persp_rays(width=800, height=800, device='cpu', dtype=torch.float32):
+        """
+        Allocate a svox.Rays buffer for :code:`persp_rays(..., out=)`.
+        viewdirs aliases dirs, as in :code:`persp_rays`.
+
+        :param width: int output image width
+        :param height: int output image height
+        :param device: torch device of the buffer
+        :param dtype: torch dtype of the buffer (dirs are always float32
+                      in :code:`persp_rays`, origins follow c2w)
+
+        :return: rays namedtuple svox.Rays of uninitialized
+                     :code:`(H*W, 3)` tensors
+        """
+        origins = torch.empty(height * width, 3, device=device, dtype=dtype)
+        dirs = torch.empty(height * width, 3, device=device, dtype=dtype)
+        return Rays(origins=origins, dirs=dirs, viewdirs=dirs)
+
+    _camera_dirs_cache = OrderedDict()
+    camera_dirs_cache_size = 8
+
+    @staticmethod
+    def camera_dirs(width=800, height=800, fx=1111.111, fy=None,
+                    device='cpu'):
+        """
+        Camera-space unit ray directions :code:`(x, -y, -1) / norm` in row
+        major order, float64, computed once per
+        :code:`(width, height, fx, fy, device)` and cached (LRU of
+        :code:`VolumeRenderer.camera_dirs_cache_size` entries).
+        The returned tensor is shared, do not modify it in place.
+
+        :param width: int output image width
+        :param height: int output image height
+        :param fx: float output image focal length (x)
+        :param fy: float output image focal length (y), if not specified uses fx
+        :param device: torch device
+
+        :return: :code:`(H*W, 3)` float64
         """
         if fy is None:
             fy = fx
-        origins = c2w[None, :3, 3].expand(height * width, -1).contiguous()
+        device = torch.device(device)
+        key = (int(width), int(height), float(fx), float(fy), device)
+        cache = VolumeRenderer._camera_dirs_cache
+        dirs = cache.get(key)
+        if dirs is not None:
+            cache.move_to_end(key)
+            return dirs
         yy, xx = torch.meshgrid(
-            torch.arange(height, dtype=torch.float64, device=c2w.device),
-            torch.arange(width, dtype=torch.float64, device=c2w.device),
+            torch.arange(height, dtype=torch.float64, device=device),
+            torch.arange(width, dtype=torch.float64, device=device),
         )
         xx = (xx - width * 0.5) / float(fx)
         yy = (yy - height * 0.5) / float(fy)
@@ -416,15 +639,72 @@ class VolumeRenderer(nn.Module):
         dirs /= torch.norm(dirs, dim=-1, keepdim=True)
         dirs = dirs.reshape(-1, 3)
         del xx, yy, zz
-        dirs = torch.matmul(c2w[None, :3, :3].double(), dirs[..., None])[..., 0].float()
-        vdirs = dirs
+        cache[key] = dirs
+        while len(cache) > VolumeRenderer.camera_dirs_cache_size:
+            cache.popitem(last=False)
+        return dirs
+
+    @staticmethod
+    def persp_rays_batch(c2ws, width=800, height=800, fx=1111.111, fy=None):
+        """
+        Generate perspective camera rays for K cameras sharing the same
+        intrinsics, view-major then row major. The cached camera-space
+        directions are rotated by every pose.
+
+        :param c2ws: torch.Tensor (K, 3, 4) or (K, 4, 4) camera pose matrices
+        :param width: int output image width
+        :param height: int output image height
+        :param fx: float output image focal length (x)
+        :param fy: float output image focal length (y), if not specified uses fx
+
+        :return: rays namedtuple svox.Rays of origins
+                     :code:`(K*H*W, 3)`, dirs :code:`(K*H*W, 3):, viewdirs :code:`(K*H*W, 3)`
+
+        """
+        cam_dirs = VolumeRenderer.camera_dirs(width, height, fx, fy,
+                                              device=c2ws.device)
+        K = c2ws.shape[0]
+        origins = c2ws[:, None, :3, 3].expand(-1, height * width, -1).reshape(-1, 3)
+        dirs = torch.matmul(cam_dirs, c2ws[:, :3, :3].double().transpose(1, 2)).float()
+        dirs = dirs.reshape(K * height * width, 3)
 
         return Rays(
             origins=origins,
             dirs=dirs,
-            viewdirs=vdirs
+            viewdirs=dirs
         )
 
+    def _cpu_options(self, height=None, width=None, fx=None, fy=None):
+        """
+        Keyword arguments of cpu_render.render_rays from the cpu_* settings,
+        plus the image size and pixel angle when rendering an image
+        """
+        kwargs = dict(n_threads=self.cpu_threads,
+                      tile_size=self.cpu_tile_size,
+                      skip_empty=self.cpu_skip_empty,
+                      shading=self.cpu_shading,
+                      shading_tol=self.cpu_shading_tol,
+                      scheduler=self.cpu_scheduler,
+                      tile_stats=self.cpu_tile_stats)
+        if height is not None:
+            kwargs.update(sh_lod=self.sh_lod,
+                          pixel_angle=1.0 / max(fx, fy or fx),
+                          mip_footprint=self.cpu_mip_footprint,
+                          image_size=(height, width))
+        return kwargs
+
+    def _update_lod(self, start, n_frames=1):
+        """
+        Feed the time per frame since start to the SH LOD policy, if it has a target
+        """
+        if self.sh_lod is None or self.sh_lod.target_fps is None or \
+                self.data_format.format != DataFormat.SH:
+            return
+        if self.tree.data.is_cuda:
+            torch.cuda.synchronize()
+        self.sh_lod.update((time.perf_counter() - start) / max(n_frames, 1),
+                           self.data_format.basis_dim)
+
     @property
     def data_format(self):
         return self._data_format or self.tree.data_format
@@ -432,8 +712,9 @@ class VolumeRenderer(nn.Module):
     def _get_options(self, fast=False):
         """
         Make RenderOptions struct to send to C++
+        (or to the CPU engine if the extension is not built)
         """
-        opts = _C.RenderOptions()
+        opts = _C.RenderOptions() if _C is not None else cpu_render.RenderOptions()
         opts.step_size = self.step_size
         opts.background_brightness = self.background_brightness
 
@@ -444,6 +725,9 @@ class VolumeRenderer(nn.Module):
 
         if self.max_comp < 0:
             opts.max_comp += opts.basis_dim
+        if self.sh_lod is not None and self.sh_lod.degree is not None and \
+                opts.format == DataFormat.SH:
+            opts.max_comp = min(opts.max_comp, (self.sh_lod.degree + 1) ** 2 - 1)
 
         opts.density_softplus = self.density_softplus
         opts.rgb_padding = self.rgb_padding
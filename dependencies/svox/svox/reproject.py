@@ -0,0 +1,178 @@
+#  Copyright 2021 PlenOctree Authors.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  1. Redistributions of source code must retain the above copyright notice,
+#  this list of conditions and the following disclaimer.
+#
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#  this list of conditions and the following disclaimer in the documentation
+#  and/or other materials provided with the distribution.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+#  LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#  CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#  SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#  INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#  CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#  ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+"""
+Temporal reuse for rendering camera paths (videos, orbits) with the
+PyTorch engine: each frame seeds the ray windows of the next
+"""
+import torch
+import torch.nn.functional as F
+
+from svox import cpu_render
+from svox.renderer import VolumeRenderer
+
+
+class ReprojectionCache:
+    """
+    Renders consecutive perspective frames of a camera path, reusing the
+    previous frame's depths.
+    After each frame, the points where rays first met density and where
+    they became (nearly) opaque are kept. For the next frame, they are
+    splatted into the new view: each pixel whose 3x3 neighborhood is fully
+    covered starts marching at the nearest warped first hit (minus margin)
+    and may stop past the farthest warped termination (plus margin) once its
+    transmittance is at most stop_light. Other pixels (disocclusions, image
+    borders, rays which missed everything) are marched in full, as is every
+    refresh_every-th frame.
+
+    Geometry entering the view in front of what the previous frame saw is
+    only caught on refresh frames, so keep refresh_every small for paths
+    with occluders moving in from the borders.
+    Uses the CPU engine and the renderer's cpu_* settings; not in NDC
+    (the cache is then bypassed).
+
+    Usage:
+    .. code-block:: python
+
+        cache = svox.ReprojectionCache()
+        frames = [cache.render(r, c2w, width=W, height=H, fx=focal) for c2w in path]
+    """
+    def __init__(self, margin=0.02, stop_light=1e-3, refresh_every=8):
+        """
+        :param margin: float relative depth margin added before the warped
+                       start and after the warped stop
+        :param stop_light: float transmittance below which rays past their
+                           warped stop end (the color is renormalized as
+                           for stop_thresh)
+        :param refresh_every: int, every refresh_every-th frame is fully marched
+        """
+        self.margin = margin
+        self.stop_light = stop_light
+        self.refresh_every = refresh_every
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the previous frame, e.g. on a camera cut
+        """
+        self._prev = None
+        self._n_frames = 0
+        # Fraction of the pixels of the last frame which used a window
+        self.valid_fraction = 0.0
+
+    def render(self, renderer, c2w, width=800, height=800, fx=1111.111, fy=None,
+               fast=False):
+        """
+        Render the next frame of the path, like renderer.render_persp(cuda=False)
+
+        :param renderer: VolumeRenderer
+        :param c2w: torch.Tensor (3, 4) or (4, 4) camera pose matrix (c2w)
+        :param width: int output image width
+        :param height: int output image height
+        :param fx: float output image focal length (x)
+        :param fy: float output image focal length (y), if not specified uses fx
+        :param fast: if True, enables faster evaluation, potentially leading
+                     to some loss of accuracy.
+
+        :return: :code:`(height, width, rgb_dim)`
+        """
+        if fy is None:
+            fy = fx
+        self._n_frames += 1
+        if renderer.ndc_config is not None:
+            return renderer.render_persp(c2w, width, height, fx, fy, cuda=False, fast=fast)
+        rays = VolumeRenderer.persp_rays(c2w, width, height, fx, fy)
+        key = (width, height, fx, fy)
+        window = None
+        self.valid_fraction = 0.0
+        if self._prev is not None and self._prev[0] == key and \
+                (self._n_frames - 1) % self.refresh_every != 0:
+            window = self._warp(c2w, width, height, fx, fy)
+        rgb, t_first, t_term = cpu_render.render_rays(
+                renderer.tree, rays.origins, rays.dirs, rays.viewdirs,
+                renderer._get_options(fast), t_window=window,
+                stop_light=self.stop_light, want_depth=True,
+                **renderer._cpu_options(height, width, fx, fy))
+        self._store(key, rays, t_first, t_term)
+        return rgb.reshape(height, width, -1)
+
+    def _store(self, key, rays, t_first, t_term):
+        origins = rays.origins.to(dtype=t_first.dtype)
+        dirs = rays.dirs.to(dtype=t_first.dtype)
+        first = torch.isfinite(t_first)
+        term = torch.isfinite(t_term)
+        self._prev = (key,
+                      origins[first] + t_first[first, None] * dirs[first],
+                      origins[term] + t_term[term, None] * dirs[term])
+
+    @staticmethod
+    def _splat(pts, c2w, width, height, fx, fy, reduce):
+        """
+        Distances from the camera center of points, splatted to the 4
+        nearest pixels with reduce ('amin' or 'amax');
+        inf (amin) or -inf (amax) where nothing lands
+
+        :return: :code:`(height, width)`
+        """
+        fill = float('inf') if reduce == 'amin' else -float('inf')
+        out = torch.full((height * width,), fill, dtype=pts.dtype, device=pts.device)
+        eye = c2w[:3, 3].to(dtype=pts.dtype)
+        rel = pts - eye
+        cam = rel @ c2w[:3, :3].to(dtype=pts.dtype)
+        z = -cam[:, 2]
+        front = z > 1e-6
+        rel, cam, z = rel[front], cam[front], z[front]
+        col = cam[:, 0] / z * fx + width * 0.5
+        row = -cam[:, 1] / z * fy + height * 0.5
+        dist = rel.norm(dim=-1)
+        col0, row0 = torch.floor(col).long(), torch.floor(row).long()
+        for dr in (0, 1):
+            for dc in (0, 1):
+                r, c = row0 + dr, col0 + dc
+                inside = ((r >= 0) & (r < height) & (c >= 0) & (c < width)).nonzero(
+                        as_tuple=False).reshape(-1)
+                out.scatter_reduce_(0, r[inside] * width + c[inside], dist[inside],
+                                    reduce=reduce)
+        return out.view(height, width)
+
+    def _warp(self, c2w, width, height, fx, fy):
+        """
+        Ray windows :code:`(H*W)` start, stop of the new view from the previous frame
+        """
+        _, pts_first, pts_term = self._prev
+        start = self._splat(pts_first, c2w, width, height, fx, fy, 'amin')[None, None]
+        stop = self._splat(pts_term, c2w, width, height, fx, fy, 'amax')[None, None]
+        # Start at the nearest first hit around, if there is no hole around
+        start_max = F.max_pool2d(start, 3, stride=1, padding=1)
+        start = -F.max_pool2d(-start, 3, stride=1, padding=1)
+        valid = torch.isfinite(start_max)[0, 0]
+        valid[0], valid[-1], valid[:, 0], valid[:, -1] = False, False, False, False
+        # Stop past the farthest termination around, if all pixels around terminated
+        stop_min = -F.max_pool2d(-stop, 3, stride=1, padding=1)
+        stop = F.max_pool2d(stop, 3, stride=1, padding=1)
+        stop = torch.where(torch.isfinite(stop_min), stop * (1.0 + self.margin),
+                           torch.full_like(stop, float('inf')))[0, 0]
+        start = (start[0, 0] * (1.0 - self.margin)).clamp_min(0.0)
+        self.valid_fraction = valid.float().mean().item()
+        start = torch.where(valid, start, torch.zeros_like(start))
+        stop = torch.where(valid, stop, torch.full_like(stop, float('inf')))
+        return start.reshape(-1), stop.reshape(-1)
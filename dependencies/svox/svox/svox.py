@@ -31,6 +31,7 @@ import numpy as np
 import math
 from torch import nn, autograd
 from svox.helpers import N3TreeView, DataFormat, LocalIndex, _get_c_extension
+from svox import treefile
 from warnings import warn
 
 _C = _get_c_extension()
@@ -67,8 +68,13 @@ class N3Tree(nn.Module):
         or :code:`expand(), shrink()` is used,
         please re-make any optimizers
     """
+    # PyTorch point query (no CUDA): points per chunk, threads over chunks
+    cpu_query_chunk = 1 << 20
+    cpu_query_threads = 0
+
     def __init__(self, N=2, data_dim=None, depth_limit=10,
             init_reserve=1, init_refine=0, geom_resize_fact=1.0,
+            max_resize_step=0, resize_chunk=0,
             radius=0.5, center=[0.5, 0.5, 0.5],
             data_format="RGBA",
             extra_data=None,
@@ -91,6 +97,9 @@ class N3Tree(nn.Module):
                             inital resolution will be :code:`[N^(init_refine + 1)]^3`.
                             initial max_depth will be init_refine.
         :param geom_resize_fact: float geometric resizing factor
+        :param max_resize_step: int max number of nodes added by one resize on top of the
+                                nodes actually needed (0 = no limit)
+        :param resize_chunk: int if > 0, the capacity grows in multiples of this many nodes
         :param radius: float or list, 1/2 side length of cube (possibly in each dim)
         :param center: list center of space
         :param data_format: a string to indicate the data format. :code:`RGBA | SH# | SG# | ASG#`
@@ -139,6 +148,8 @@ class N3Tree(nn.Module):
 
         self.depth_limit = depth_limit
         self.geom_resize_fact = geom_resize_fact
+        self.max_resize_step = max_resize_step
+        self.resize_chunk = resize_chunk
 
         if extra_data is not None:
             assert isinstance(extra_data, torch.Tensor)
@@ -147,7 +158,11 @@ class N3Tree(nn.Module):
             self.extra_data = None
 
         self._ver = 0
+        self._data_ver = 0
+        self._last_mip = None
         self._invalidate()
+        self._n_reused_total = 0
+        self._n_appended_total = 0
         self._lock_tree_structure = False
         self._weight_accum = None
         self._weight_accum_op = None
@@ -173,37 +188,12 @@ class N3Tree(nn.Module):
         values = values.to(device=self.data.device)
 
         if not cuda or _C is None or not self.data.is_cuda:
-            warn("Using slow assignment")
             indices = self.world2tree(indices)
-
-            n_queries, _ = indices.shape
-            indices.clamp_(0.0, 1.0 - 1e-10)
-            ind = indices.clone()
-
-            node_ids = torch.zeros(n_queries, dtype=torch.long, device=indices.device)
-            remain_mask = torch.ones(n_queries, dtype=torch.bool, device=indices.device)
-            while remain_mask.any():
-                ind_floor = torch.floor(ind[remain_mask] * self.N)
-                ind_floor.clamp_max_(self.N - 1)
-                sel = (node_ids[remain_mask], *(ind_floor.long().T),)
-
-                deltas = self.child[sel]
-                vals = self.data.data[sel]
-
-                nonterm_partial_mask = deltas != 0
-                nonterm_mask = torch.zeros(n_queries, dtype=torch.bool, device=indices.device)
-                nonterm_mask[remain_mask] = nonterm_partial_mask
-
-                node_ids[remain_mask] += deltas
-                ind[remain_mask] = ind[remain_mask] * self.N - ind_floor
-
-                term_mask = remain_mask & ~nonterm_mask
-                vals[~nonterm_partial_mask] = values[term_mask]
-                self.data.data[sel] = vals
-
-                remain_mask &= nonterm_mask
+            flat = self._query_leaf_cpu(indices)
+            self.data.data.view(-1, self.data_dim)[flat] = values.to(self.data.dtype)
         else:
             _C.assign_vertical(self._spec(), indices, values)
+        self._data_ver += 1
 
     def forward(self, indices, cuda=True, want_node_ids=False, world=True):
         """
@@ -222,55 +212,73 @@ class N3Tree(nn.Module):
         assert len(indices.shape) == 2
 
         if not cuda or _C is None or not self.data.is_cuda:
-            if not want_node_ids:
-                warn("Using slow query")
             if world:
                 indices = self.world2tree(indices)
-
-            indices.clamp_(0.0, 1.0 - 1e-10)
-
-            n_queries, _ = indices.shape
-            node_ids = torch.zeros(n_queries, dtype=torch.long, device=indices.device)
-            result = torch.empty((n_queries, self.data_dim), dtype=self.data.dtype,
-                                  device=indices.device)
-            remain_indices = torch.arange(n_queries, dtype=torch.long, device=indices.device)
-            ind = indices.clone()
-
-            if want_node_ids:
-                subidx = torch.zeros((n_queries, 3), dtype=torch.long, device=indices.device)
-
-            while remain_indices.numel():
-                ind *= self.N
-                ind_floor = torch.floor(ind)
-                ind_floor.clamp_max_(self.N - 1)
-                ind -= ind_floor
-
-                sel = (node_ids[remain_indices], *(ind_floor.long().T),)
-
-                deltas = self.child[sel]
-
-                term_mask = deltas == 0
-                term_indices = remain_indices[term_mask]
-
-                vals = self.data[sel]
-                result[term_indices] = vals[term_mask]
-                if want_node_ids:
-                    subidx[term_indices] = ind_floor.to(torch.long)[term_mask]
-
-                node_ids[remain_indices] += deltas
-                remain_indices = remain_indices[~term_mask]
-                ind = ind[~term_mask]
-
-            if want_node_ids:
-                txyz = torch.cat([node_ids[:, None], subidx], axis=-1)
-                return result, self._pack_index(txyz)
-
-            return result
+            flat = self._query_leaf_cpu(indices)
+            result = self.data.view(-1, self.data_dim)[flat]
+            return (result, flat) if want_node_ids else result
         else:
             result, node_ids = _QueryVerticalFunction.apply(
                                 self.data, self._spec(world), indices);
             return (result, node_ids) if want_node_ids else result
 
+    def _query_leaf_cpu(self, indices):
+        """
+        PyTorch version of the point query used when CUDA is not available.
+        Descends the tree one depth at a time for all points still above
+        a leaf, keeping only their ids (no full-size masks). Chunks of
+        cpu_query_chunk points are run on cpu_query_threads threads.
+
+        :param indices: :code:`(Q, 3)` points in :code:`[0,1]^3` (tree space)
+
+        :return: :code:`(Q)` long packed leaf index (node * N^3 + x * N^2 + y * N + z)
+                 of each point, i.e. an index into :code:`data.view(-1, data_dim)`
+        """
+        n_queries = indices.shape[0]
+        out = torch.empty(n_queries, dtype=torch.long, device=indices.device)
+        chunk = max(self.cpu_query_chunk, 1)
+        starts = range(0, n_queries, chunk)
+
+        def run(start):
+            end = min(start + chunk, n_queries)
+            out[start:end] = self._query_leaf_chunk(indices[start:end])
+
+        if self.cpu_query_threads > 1 and len(starts) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(self.cpu_query_threads) as pool:
+                list(pool.map(run, starts))
+        else:
+            for start in starts:
+                run(start)
+        return out
+
+    def _query_leaf_chunk(self, indices):
+        N = self.N
+        child = self.child.view(-1)
+        ind = indices.clamp(0.0, 1.0 - 1e-10)
+        n_queries = ind.shape[0]
+        out = torch.empty(n_queries, dtype=torch.long, device=ind.device)
+        remain = torch.arange(n_queries, device=ind.device)
+        node = torch.zeros(n_queries, dtype=torch.long, device=ind.device)
+        while True:
+            ind = ind * N
+            ind_floor = torch.floor(ind).clamp_max_(N - 1)
+            ind -= ind_floor
+            xyz = ind_floor.long()
+            flat = ((node * N + xyz[:, 0]) * N + xyz[:, 1]) * N + xyz[:, 2]
+            deltas = child[flat]
+            nonterm = deltas.nonzero(as_tuple=False).reshape(-1)
+            if nonterm.numel() < remain.numel():
+                # Points not at a leaf yet are overwritten at a later depth
+                out[remain] = flat
+                if nonterm.numel() == 0:
+                    return out
+                remain = remain[nonterm]
+                ind = ind[nonterm]
+                node = node[nonterm]
+                deltas = deltas[nonterm]
+            node = node + deltas
+
     # Special features
     def snap(self, indices):
         """
@@ -311,6 +319,8 @@ class N3Tree(nn.Module):
                 data_format=data_format or str(self.data_format),
                 depth_limit=self.depth_limit,
                 geom_resize_fact=self.geom_resize_fact,
+                max_resize_step=self.max_resize_step,
+                resize_chunk=self.resize_chunk,
                 dtype=dtype,
                 device=device)
         def copy_to_device(x):
@@ -330,6 +340,7 @@ class N3Tree(nn.Module):
             t2.data = nn.Parameter(copy_to_device(self.data.data))
         else:
             t2.data = nn.Parameter(copy_to_device(self.data.data[..., sel_indices].contiguous()))
+        t2._invalidate()
         return t2
 
     def expand(self, data_format, data_dim=None, remap=None):
@@ -465,13 +476,15 @@ class N3Tree(nn.Module):
         if isinstance(reduced_vals, tuple):
             # Allow torch.max, torch.min, etc
             reduced_vals = reduced_vals[0]
-        parent_sel = (*self._unpack_index(self.parent_depth[nid, 0]).long().T,)
+        parent_ids = self.parent_depth[nid, 0]
+        parent_sel = (*self._unpack_index(parent_ids.clone()).long().T,)
         self.data.data[parent_sel] = reduced_vals
         self.child[parent_sel] = 0
         self.parent_depth[nid] = -1
         self.child[nid] = -1
         self._n_free += nid.shape[0]
-        self._invalidate()
+        self._release_nodes(nid)
+        self._record_delta(**self._merge_delta(nid, parent_ids))
         return True
 
     @property
@@ -624,12 +637,44 @@ class N3Tree(nn.Module):
 
         :return: node indices (first dim of self.data)
         """
-        if self._last_frontier is None:
-            node_selector = (self.child[ :self.n_internal] == 0).reshape(
-                    self.n_internal, -1).all(dim=1)
-            node_selector &= self.parent_depth[:self.n_internal, 0] != -1
-            self._last_frontier = node_selector.nonzero(as_tuple=False).reshape(-1)
-        return self._last_frontier
+        return self._cached_index('frontier')
+
+    def _all_internals(self):
+        """
+        Get the slots with a nonzero child link among the first n_internal nodes
+        (internal use). This includes the slots of freed nodes, whose child is -1;
+        see :code:`_live_internals` for the slots pointing to a child node.
+
+        :return: :code:`(n_slots, 4)` node selector on CPU
+        """
+        if self._last_all_inter is None or self._last_all_inter[0] != self._ver:
+            self._last_all_inter = (self._ver, (self.child[
+                :self.n_internal] != 0).nonzero(as_tuple=False).cpu())
+        return self._last_all_inter[1]
+
+    def _live_internals(self):
+        """
+        Get the slots of live nodes which point to a child node (internal use)
+
+        :return: :code:`(n_internal_slots, 4)` node selector on CPU
+        """
+        if self._last_live_inter is None or self._last_live_inter[0] != self._ver:
+            ids = self._cached_index('internals')
+            self._last_live_inter = (self._ver, self._unpack_index(ids.clone()))
+        return self._last_live_inter[1]
+
+    def check_index_consistency(self):
+        """
+        Check the incrementally maintained leaf, frontier and internal
+        slot sets against a full recompute, mostly for testing.
+        Errors with message if check fails; does nothing else.
+        """
+        for name, calc in self._index_calcs().items():
+            if name in self._index_cache:
+                ids = self._cached_index(name)
+                assert torch.equal(ids.cpu(), calc().cpu()), \
+                        f"Incrementally maintained {name} differ from full recompute"
+        return True
 
 
     # Leaf refinement & memory management methods
@@ -670,38 +715,35 @@ class N3Tree(nn.Module):
                 if num_nc == 0:
                     # Nothing to do
                     return False
-                new_filled = filled + num_nc
+                # Reuse slots freed by merge() first, append the rest
+                new_idxs, num_append = self._alloc_nodes(leaf_node[:, 0])
+                new_filled = filled + num_append
 
                 cap_needed = new_filled - self.capacity
                 if cap_needed > 0:
                     self._resize_add_cap(cap_needed)
                     resized = True
 
-                new_idxs = torch.arange(filled, filled + num_nc,
-                        device=leaf_node.device, dtype=self.child.dtype) # NNC
-
-                self.child[filled:new_filled] = 0
-                self.child[sel] = new_idxs - leaf_node[:, 0].to(torch.int32)
-                self.data.data[filled:new_filled] = self.data.data[
+                self.child[new_idxs] = 0
+                self.child[sel] = (new_idxs - leaf_node[:, 0]).to(self.child.dtype)
+                self.data.data[new_idxs] = self.data.data[
                         sel][:, None, None, None]
-                self.parent_depth[filled:new_filled, 0] = self._pack_index(leaf_node)  # parent
-                self.parent_depth[filled:new_filled, 1] = self.parent_depth[
+                self.parent_depth[new_idxs, 0] = self._pack_index(leaf_node).to(
+                        self.parent_depth.dtype)  # parent
+                self.parent_depth[new_idxs, 1] = self.parent_depth[
                         leaf_node[:, 0], 1] + 1  # depth
+                self._record_delta(**self._refine_delta(leaf_node, new_idxs))
 
                 if repeat_id < repeats - 1:
                     # Infer new selector
-                    t1 = torch.arange(filled, new_filled,
-                            device=self.data.device).repeat_interleave(self.N ** 3)
+                    t1 = new_idxs.repeat_interleave(self.N ** 3)
                     rangen = torch.arange(self.N, device=self.data.device)
-                    t2 = rangen.repeat_interleave(self.N ** 2).repeat(
-                            new_filled - filled)
-                    t3 = rangen.repeat_interleave(self.N).repeat(
-                            (new_filled - filled) * self.N)
-                    t4 = rangen.repeat((new_filled - filled) * self.N ** 2)
+                    t2 = rangen.repeat_interleave(self.N ** 2).repeat(num_nc)
+                    t3 = rangen.repeat_interleave(self.N).repeat(num_nc * self.N)
+                    t4 = rangen.repeat(num_nc * self.N ** 2)
                     sel = (t1, t2, t3, t4)
-                self._n_internal += num_nc
-        if repeats > 0:
-            self._invalidate()
+                self._n_internal += num_append
+                self._n_free -= num_nc - num_append
         return resized
 
     def _refine_at(self, intnode_idx, xyzi):
@@ -739,9 +781,98 @@ class N3Tree(nn.Module):
         self.data.data[filled, :, :, :] = self.data.data[intnode_idx, xi, yi, zi]
         self.data.data[intnode_idx, xi, yi, zi] = 0
         self._n_internal += 1
-        self._invalidate()
+        self._record_delta(**self._refine_delta(
+            torch.tensor([[intnode_idx, xi, yi, zi]], device=self.child.device),
+            torch.tensor([filled], device=self.child.device)))
         return resized
 
+    def _free_slots(self):
+        """
+        Sorted ids of the slots below n_internal freed by merge()
+        """
+        if self._last_free is None:
+            self._last_free = (self.parent_depth[:self.n_internal, 0] == -1).nonzero(
+                    as_tuple=False).reshape(-1)
+        return self._last_free
+
+    def _release_nodes(self, nids):
+        # Called after nodes are freed, keeps the free list in sync
+        if self._last_free is not None:
+            self._last_free = _sorted_insert(self._last_free, nids)
+
+    def _alloc_nodes(self, parents):
+        """
+        Pick slots for new child nodes of the given parents, reusing free
+        slots before growing past n_internal. A free slot only goes to a child
+        of a node with a smaller id, so nodes stay topologically sorted.
+        Does not update n_internal / n_free.
+
+        :param parents: :code:`(B)` parent node id of each new node
+
+        :return: :code:`(B)` long new node ids, int number of them appended
+                 from n_internal on
+        """
+        device = self.child.device
+        B = parents.shape[0]
+        filled = self.n_internal
+        num_reused = 0
+        free = self._free_slots() if self._n_free.item() > 0 else None
+        if free is None or free.numel() == 0:
+            new_idxs = torch.arange(filled, filled + B, device=device)
+        else:
+            new_idxs = torch.empty(B, dtype=torch.long, device=device)
+            sorted_parents, order = torch.sort(parents.to(device=device, dtype=torch.long))
+            # Greedy: in order of parent id, take the smallest free slot above
+            # the parent which is not taken yet
+            rng = torch.arange(B, device=device)
+            lowest = torch.searchsorted(free, sorted_parents, right=True)
+            slot = rng + torch.cummax(lowest - rng, dim=0)[0]
+            num_reused = int((slot < free.numel()).sum().item())
+            new_idxs[order[:num_reused]] = free[slot[:num_reused]]
+            new_idxs[order[num_reused:]] = torch.arange(
+                    filled, filled + B - num_reused, device=device)
+            taken = torch.zeros(free.numel(), dtype=torch.bool, device=device)
+            taken[slot[:num_reused]] = True
+            self._last_free = free[~taken]
+        self._n_reused_total += num_reused
+        self._n_appended_total += B - num_reused
+        return new_idxs, B - num_reused
+
+    def fragmentation_stats(self):
+        """
+        Node slot usage, e.g. to monitor how much memory freed by merge()
+        is reclaimed by refine() over a training run
+
+        :return: dict with
+                 capacity (allocated slots),
+                 n_internal (slots in use including free ones),
+                 n_free (free slots below n_internal),
+                 n_live (n_internal - n_free),
+                 fragmentation (n_free / n_internal),
+                 utilization (n_live / capacity),
+                 n_reused and n_appended (slots handed out by refine
+                 since construction, from the free list and from n_internal on),
+                 bytes_per_node and free_bytes (memory held by free slots)
+        """
+        n_int = self.n_internal
+        n_free = self._n_free.item()
+        N3 = self.N ** 3
+        bytes_per_node = (N3 * self.data_dim * self.data.element_size() +
+                          N3 * self.child.element_size() +
+                          2 * self.parent_depth.element_size())
+        return {
+            'capacity': self.capacity,
+            'n_internal': n_int,
+            'n_free': n_free,
+            'n_live': n_int - n_free,
+            'fragmentation': n_free / max(n_int, 1),
+            'utilization': (n_int - n_free) / max(self.capacity, 1),
+            'n_reused': self._n_reused_total,
+            'n_appended': self._n_appended_total,
+            'bytes_per_node': bytes_per_node,
+            'free_bytes': n_free * bytes_per_node,
+        }
+
     def shrink_to_fit(self):
         """
         Shrink data & buffers to tightly needed fit tree data,
@@ -779,18 +910,102 @@ class N3Tree(nn.Module):
             self.parent_depth = self.parent_depth[remain_ids]
             self._n_internal.fill_(new_cap)
             self._n_free.zero_()
+            self._invalidate()
         else:
-            # Direct resize
+            # Direct resize, node ids are unchanged
             self.data = nn.Parameter(self.data.data[:new_cap])
             self.child = self.child[:new_cap]
             self.parent_depth = self.parent_depth[:new_cap]
-        self._invalidate()
+            self._record_delta()
         return True
 
+    def reorder(self, policy='morton'):
+        """
+        Permute the nodes into a locality-preserving layout and compact the
+        storage like :code:`shrink_to_fit()`, removing free nodes.
+        Parents always come before their children, as required by the kernels.
+
+        :param policy: str
+                       'morton' depth-first, children visited in Z-order
+                       (for N=2, each subtree is contiguous along the Morton curve);
+                       'bfs' level by level, each level in Z-order
+
+        :return: :code:`(n_live)` long, old id of each node in the new order,
+                 to permute other per-node tensors with
+
+        .. warning::
+                Will change the nn.Parameter size (data), breaking optimizer!
+        """
+        if self._lock_tree_structure:
+            raise RuntimeError("Tree locked")
+        order = self._node_order(policy)
+        self._apply_node_order(order)
+        return order
+
+    def _node_order(self, policy):
+        """
+        Old ids of all live nodes in the layout given by policy,
+        see :code:`reorder()`
+        """
+        assert policy in ('morton', 'bfs'), f'Unknown node order {policy}'
+        device = self.child.device
+        n_int = self.n_internal
+        N3 = self.N ** 3
+        depth = self.parent_depth[:n_int, 1].long()
+        levels = self._live_levels()
+        max_depth = len(levels) - 1
+
+        # Path from the root as one digit (child slot + 1) per level, 0-padded,
+        # so that a parent compares below its own children
+        path = torch.zeros((n_int, max_depth), dtype=torch.long, device=device)
+        for d, ids in enumerate(levels):
+            if d == 0:
+                continue  # Root
+            packed = self.parent_depth[ids, 0].long()
+            path[ids] = path[torch.div(packed, N3, rounding_mode='floor')]
+            path[ids, d - 1] = packed % N3 + 1
+
+        # Lexicographic order by stable sorts, least significant digit first
+        order = torch.cat(levels)
+        for d in range(max_depth - 1, -1, -1):
+            order = order[torch.sort(path[order, d], stable=True)[1]]
+        if policy == 'bfs':
+            order = order[torch.sort(depth[order], stable=True)[1]]
+        return order
+
+    def _apply_node_order(self, order):
+        """
+        Rebuild the storage with the nodes order (old ids), which must list
+        every live node exactly once with parents before children
+        """
+        device = self.child.device
+        n_int = self.n_internal
+        N3 = self.N ** 3
+        new_id = torch.full((n_int,), -1, dtype=torch.long, device=device)
+        new_id[order] = torch.arange(order.numel(), device=device)
+
+        child = self.child[order].long()
+        nonleaf = child != 0
+        node_ids = order.view(-1, *([1] * (child.dim() - 1))).expand_as(child)
+        child[nonleaf] = new_id[node_ids[nonleaf] + child[nonleaf]] - \
+                new_id[node_ids[nonleaf]]
+
+        parent_depth = self.parent_depth[order].clone()
+        packed = parent_depth[:, 0].long()
+        parent_depth[:, 0] = (new_id[torch.div(packed, N3, rounding_mode='floor')] * N3 +
+                packed % N3).to(parent_depth.dtype)
+
+        self.data = nn.Parameter(self.data.data[order])
+        self.child = child.to(self.child.dtype)
+        self.parent_depth = parent_depth
+        self._n_internal.fill_(order.numel())
+        self._n_free.zero_()
+        self._invalidate()
+
     # Misc
     @property
     def n_leaves(self):
-        return self._all_leaves().shape[0]
+        return self._cached_index('leaves').numel()
 
     @property
     def n_internal(self):
@@ -832,34 +1047,55 @@ class N3Tree(nn.Module):
         return WeightAccumulator(self, op)
 
     # Persistence
-    def save(self, path, shrink=True, compress=True):
+    def save(self, path, shrink=True, compress=None, n_threads=4, half=False):
         """
-        Save to from npz file
-
-        :param path: npz path
-        :param shrink: if True (default), applies shrink_to_fit before saving
-        :param compress: whether to compress the npz; may be slow
+        Save to npz file, or to the memory-mappable tree file format
+        (see :code:`svox.treefile`) if path ends with :code:`.n3t`.
+        npz files store data in float16. .n3t files store it in the tree's dtype,
+        so an uncompressed one loads without copying any array, data included
+
+        :param path: npz or .n3t path
+        :param shrink: if True (default), only the n_internal used nodes are saved,
+                       after a shrink_to_fit() defragmentation if there are free nodes
+        :param compress: whether to compress; may be slow for npz.
+                         For .n3t, True picks the fastest available codec,
+                         a str selects one (see :code:`treefile.available_codecs()`).
+                         Default (None): npz files are compressed, .n3t files are not,
+                         as compressed ones can not be memory-mapped
+        :param n_threads: int threads compressing .n3t chunks in parallel
+        :param half: store .n3t data in float16 as npz does: half the size, but
+                     data is then converted (copied) on load
 
         """
-        if shrink:
+        if shrink and self._n_free.item() > 0:
             self.shrink_to_fit()
+        n_save = self.n_internal if shrink else self.capacity
         data = {
             "data_dim" : self.data_dim,
-            "child" : self.child.cpu(),
-            "parent_depth" : self.parent_depth.cpu(),
+            "child" : self.child[:n_save],
+            "parent_depth" : self.parent_depth[:n_save],
             "n_internal" : self._n_internal.cpu().item(),
             "n_free" : self._n_free.cpu().item(),
-            "invradius3" : self.invradius.cpu(),
-            "offset" : self.offset.cpu(),
+            "invradius3" : self.invradius,
+            "offset" : self.offset,
             "depth_limit": self.depth_limit,
             "geom_resize_fact": self.geom_resize_fact,
-            "data": self.data.data.half().cpu().numpy()  # save CPU Memory
+            "data": self.data.data[:n_save],
         }
         if self.data_format is not None:
             data["data_format"] = repr(self.data_format)
         if self.extra_data is not None:
-            data["extra_data"] = self.extra_data.cpu()
-        if compress:
+            data["extra_data"] = self.extra_data
+        if path.endswith(treefile.EXT):
+            # Streamed to disk in chunks, data converted to half on the way if asked
+            codec = treefile.available_codecs()[0] if compress is True else compress
+            treefile.write_tree_file(path, data, dtypes={"data": np.float16} if half else None,
+                                     codec=codec or None, n_threads=n_threads)
+            return
+        data = {k: v.cpu() if isinstance(v, torch.Tensor) else v for k, v in data.items()
+                if k != "data"}
+        data["data"] = self.data.data[:n_save].half().cpu().numpy()  # save CPU Memory
+        if compress or compress is None:
             np.savez_compressed(path, **data)
         else:
             np.savez(path, **data)
@@ -897,14 +1133,18 @@ class N3Tree(nn.Module):
         self[LocalIndex(idx)] = grid.reshape(-1, self.data_dim)
 
     @classmethod
-    def load(cls, path, device='cpu', dtype=torch.float32, map_location=None):
+    def load(cls, path, device='cpu', dtype=torch.float32, map_location=None, mmap=True):
         """
-        Load from npz file
+        Load from npz file or tree file (see :code:`svox.treefile`)
 
-        :param path: npz path
+        :param path: npz or tree file path
         :param device: str device to put data
         :param dtype: str torch.float32 (default) | torch.float64
         :param map_location: str DEPRECATED old name for device
+        :param mmap: memory-map tree files; on CPU, arrays already of the
+                     right dtype are then used in place without being copied.
+                     data stored in float16 (npz, or .n3t saved with half=True)
+                     is always converted, so it is copied in full on load
 
         """
         if map_location is not None:
@@ -912,11 +1152,11 @@ class N3Tree(nn.Module):
             device = map_location
         assert dtype == torch.float32 or dtype == torch.float64, 'Unsupported dtype'
         tree = cls(dtype=dtype, device=device)
-        z = np.load(path)
+        z = treefile.load_fields(path, mmap=mmap)
         tree.data_dim = int(z["data_dim"])
-        tree.child = torch.from_numpy(z["child"]).to(device)
+        tree.child = treefile.to_tensor(z["child"], device=device)
         tree.N = tree.child.shape[-1]
-        tree.parent_depth = torch.from_numpy(z["parent_depth"]).to(device)
+        tree.parent_depth = treefile.to_tensor(z["parent_depth"], device=device)
         tree._n_internal.fill_(z["n_internal"].item())
         if "invradius3" in z.files:
             tree.invradius = torch.from_numpy(z["invradius3"].astype(
@@ -926,15 +1166,92 @@ class N3Tree(nn.Module):
         tree.offset = torch.from_numpy(z["offset"].astype(np.float32)).to(device)
         tree.depth_limit = int(z["depth_limit"])
         tree.geom_resize_fact = float(z["geom_resize_fact"])
-        tree.data.data = torch.from_numpy(z["data"].astype(np.float32)).to(device)
+        tree.data.data = treefile.to_tensor(z["data"], dtype=dtype, device=device)
         if 'n_free' in z.files:
             tree._n_free.fill_(z["n_free"].item())
         else:
             tree._n_free.zero_()
         tree.data_format = DataFormat(z['data_format'].item()) if \
                 'data_format' in z.files else None
-        tree.extra_data = torch.from_numpy(z['extra_data']).to(device) if \
+        tree.extra_data = treefile.to_tensor(z['extra_data'], device=device) if \
                           'extra_data' in z.files else None
+        tree._invalidate()
+        return tree
+
+    def snapshot(self, share_memory=False, alloc=None, non_blocking=False):
+        """
+        Copy the tree state to CPU memory, as a dict of tensors and values
+        that :code:`from_snapshot` turns back into a tree.
+        Only the first n_internal nodes are copied (free nodes inside are kept).
+
+        :param share_memory: allocate the tensors in shared memory, so that passing
+                             the snapshot to another process (torch.multiprocessing)
+                             does not copy it again
+        :param alloc: callable :code:`(shape, dtype) -> CPU tensor` to copy into
+                      instead of new tensors, e.g. reused pinned buffers
+        :param non_blocking: with pinned buffers from alloc, copies from a CUDA tree are
+                             only queued on the current stream; synchronize it (or an event
+                             recorded after this call) before reading the snapshot
+
+        :return: dict
+        """
+        n_save = self.n_internal
+
+        def _copy(x):
+            out = torch.empty(x.shape, dtype=x.dtype) if alloc is None else alloc(x.shape, x.dtype)
+            if share_memory:
+                out.share_memory_()
+            return out.copy_(x, non_blocking=non_blocking)
+
+        with torch.no_grad():
+            return {
+                "N": self.N,
+                "data_dim": self.data_dim,
+                "data": _copy(self.data.data[:n_save]),
+                "child": _copy(self.child[:n_save]),
+                "parent_depth": _copy(self.parent_depth[:n_save]),
+                "n_internal": n_save,
+                "n_free": self._n_free.item(),
+                "invradius": _copy(self.invradius),
+                "offset": _copy(self.offset),
+                "depth_limit": self.depth_limit,
+                "geom_resize_fact": self.geom_resize_fact,
+                "max_resize_step": self.max_resize_step,
+                "resize_chunk": self.resize_chunk,
+                "data_format": repr(self.data_format) if self.data_format is not None else None,
+                "extra_data": _copy(self.extra_data) if self.extra_data is not None else None,
+            }
+
+    @classmethod
+    def from_snapshot(cls, snap, device='cpu'):
+        """
+        Make a tree from :code:`snapshot()`. On CPU the tree uses the snapshot tensors
+        in place, so modifying one modifies the other.
+
+        :param snap: dict from :code:`snapshot()`
+        :param device: str device to put data
+
+        """
+        dtype = snap["data"].dtype
+        tree = cls(dtype=dtype, device=device)
+        tree.N = snap["N"]
+        tree.data_dim = snap["data_dim"]
+        tree.child = snap["child"].to(device=device)
+        tree.parent_depth = snap["parent_depth"].to(device=device)
+        tree._n_internal.fill_(snap["n_internal"])
+        tree._n_free.fill_(snap["n_free"])
+        tree.invradius = snap["invradius"].to(device=device)
+        tree.offset = snap["offset"].to(device=device)
+        tree.depth_limit = snap["depth_limit"]
+        tree.geom_resize_fact = snap["geom_resize_fact"]
+        tree.max_resize_step = snap["max_resize_step"]
+        tree.resize_chunk = snap["resize_chunk"]
+        tree.data.data = snap["data"].to(device=device)
+        tree.data_format = DataFormat(snap["data_format"]) if \
+                snap["data_format"] is not None else None
+        tree.extra_data = snap["extra_data"].to(device=device) if \
+                snap["extra_data"] is not None else None
+        tree._invalidate()
         return tree
 
     # Magic
@@ -991,26 +1308,92 @@ class N3Tree(nn.Module):
         if _C is not None and cuda and self.data.is_cuda:
             return _C.calc_corners(self._spec(), nodes.to(self.data.device))
 
-        Q, _ = nodes.shape
-        filled = self.n_internal
-
-        curr = nodes.clone()
-        mask = torch.ones(Q, device=curr.device, dtype=torch.bool)
-        output = torch.zeros(Q, 3, device=curr.device, dtype=self.data.dtype)
+        # Lower corner of the node plus the offset of the cell within it
+        nodes = nodes.long()
+        cell_size = torch.pow(float(self.N), -1.0 - self.parent_depth[nodes[:, 0], 1].to(
+                self.data.dtype))
+        return self._node_origins()[nodes[:, 0]] + nodes[:, 1:] * cell_size[:, None]
 
-        while True:
-            output[mask] += curr[:, 1:]
-            output[mask] /= self.N
-
-            good_mask = curr[:, 0] != 0
-            if not good_mask.any():
-                break
-            mask[mask.clone()] = good_mask
-
-            curr = self._unpack_index(self.parent_depth[curr[good_mask, 0], 0].long())
+    def _node_origins(self):
+        """
+        :code:`(n_internal, 3)` lower corner of every node in :code:`[0,1]^3`,
+        computed one depth at a time and cached until the tree changes
+        """
+        if self._last_origins is None or self._last_origins[0] != self._ver:
+            origins = torch.zeros((self.n_internal, 3), dtype=self.data.dtype,
+                                  device=self.child.device)
+            for d, ids in enumerate(self._live_levels()):
+                if d == 0:
+                    continue  # Root
+                packed = self.parent_depth[ids, 0].long()
+                parent_xyz = self._unpack_index(packed.clone())
+                origins[ids] = origins[parent_xyz[:, 0]] + parent_xyz[:, 1:] * \
+                        float(self.N) ** -d
+            self._last_origins = (self._ver, origins)
+        return self._last_origins[1]
+
+    def mip(self):
+        """
+        Aggregates of every node's subtree (a mip pyramid over the tree),
+        for level of detail rendering: the mean density over the node's volume,
+        the density-weighted mean of the other channels (plain mean if empty),
+        and the max density of any leaf below.
+        This is a lazy full rebuild: nothing is updated incrementally, the whole
+        pyramid is recomputed bottom-up on the first call after any structure
+        change or data write through the tree (set, views, optimizer steps).
+        Call :code:`update_mip()` after writing :code:`tree.data` directly.
+
+        :return: :code:`(n_internal, data_dim)` mean values,
+                 :code:`(n_internal)` max density
+        """
+        key = (self._ver, self._data_ver)
+        if self._last_mip is None or self._last_mip[0] != key:
+            self._last_mip = (key, self._calc_mip())
+        return self._last_mip[1]
 
-        return output
+    def update_mip(self):
+        """
+        Mark data as modified, so that the next :code:`mip()` rebuilds the pyramid
+        """
+        self._data_ver += 1
 
+    def _calc_mip(self):
+        with torch.no_grad():
+            data = self.data.data
+            mean = torch.zeros((self.n_internal, self.data_dim), dtype=data.dtype,
+                               device=data.device)
+            sigma_max = torch.full((self.n_internal,), -float('inf'), dtype=data.dtype,
+                                   device=data.device)
+            # Bottom-up: children are done first
+            for ids in reversed(self._live_levels()):
+                vals = data[ids].reshape(ids.numel(), -1, self.data_dim).clone()
+                cell_max = vals[..., -1].clone()
+                skip = self.child[ids].reshape(ids.numel(), -1)
+                internal = skip != 0
+                if internal.any():
+                    cell_ids = ids[:, None].expand_as(skip)[internal] + skip[internal]
+                    vals[internal] = mean[cell_ids]
+                    cell_max[internal] = sigma_max[cell_ids]
+                weight = vals[..., -1:].clamp_min(0.0)
+                weight_sum = weight.sum(dim=1)
+                color = torch.where(weight_sum > 0,
+                                    (vals[..., :-1] * weight).sum(dim=1) /
+                                    weight_sum.clamp_min(1e-12),
+                                    vals[..., :-1].mean(dim=1))
+                mean[ids] = torch.cat([color, vals[..., -1:].mean(dim=1)], dim=-1)
+                sigma_max[ids] = cell_max.amax(dim=1)
+        return mean, sigma_max
+
+    def _live_levels(self):
+        """
+        Ids of the live nodes, one tensor per depth starting from the root
+        """
+        n_int = self.n_internal
+        depth = self.parent_depth[:n_int, 1].long()
+        live_ids = (self.parent_depth[:n_int, 0] != -1).nonzero(as_tuple=False).reshape(-1)
+        by_depth = live_ids[torch.argsort(depth[live_ids])]
+        levels = torch.unique_consecutive(depth[by_depth], return_counts=True)[1]
+        return torch.split(by_depth, levels.tolist())
 
     def _pack_index(self, txyz):
         return txyz[:, 0] * (self.N ** 3) + txyz[:, 1] * (self.N ** 2) + \
@@ -1023,29 +1406,51 @@ class N3Tree(nn.Module):
             flat //= self.N
         return torch.stack((flat, t[2], t[1], t[0]), dim=-1)
 
+    def _grow_size(self, cap_needed):
+        """
+        Number of nodes to add to the capacity when at least cap_needed are
+        missing, following the growth policy: geometric by geom_resize_fact,
+        at most max_resize_step nodes past cap_needed (0 = no limit), rounded
+        up to a multiple of resize_chunk (0 = no rounding)
+        """
+        cap_add = max(cap_needed, int(self.capacity * (self.geom_resize_fact - 1.0)))
+        if self.max_resize_step > 0:
+            cap_add = max(cap_needed, min(cap_add, cap_needed + self.max_resize_step))
+        if self.resize_chunk > 0:
+            cap_add = -(-cap_add // self.resize_chunk) * self.resize_chunk
+        return cap_add
+
     def _resize_add_cap(self, cap_needed):
         """
         Helper for increasing capacity
         """
-        cap_needed = max(cap_needed, int(self.capacity * (self.geom_resize_fact - 1.0)))
-        may_oom = self.capacity + cap_needed > 1e7  # My CPU Memory is limited
-        if may_oom:
-            # Potential OOM prevention hack
-            self.data = nn.Parameter(self.data.cpu())
-        self.data = nn.Parameter(torch.cat((self.data.data,
-                        torch.zeros((cap_needed, *self.data.data.shape[1:]),
-                                dtype=self.data.dtype,
-                                device=self.data.device)), dim=0))
-        if may_oom:
-            self.data = nn.Parameter(self.data.to(device=self.child.device))
-        self.child = torch.cat((self.child,
-                                torch.zeros((cap_needed, *self.child.shape[1:]),
-                                   dtype=self.child.dtype,
-                                   device=self.data.device)))
-        self.parent_depth = torch.cat((self.parent_depth,
-                                torch.zeros((cap_needed, *self.parent_depth.shape[1:]),
-                                   dtype=self.parent_depth.dtype,
-                                   device=self.data.device)))
+        new_cap = self.capacity + self._grow_size(cap_needed)
+        def grow(x):
+            # Copy into a preallocated buffer: peak memory is old + new,
+            # without the temporary padding block torch.cat needs
+            out = x.new_zeros((new_cap, *x.shape[1:]))
+            out[:x.shape[0]] = x
+            return out
+        self.data = nn.Parameter(grow(self.data.data))
+        self.child = grow(self.child)
+        self.parent_depth = grow(self.parent_depth)
+
+    def reserve(self, n):
+        """
+        Make sure that n more nodes can be added by refine() without
+        reallocating, e.g. before a sampling round of known size.
+        Slots freed by merge() are not counted, so this may over-reserve.
+
+        :param n: int number of nodes to be added
+
+        :return: True iff the capacity was increased,
+                 in which case optimizers must be re-made
+        """
+        cap_needed = self.n_internal + n - self.capacity
+        if cap_needed <= 0:
+            return False
+        self._resize_add_cap(cap_needed)
+        return True
 
     def _make_val_tensor(self, val):
         val_tensor = torch.tensor(val, dtype=self.data.dtype,
@@ -1059,10 +1464,10 @@ class N3Tree(nn.Module):
         return val_tensor
 
     def _all_leaves(self):
-        if self._last_all_leaves is None:
-            self._last_all_leaves = (self.child[
-                :self.n_internal] == 0).nonzero(as_tuple=False).cpu()
-        return self._last_all_leaves
+        if self._last_all_leaves is None or self._last_all_leaves[0] != self._ver:
+            ids = self._cached_index('leaves')
+            self._last_all_leaves = (self._ver, self._unpack_index(ids.clone()))
+        return self._last_all_leaves[1]
 
     def world2tree(self, indices):
         """
@@ -1078,8 +1483,118 @@ class N3Tree(nn.Module):
 
     def _invalidate(self):
         self._ver += 1
+        self._index_cache = {}
+        self._delta_log = []
         self._last_all_leaves = None
-        self._last_frontier = None
+        self._last_all_inter = None
+        self._last_live_inter = None
+        self._last_free = None
+        self._last_origins = None
+        self._last_mip = None
+
+    # Incrementally maintained node/slot id sets.
+    # Structural edits which keep node ids stable log their effect through
+    # _record_delta instead of calling _invalidate; the cached sets replay
+    # the log lazily on next access.
+    def _index_calcs(self):
+        return {
+            'leaves': self._calc_leaf_ids,
+            'frontier': self._calc_frontier,
+            'internals': self._calc_internal_ids,
+        }
+
+    def _calc_leaf_ids(self):
+        # Flat index into child[:n_internal] is the packed index
+        return (self.child[:self.n_internal] == 0).reshape(-1).nonzero(
+                as_tuple=False).reshape(-1).cpu()
+
+    def _calc_frontier(self):
+        node_selector = (self.child[ :self.n_internal] == 0).reshape(
+                self.n_internal, -1).all(dim=1)
+        node_selector &= self.parent_depth[:self.n_internal, 0] != -1
+        return node_selector.nonzero(as_tuple=False).reshape(-1)
+
+    def _calc_internal_ids(self):
+        n_int = self.n_internal
+        live = self.parent_depth[:n_int, 0] != -1
+        return ((self.child[:n_int] != 0) & live[:, None, None, None]).reshape(
+                -1).nonzero(as_tuple=False).reshape(-1).cpu()
+
+    def _cached_index(self, name):
+        """
+        Get sorted id set :code:`name` ('leaves' | 'frontier' | 'internals'),
+        replaying the edits logged since it was cached,
+        or fully recomputing it if it is not cached
+        """
+        entry = self._index_cache.get(name)
+        if entry is None:
+            ids = self._index_calcs()[name]()
+        else:
+            ver, ids = entry
+            if ver == self._ver:
+                return ids
+            for dver, dname, added, removed in self._delta_log:
+                if dver > ver and dname == name:
+                    ids = _sorted_insert(_sorted_remove(ids, removed), added)
+        self._index_cache[name] = (self._ver, ids)
+        self._trim_delta_log()
+        return ids
+
+    def _record_delta(self, **deltas):
+        """
+        Bump the layout version after a structural edit which keeps
+        node ids stable, logging its effect on the cached id sets.
+
+        :param deltas: name -> (added ids, removed ids), for each of
+                       'leaves' | 'frontier' | 'internals'
+        """
+        self._ver += 1
+        for name, (added, removed) in deltas.items():
+            entry = self._index_cache.get(name)
+            if entry is None:
+                continue
+            pending = added.numel() + removed.numel() + sum(
+                    d[2].numel() + d[3].numel() for d in self._delta_log if d[1] == name)
+            if pending > entry[1].numel():
+                # Cheaper to recompute than to replay
+                del self._index_cache[name]
+            else:
+                self._delta_log.append((self._ver, name, added, removed))
+        self._trim_delta_log()
+
+    def _trim_delta_log(self):
+        self._delta_log = [d for d in self._delta_log if d[1] in self._index_cache
+                           and d[0] > self._index_cache[d[1]][0]]
+
+    def _refine_delta(self, leaf_node, new_idxs):
+        N3 = self.N ** 3
+        leaf_ids = self._pack_index(leaf_node.long())
+        new_idxs = new_idxs.long()
+        new_leaves = new_idxs[:, None] * N3 + torch.arange(N3, device=new_idxs.device)
+        return dict(
+            leaves=(new_leaves.reshape(-1), leaf_ids),
+            frontier=(new_idxs, leaf_node[:, 0].long()),
+            internals=(leaf_ids, leaf_ids[:0]),
+        )
+
+    def _merge_delta(self, nids, parent_ids):
+        """
+        Effect of merging nodes nids (possibly nested) with packed parent slots
+        parent_ids on the id sets; call after the edit
+        """
+        N3 = self.N ** 3
+        nids = nids.long()
+        parent_ids = parent_ids.long()
+        parent_nodes = torch.div(parent_ids, N3, rounding_mode='floor')
+        top = ~_isin_sorted(parent_nodes, torch.sort(nids)[0])
+        cand = torch.unique(parent_nodes[top])
+        cand = cand[(self.child[cand] == 0).reshape(cand.shape[0], -1).all(dim=1)]
+        old_leaves = nids[:, None] * N3 + torch.arange(N3, device=nids.device)
+        return dict(
+            leaves=(parent_ids[top], old_leaves.reshape(-1)),
+            frontier=(cand, nids),
+            internals=(parent_ids[:0], parent_ids),
+        )
 
     def _spec(self, world=True):
         """
@@ -1160,6 +1675,42 @@ class WeightAccumulator():
     def __call__(self):
         return self.tree.aux(self.weight_accum)
 
+def _sorted_remove(ids, vals):
+    """
+    Remove vals from sorted unique 1D tensor ids, ignoring values not in ids
+    """
+    if ids.numel() == 0 or vals.numel() == 0:
+        return ids
+    vals = vals.to(device=ids.device, dtype=ids.dtype).reshape(-1)
+    pos = torch.searchsorted(ids, vals).clamp_max_(ids.numel() - 1)
+    keep = torch.ones(ids.numel(), dtype=torch.bool, device=ids.device)
+    keep[pos[ids[pos] == vals]] = False
+    return ids[keep]
+
+def _sorted_insert(ids, vals):
+    """
+    Insert vals, which must not be in ids yet, into sorted unique 1D tensor ids
+    """
+    if vals.numel() == 0:
+        return ids
+    vals = torch.unique(vals.to(device=ids.device, dtype=ids.dtype).reshape(-1))
+    pos = torch.searchsorted(ids, vals) + torch.arange(vals.numel(), device=ids.device)
+    out = torch.empty(ids.numel() + vals.numel(), dtype=ids.dtype, device=ids.device)
+    mask = torch.ones(out.numel(), dtype=torch.bool, device=ids.device)
+    mask[pos] = False
+    out[pos] = vals
+    out[mask] = ids
+    return out
+
+def _isin_sorted(vals, ids):
+    """
+    Elementwise membership of vals in sorted 1D tensor ids
+    """
+    if ids.numel() == 0:
+        return torch.zeros(vals.shape, dtype=torch.bool, device=vals.device)
+    pos = torch.searchsorted(ids, vals).clamp_max_(ids.numel() - 1)
+    return ids[pos] == vals
+
 def gen_grid(D):
     """
     Generate D^3 grid centers (coordinates in [0, 1]^3, xyz)
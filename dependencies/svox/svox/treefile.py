@@ -0,0 +1,293 @@
+#  Copyright 2021 PlenOctree Authors.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  1. Redistributions of source code must retain the above copyright notice,
+#  this list of conditions and the following disclaimer.
+#
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#  this list of conditions and the following disclaimer in the documentation
+#  and/or other materials provided with the distribution.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+#  LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#  CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#  SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#  INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#  CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#  ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+"""
+Native on-disk format for N3Tree, an alternative to npz which can be
+memory-mapped (when uncompressed) and written/read with parallel compression.
+
+    MAGIC (8 bytes) | header offset (uint64 LE) | pad |
+    array 0 | pad | array 1 | ... | header JSON
+
+Arrays are streamed first, each starting at an ALIGN byte boundary; the
+header at the end holds the scalar fields of the tree and, per array, its
+dtype, shape, absolute byte offset and codec. Compressed arrays are split
+into independently compressed chunks listed in the header.
+"""
+import json
+import zlib
+import lzma
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+MAGIC = b'N3TREE\x00\x02'
+ALIGN = 64
+EXT = '.n3t'
+
+# Uncompressed bytes per chunk when streaming / compressing arrays
+CHUNK_BYTES = 1 << 24
+
+
+def _align(n):
+    return -(-n // ALIGN) * ALIGN
+
+
+def _get_codec(name):
+    """
+    :return: (compress, decompress) functions of bytes for codec name
+    """
+    if name == 'zstd':
+        import zstandard
+        return (lambda buf: zstandard.ZstdCompressor(level=3).compress(buf),
+                lambda buf: zstandard.ZstdDecompressor().decompress(buf))
+    elif name == 'lz4':
+        import lz4.frame
+        return lz4.frame.compress, lz4.frame.decompress
+    elif name == 'zlib':
+        return (lambda buf: zlib.compress(buf, 1)), zlib.decompress
+    elif name == 'lzma':
+        return (lambda buf: lzma.compress(buf, preset=1)), lzma.decompress
+    raise NotImplementedError(f'Unsupported codec {name}')
+
+
+def available_codecs():
+    """
+    Usable codecs, fastest first. zstd and lz4 need the zstandard / lz4
+    packages, zlib and lzma are always available.
+    """
+    codecs = []
+    for name in ['zstd', 'lz4']:
+        try:
+            _get_codec(name)
+            codecs.append(name)
+        except ImportError:
+            pass
+    return codecs + ['zlib', 'lzma']
+
+
+def is_tree_file(path):
+    """
+    Whether path is in this format (as opposed to npz), by its magic bytes
+    """
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _np_dtype(dtype):
+    return torch.empty(0, dtype=dtype).numpy().dtype
+
+
+def _iter_chunks(arr, dtype):
+    """
+    Contiguous numpy chunks of about CHUNK_BYTES of a np.ndarray or
+    torch.Tensor (any device) along dim 0, cast to np dtype on the way
+    """
+    if arr.ndim == 0:
+        arr = arr.reshape(1)
+    row_bytes = max(int(np.prod(arr.shape[1:])) * np.dtype(dtype).itemsize, 1)
+    step = max(CHUNK_BYTES // row_bytes, 1)
+    for i in range(0, max(arr.shape[0], 1), step):
+        chunk = arr[i:i + step]
+        if isinstance(chunk, torch.Tensor):
+            chunk = chunk.to(dtype=torch.from_numpy(np.empty(0, dtype)).dtype)
+            chunk = chunk.cpu().numpy()
+        yield np.ascontiguousarray(chunk, dtype=dtype)
+
+
+def write_tree_file(path, fields, dtypes=None, codec=None, n_threads=4):
+    """
+    Write a tree file, streaming arrays to disk one chunk at a time
+
+    :param path: output path
+    :param fields: dict of name to np.ndarray / torch.Tensor on any device
+                   (stored as arrays) or JSON-serializable scalar (stored in the header)
+    :param dtypes: optional dict of name to np dtype to store an array as,
+                   converted chunk by chunk (e.g. {'data': np.float16})
+    :param codec: None (raw, memory-mappable) | 'zstd' | 'lz4' | 'zlib' | 'lzma'
+    :param n_threads: int threads compressing chunks in parallel
+    """
+    dtypes = dtypes or {}
+    compress = _get_codec(codec)[0] if codec is not None else None
+    meta, layout = {}, {}
+    pool = ThreadPoolExecutor(n_threads) if compress is not None else None
+    try:
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(np.uint64(0).tobytes())
+            for name, arr in fields.items():
+                if not isinstance(arr, (np.ndarray, torch.Tensor)):
+                    meta[name] = arr
+                    continue
+                dtype = np.dtype(dtypes.get(name, arr.dtype if isinstance(arr, np.ndarray)
+                                            else _np_dtype(arr.dtype)))
+                f.write(b'\x00' * (_align(f.tell()) - f.tell()))
+                desc = {'dtype': dtype.str, 'shape': list(arr.shape), 'offset': f.tell()}
+                if compress is None:
+                    for chunk in _iter_chunks(arr, dtype):
+                        chunk.tofile(f)
+                else:
+                    # Keep a bounded number of chunks in flight, written in order
+                    desc['codec'] = codec
+                    desc['chunks'] = []
+                    pending = []
+                    def flush(max_pending):
+                        while len(pending) > max_pending:
+                            raw_size, fut = pending.pop(0)
+                            buf = fut.result()
+                            desc['chunks'].append([f.tell(), len(buf), raw_size])
+                            f.write(buf)
+                    for chunk in _iter_chunks(arr, dtype):
+                        pending.append((chunk.nbytes, pool.submit(compress, chunk.data)))
+                        flush(2 * n_threads)
+                    flush(0)
+                layout[name] = desc
+            header_offset = f.tell()
+            f.write(json.dumps({'meta': meta, 'arrays': layout}).encode('utf-8'))
+            f.seek(len(MAGIC))
+            f.write(np.uint64(header_offset).tobytes())
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+class TreeFile:
+    """
+    Contents of a tree file, with the interface of np.load's NpzFile
+    (:code:`files`, :code:`z[name]`) so loaders can read either.
+    With mmap, uncompressed arrays are copy-on-write np.memmap views of the file:
+    nothing is read until accessed and in-memory writes never reach the disk.
+    Compressed arrays are decompressed in parallel on first access.
+    """
+    def __init__(self, path, mmap=True, n_threads=4):
+        self.path = path
+        self.mmap = mmap
+        self.n_threads = n_threads
+        with open(path, 'rb') as f:
+            assert f.read(len(MAGIC)) == MAGIC, f'{path} is not a tree file'
+            f.seek(int(np.frombuffer(f.read(8), dtype=np.uint64)[0]))
+            header = json.loads(f.read().decode('utf-8'))
+        self._meta = header['meta']
+        self._layout = header['arrays']
+        self._arrays = {}
+        self.files = list(self._meta) + list(self._layout)
+
+    def _read_array(self, desc):
+        dtype = np.dtype(desc['dtype'])
+        shape = tuple(desc['shape'])
+        count = int(np.prod(shape))
+        if 'codec' in desc:
+            out = np.empty(shape, dtype=dtype)
+            flat = out.reshape(-1).view(np.uint8)
+            decompress = _get_codec(desc['codec'])[1]
+            starts = np.cumsum([0] + [c[2] for c in desc['chunks']])
+            def run(i):
+                offset, size, _ = desc['chunks'][i]
+                with open(self.path, 'rb') as f:
+                    f.seek(offset)
+                    buf = decompress(f.read(size))
+                flat[starts[i]:starts[i + 1]] = np.frombuffer(buf, dtype=np.uint8)
+            with ThreadPoolExecutor(self.n_threads) as pool:
+                list(pool.map(run, range(len(desc['chunks']))))
+            return out
+        if self.mmap and count > 0:
+            return np.memmap(self.path, dtype=dtype, mode='c',
+                             offset=desc['offset'], shape=shape)
+        with open(self.path, 'rb') as f:
+            f.seek(desc['offset'])
+            return np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+
+    def __getitem__(self, name):
+        if name in self._layout:
+            if name not in self._arrays:
+                self._arrays[name] = self._read_array(self._layout[name])
+            return self._arrays[name]
+        return np.asarray(self._meta[name])
+
+    def __contains__(self, name):
+        return name in self.files
+
+
+def load_fields(path, mmap=True):
+    """
+    Open a tree file or npz, whichever path is
+
+    :return: TreeFile or NpzFile
+    """
+    if is_tree_file(path):
+        return TreeFile(path, mmap=mmap)
+    return np.load(path)
+
+
+def to_tensor(arr, dtype=None, device='cpu', chunk_bytes=1 << 28):
+    """
+    Convert a (possibly memory-mapped) array to a tensor without
+    intermediate copies: zero-copy if dtype and device already match,
+    else converted chunk by chunk straight into the output tensor
+
+    :param arr: np.ndarray
+    :param dtype: torch dtype of the result, default arr's
+    :param device: device of the result
+    :param chunk_bytes: int approximate size of each converted chunk
+    """
+    src = torch.from_numpy(arr) if arr.flags.writeable else torch.from_numpy(arr.copy())
+    dtype = dtype or src.dtype
+    if dtype == src.dtype and torch.device(device).type == 'cpu':
+        return src
+    out = torch.empty(src.shape, dtype=dtype, device=device)
+    if src.dim() == 0:
+        return out.copy_(src)
+    row_bytes = max(src[0].numel() * src.element_size(), 1)
+    step = max(chunk_bytes // row_bytes, 1)
+    for i in range(0, src.shape[0], step):
+        out[i:i + step].copy_(src[i:i + step])
+    return out
+
+
+def convert(src, dst, mmap=True, codec=None, sh_dim=None):
+    """
+    Convert between npz and tree file, by the extension of dst
+
+    :param sh_dim: int, if set, keep only the first sh_dim SH basis functions
+                   (1, 4, 9, 16 or 25) of an SH tree, cutting memory and
+                   shading cost
+    """
+    from svox.svox import N3Tree
+    from svox.helpers import DataFormat
+    tree = N3Tree.load(src, mmap=mmap)
+    if sh_dim is not None and sh_dim < tree.data_format.basis_dim:
+        assert tree.data_format.format == DataFormat.SH, "Only SH trees can be truncated"
+        tree.shrink(f"SH{sh_dim}")
+    tree.save(dst, shrink=False,
+              compress=codec if dst.endswith(EXT) else codec is not None)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert an N3Tree between npz and ' + EXT)
+    parser.add_argument('src', type=str)
+    parser.add_argument('dst', type=str)
+    parser.add_argument('--codec', type=str, default=None, choices=available_codecs(),
+                        help='Compress the output (default: uncompressed, memory-mappable)')
+    parser.add_argument('--sh_dim', type=int, default=None,
+                        help='Truncate an SH tree to this many basis functions (1, 4, 9, 16)')
+    args = parser.parse_args()
+    convert(args.src, args.dst, codec=args.codec, sh_dim=args.sh_dim)
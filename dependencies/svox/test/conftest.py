@@ -0,0 +1,35 @@
+import importlib.util
+
+import pytest
+
+# Without torch and an installed svox there is nothing to run
+collect_ignore_glob = [] if all(importlib.util.find_spec(m) is not None
+                                for m in ("torch", "numpy", "svox")) else ["test_*.py"]
+
+
+@pytest.fixture
+def random_tree():
+    """
+    Factory of random trees: an N3Tree refined on a random fraction of its
+    leaves for each of steps rounds, then filled with random data.
+    after_step(tree, generator), if given, runs after each round.
+    Other keyword arguments go to N3Tree.
+    """
+    import torch
+    import svox
+
+    def make(seed=0, steps=3, frac=0.3, after_step=None, **kwargs):
+        kwargs.setdefault("init_refine", 1)
+        kwargs.setdefault("depth_limit", 6)
+        g = torch.Generator().manual_seed(seed)
+        tree = svox.N3Tree(**kwargs)
+        for _ in range(steps):
+            leaves = tree._all_leaves()
+            k = max(int(leaves.size(0) * frac), 1)
+            pick = torch.randperm(leaves.size(0), generator=g)[:k]
+            tree.refine(sel=(*leaves[pick].long().T,))
+            if after_step is not None:
+                after_step(tree, g)
+        tree.data.data.copy_(torch.randn(tree.data.shape, generator=g))
+        return tree
+    return make
@@ -0,0 +1,21 @@
+import svox
+
+
+def test_growth_policy():
+    tree = svox.N3Tree(init_reserve=1000, geom_resize_fact=1.5, max_resize_step=100)
+    # Geometric growth, capped at max_resize_step spare nodes past the need
+    assert tree._grow_size(10) == 110
+    assert tree._grow_size(1000) == 1000
+    tree.max_resize_step = 0
+    assert tree._grow_size(10) == 500
+    tree.geom_resize_fact = 1.0
+    assert tree._grow_size(10) == 10
+
+
+def test_refine_reuses_capacity():
+    tree = svox.N3Tree(geom_resize_fact=1.5, max_resize_step=64)
+    for _ in range(3):
+        leaves = tree._all_leaves()
+        tree.refine(sel=(*leaves[:3].long().T,))
+        assert tree.n_internal <= tree.capacity <= tree.n_internal + 64
+    tree.check_index_consistency()
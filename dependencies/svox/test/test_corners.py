@@ -0,0 +1,32 @@
+import torch
+
+
+def _reference_corner(tree, leaf):
+    # Sum the cell offsets up the parent links
+    N = tree.N
+    node, xyz = int(leaf[0]), leaf[1:].tolist()
+    corner = [0.0, 0.0, 0.0]
+    while True:
+        depth = int(tree.parent_depth[node, 1])
+        for k in range(3):
+            corner[k] += xyz[k] * float(N) ** (-depth - 1)
+        if node == 0:
+            return corner
+        node, rem = divmod(int(tree.parent_depth[node, 0]), N ** 3)
+        x, rem = divmod(rem, N * N)
+        xyz = [x, *divmod(rem, N)]
+
+
+def _check(tree):
+    leaves = tree._all_leaves().long()
+    corners = tree._calc_corners(leaves, cuda=False)
+    ref = torch.tensor([_reference_corner(tree, l) for l in leaves], dtype=corners.dtype)
+    assert torch.allclose(corners, ref, atol=1e-6)
+
+
+def test_corners_match_reference_after_edits(random_tree):
+    # The per-node origin table must follow every new layout
+    tree = random_tree(frac=0.25, after_step=lambda tree, g: _check(tree))
+    _check(tree)
+    tree.merge(torch.arange(0, tree.n_frontier, 3))
+    _check(tree)
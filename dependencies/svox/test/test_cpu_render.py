@@ -0,0 +1,222 @@
+import pytest
+import torch
+import svox
+
+from svox import renderer as svox_renderer
+
+
+def _scene(data_format='SH4', seed=0):
+    # Random colors, dense ball in the middle of [0,1]^3
+    g = torch.Generator().manual_seed(seed)
+    tree = svox.N3Tree(init_refine=3, data_format=data_format)
+    leaves = tree._all_leaves().long()
+    centers = tree._calc_corners(leaves, cuda=False) + 0.5 / 16
+    vals = torch.randn(leaves.size(0), tree.data_dim, generator=g)
+    vals[:, -1] = ((centers - 0.5).norm(dim=-1) < 0.3).float() * 20.0
+    tree.data.data[(*leaves.T,)] = vals
+    return tree
+
+
+def _pose(x=0.5):
+    c2w = torch.eye(4)
+    c2w[:3, 3] = torch.tensor([x, 0.5, 2.0])
+    return c2w
+
+
+def test_empty_tree_renders_background():
+    tree = svox.N3Tree(init_refine=2, data_format='SH4')
+    r = svox.VolumeRenderer(tree, background_brightness=0.7)
+    im = r.render_persp(_pose(), 16, 16, fx=20.0, cuda=False)
+    assert torch.equal(im, torch.full_like(im, 0.7))
+
+
+def test_opaque_tree_renders_leaf_color():
+    tree = svox.N3Tree(init_refine=2)
+    tree.data.data[..., :3] = torch.tensor([0.3, -1.0, 2.0])
+    tree.data.data[..., 3] = 1e4
+    r = svox.VolumeRenderer(tree)
+    with torch.no_grad():
+        im = r.render_persp(_pose(), 8, 8, fx=20.0, cuda=False)
+    expected = torch.sigmoid(torch.tensor([0.3, -1.0, 2.0]))
+    assert torch.allclose(im, expected.expand_as(im), atol=1e-4)
+
+
+def test_gradient_reaches_visible_leaves():
+    tree = _scene()
+    r = svox.VolumeRenderer(tree)
+    r.render_persp(_pose(), 16, 16, fx=20.0, cuda=False).sum().backward()
+    grad = tree.data.grad
+    assert torch.isfinite(grad).all()
+    assert grad[..., -1].abs().sum() > 0
+
+
+@pytest.mark.skipif(svox_renderer._C is None or not torch.cuda.is_available(),
+                    reason="needs the CUDA extension")
+def test_matches_cuda_renderer():
+    tree = _scene()
+    r_cpu = svox.VolumeRenderer(tree)
+    r_cuda = svox.VolumeRenderer(tree.clone(device='cuda'))
+    with torch.no_grad():
+        for x in (0.5, 0.2):
+            im_cpu = r_cpu.render_persp(_pose(x), 24, 24, fx=30.0, cuda=False)
+            im_cuda = r_cuda.render_persp(_pose(x).cuda(), 24, 24, fx=30.0)
+            assert torch.allclose(im_cpu, im_cuda.cpu(), atol=1e-3)
+
+
+def test_batch_matches_single_views():
+    tree = _scene()
+    r = svox.VolumeRenderer(tree)
+    c2ws = torch.stack([_pose(0.5), _pose(0.3), _pose(0.7)])
+    with torch.no_grad():
+        ims = r.render_persp_batch(c2ws, 16, 12, fx=20.0, cuda=False)
+        for c2w, im in zip(c2ws, ims):
+            assert torch.allclose(im, r.render_persp(c2w, 16, 12, fx=20.0, cuda=False),
+                                  atol=1e-6)
+
+
+def test_leaf_shading_is_close_to_exact():
+    tree = _scene()
+    r = svox.VolumeRenderer(tree)
+    with torch.no_grad():
+        ref = r.render_persp(_pose(), 24, 24, fx=30.0, cuda=False)
+        r.cpu_shading = 'leaf'
+        r.cpu_shading_tol = 0.0
+        # Nothing is within tolerance, every sample is shaded exactly
+        assert torch.allclose(r.render_persp(_pose(), 24, 24, fx=30.0, cuda=False),
+                              ref, atol=1e-5)
+        r.cpu_shading_tol = 0.02
+        im = r.render_persp(_pose(), 24, 24, fx=30.0, cuda=False)
+    assert (im - ref).abs().max() < 2e-2
+
+    with pytest.raises(AssertionError):
+        r.render_persp(_pose(), 8, 8, fx=10.0, cuda=False)
+
+
+def test_sh_lod_bounds_match_band_truncation():
+    tree = _scene()
+    r = svox.VolumeRenderer(tree)
+    r_dc = svox.VolumeRenderer(tree, max_comp=0)
+    args = (_pose(), 24, 24)
+    with torch.no_grad():
+        ref = r.render_persp(*args, fx=30.0, cuda=False)
+        ref_dc = r_dc.render_persp(*args, fx=30.0, cuda=False)
+
+        r.sh_lod = svox.SHLod(footprint=1e-9)
+        assert torch.allclose(r.render_persp(*args, fx=30.0, cuda=False), ref, atol=1e-6)
+        # Every cell covers fewer pixels than this, all fall to min_degree
+        r.sh_lod = svox.SHLod(footprint=1e9)
+        assert torch.allclose(r.render_persp(*args, fx=30.0, cuda=False), ref_dc, atol=1e-6)
+        r.sh_lod = svox.SHLod()
+        r.sh_lod.degree = 0
+        assert torch.allclose(r.render_persp(*args, fx=30.0, cuda=False), ref_dc, atol=1e-6)
+
+        tree.shrink('SH1')
+        assert torch.allclose(svox.VolumeRenderer(tree).render_persp(*args, fx=30.0, cuda=False),
+                              ref_dc, atol=1e-6)
+
+
+def test_sh_lod_frame_rate_policy():
+    lod = svox.SHLod(target_fps=10.0, min_degree=1)
+    lod.update(0.2, 16)
+    assert lod.degree == 2
+    lod.update(0.2, 16)
+    lod.update(0.2, 16)
+    assert lod.degree == 1
+    lod.update(0.01, 16)
+    assert lod.degree == 2
+
+
+def test_mip_matches_leaf_aggregates():
+    tree = _scene()
+    leaves = tree._all_leaves().long()
+    # Positive densities, so that the weighted color mean is defined everywhere
+    vals = tree.data.data[(*leaves.T,)]
+    vals[:, -1] = vals[:, -1].abs() + 0.1
+    tree.data.data[(*leaves.T,)] = vals
+    tree.refine(sel=(*leaves[::7].T,))
+    tree.update_mip()
+    mean, sigma_max = tree.mip()
+
+    leaves = tree._all_leaves().long()
+    size = 2.0 ** (-1.0 - tree.parent_depth[leaves[:, 0], 1].float())
+    corners = tree._calc_corners(leaves, cuda=False)
+    vals = tree.data.data[(*leaves.T,)]
+    origins = tree._node_origins()
+    for node in range(tree.n_internal):
+        node_size = 2.0 ** -float(tree.parent_depth[node, 1])
+        inside = ((corners >= origins[node]) &
+                  (corners < origins[node] + node_size - 1e-7)).all(dim=-1)
+        w = vals[inside, -1] * size[inside] ** 3
+        assert torch.allclose(mean[node, -1], w.sum() / node_size ** 3, rtol=1e-4)
+        assert torch.allclose(mean[node, :-1],
+                              (vals[inside, :-1] * w[:, None]).sum(0) / w.sum(), atol=1e-4)
+        assert sigma_max[node] == vals[inside, -1].max()
+
+
+def test_mip_rendering_limits():
+    tree = _scene()
+    r = svox.VolumeRenderer(tree)
+    with torch.no_grad():
+        ref = r.render_persp(_pose(), 24, 24, fx=30.0, cuda=False)
+        r.cpu_mip_footprint = 1e-9
+        assert torch.allclose(r.render_persp(_pose(), 24, 24, fx=30.0, cuda=False),
+                              ref, atol=1e-6)
+        r.cpu_mip_footprint = 1e9
+        im = r.render_persp(_pose(), 24, 24, fx=30.0, cuda=False)
+    assert torch.isfinite(im).all() and not torch.allclose(im, ref, atol=1e-3)
+
+    # Written through the tree, the aggregates are recomputed
+    mean = tree.mip()[0].clone()
+    tree.set(torch.tensor([[0.5, 0.5, 0.5]]), torch.full((1, tree.data_dim), 5.0), cuda=False)
+    assert not torch.equal(tree.mip()[0], mean)
+
+
+def test_tiles_and_schedulers_agree():
+    tree = _scene()
+    r = svox.VolumeRenderer(tree)
+    n_intra = torch.get_num_threads()
+    with torch.no_grad():
+        r.cpu_threads = 1
+        ref = r.render_persp(_pose(), 30, 20, fx=30.0, cuda=False)
+        r.cpu_threads = 3
+        r.cpu_tile_size = 37
+        for scheduler in ('steal', 'dynamic', 'static'):
+            r.cpu_scheduler = scheduler
+            r.cpu_tile_stats = []
+            im = r.render_persp(_pose(), 30, 20, fx=30.0, cuda=False)
+            assert torch.allclose(im, ref, atol=1e-6)
+            tiles = sorted(s['tile'] for s in r.cpu_tile_stats)
+            assert tiles == list(range(len(tiles)))
+    # The process-wide intra-op setting is left alone
+    assert torch.get_num_threads() == n_intra
+
+
+def test_image_tiles_partition_hits():
+    hit = torch.arange(2 * 20 * 30)[::3]
+    tiles = svox.cpu_render._image_tiles(hit, 36, (20, 30))
+    assert torch.equal(torch.sort(torch.cat(tiles))[0], hit)
+    for tile in tiles:
+        pix = tile % 600
+        # One view, within a 6x6 pixel square
+        assert (tile // 600).unique().numel() == 1
+        assert (pix // 30 // 6).unique().numel() == 1
+        assert (pix % 30 // 6).unique().numel() == 1
+
+
+def test_progressive_converges_to_full_render():
+    tree = _scene()
+    r = svox.VolumeRenderer(tree)
+    with torch.no_grad():
+        ref = r.render_persp(_pose(), 20, 18, fx=25.0, cuda=False)
+    ims = list(r.render_persp_progressive(_pose(), 20, 18, fx=25.0, cuda=False,
+                                          start_stride=4, threshold=-1.0))
+    assert len(ims) == 3
+    assert all(im.shape == ref.shape for im in ims)
+    assert torch.allclose(ims[-1], ref, atol=1e-6)
+    # Rendered block corners are exact from the first level on
+    assert torch.allclose(ims[0][::4, ::4], ref[::4, ::4], atol=1e-6)
+
+    # Nothing differs by more than this, only the first level is rendered
+    coarse = list(r.render_persp_progressive(_pose(), 20, 18, fx=25.0, cuda=False,
+                                             start_stride=4, threshold=10.0))
+    assert torch.equal(coarse[-1], coarse[0])
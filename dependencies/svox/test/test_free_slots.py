@@ -0,0 +1,57 @@
+import torch
+import svox
+
+
+def test_refine_reuses_merged_slots():
+    tree = svox.N3Tree(init_refine=2)
+    n_int = tree.n_internal
+    freed = tree._frontier[:3].clone()
+    tree.merge(torch.arange(3))
+    assert tree.fragmentation_stats()['n_free'] == 3
+
+    # Children of nodes below the freed slots may take them
+    leaves = tree._all_leaves()
+    sel = leaves[leaves[:, 0] < freed.min()][:3].long()
+    vals = tree.data.data[(*sel.T,)].clone()
+    tree.refine(sel=(*sel.T,))
+
+    stats = tree.fragmentation_stats()
+    assert tree.n_internal == n_int
+    assert stats['n_free'] == 0
+    assert stats['n_reused'] == 3
+    new_ids = (sel[:, 0] + tree.child[(*sel.T,)].long())
+    assert torch.equal(torch.sort(new_ids)[0], torch.sort(freed.long())[0])
+    assert torch.equal(tree.data.data[new_ids].reshape(3, -1, tree.data_dim),
+                       vals[:, None].expand(-1, tree.N ** 3, -1))
+    tree.check_integrity()
+    tree.check_index_consistency()
+
+
+def test_free_slot_below_parent_is_not_reused():
+    tree = svox.N3Tree(init_refine=2)
+    n_int = tree.n_internal
+    tree.merge(torch.tensor([0]))
+    n_reused = tree.fragmentation_stats()['n_reused']
+    # A child must come after its parent, so the last node appends
+    leaves = tree._all_leaves()
+    sel = leaves[leaves[:, 0] == leaves[:, 0].max()][:1].long()
+    tree.refine(sel=(*sel.T,))
+
+    stats = tree.fragmentation_stats()
+    assert tree.n_internal == n_int + 1
+    assert stats['n_free'] == 1
+    assert stats['n_reused'] == n_reused
+    tree.check_integrity()
+
+
+def test_all_internals_keeps_freed_slots():
+    tree = svox.N3Tree(init_refine=2)
+    freed = tree._frontier[:2].clone()
+    tree.merge(torch.arange(2))
+    # Freed nodes keep child == -1 in every slot until reused
+    all_nodes = tree._all_internals()[:, 0]
+    live_nodes = tree._live_internals()[:, 0]
+    assert all(int((all_nodes == f).sum()) == tree.N ** 3 for f in freed.tolist())
+    assert not any((live_nodes == f).any() for f in freed.tolist())
+    linked = tree._all_internals()[tree.child[(*tree._all_internals().long().T,)] > 0]
+    assert set(map(tuple, tree._live_internals().tolist())) == set(map(tuple, linked.tolist()))
@@ -0,0 +1,31 @@
+import torch
+import svox
+
+
+def _touch(tree):
+    # Cache every id set, so that the next edits are replayed rather than recomputed
+    tree._all_leaves()
+    tree._frontier
+    tree._live_internals()
+
+
+def test_refine_and_merge_keep_sets_consistent(random_tree):
+    def merge_some(tree, g):
+        tree.check_index_consistency()
+        _touch(tree)
+        n_frontier = tree.n_frontier
+        tree.merge(torch.randperm(n_frontier, generator=g)[:max(n_frontier // 4, 1)])
+        tree.check_index_consistency()
+        assert tree.n_leaves == tree._calc_leaf_ids().numel()
+        _touch(tree)
+
+    tree = random_tree(steps=4, depth_limit=5, after_step=merge_some)
+    tree.check_integrity()
+
+
+def test_refine_at_updates_sets():
+    tree = svox.N3Tree(init_refine=1)
+    _touch(tree)
+    tree._refine_at(1, (0, 1, 0))
+    tree.check_index_consistency()
+    assert tree.n_leaves == tree._calc_leaf_ids().numel()
@@ -0,0 +1,62 @@
+import math
+
+import pytest
+import torch
+
+from svox.renderer import VolumeRenderer
+
+
+def _reference_rays(c2w, width, height, fx, fy):
+    # The per-call meshgrid construction persp_rays used before caching
+    yy, xx = torch.meshgrid(
+        torch.arange(height, dtype=torch.float64),
+        torch.arange(width, dtype=torch.float64),
+    )
+    xx = (xx - width * 0.5) / float(fx)
+    yy = (yy - height * 0.5) / float(fy)
+    dirs = torch.stack((xx, -yy, -torch.ones_like(xx)), dim=-1)
+    dirs /= torch.norm(dirs, dim=-1, keepdim=True)
+    dirs = dirs.reshape(-1, 3, 1)
+    dirs = torch.matmul(c2w[None, :3, :3].double(), dirs)[..., 0].float()
+    origins = c2w[None, :3, 3].expand(height * width, -1).contiguous()
+    return origins, dirs
+
+
+def _pose(angle, dtype):
+    c, s = math.cos(angle), math.sin(angle)
+    return torch.tensor([[c, 0.0, s, 0.3],
+                         [0.0, 1.0, 0.0, -0.2],
+                         [-s, 0.0, c, 2.0],
+                         [0.0, 0.0, 0.0, 1.0]], dtype=dtype)
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float64])
+def test_persp_rays_matches_reference(dtype):
+    c2w = _pose(0.7, dtype)
+    rays = VolumeRenderer.persp_rays(c2w, 24, 16, 20.0, 22.0)
+    origins, dirs = _reference_rays(c2w, 24, 16, 20.0, 22.0)
+    assert rays.dirs.dtype == torch.float32
+    assert rays.origins.dtype == dtype
+    assert torch.allclose(rays.dirs, dirs, rtol=0, atol=1e-7)
+    assert torch.equal(rays.origins, origins)
+
+    out = VolumeRenderer.empty_persp_rays(24, 16, dtype=dtype)
+    VolumeRenderer.persp_rays(c2w, 24, 16, 20.0, 22.0, out=out)
+    assert torch.allclose(out.dirs.float(), dirs, rtol=0, atol=1e-7)
+
+
+def test_camera_dirs_cached():
+    a = VolumeRenderer.camera_dirs(8, 6, 10.0)
+    b = VolumeRenderer.camera_dirs(8, 6, 10.0, 10.0)
+    assert a is b
+    assert a.dtype == torch.float64
+
+
+def test_persp_rays_batch_matches_single():
+    c2ws = torch.stack([_pose(0.1, torch.float32), _pose(1.3, torch.float32)])
+    rays = VolumeRenderer.persp_rays_batch(c2ws, 12, 10, 15.0)
+    for i in range(2):
+        single = VolumeRenderer.persp_rays(c2ws[i], 12, 10, 15.0)
+        sl = slice(i * 120, (i + 1) * 120)
+        assert torch.allclose(rays.dirs[sl], single.dirs, rtol=0, atol=1e-7)
+        assert torch.equal(rays.origins[sl], single.origins)
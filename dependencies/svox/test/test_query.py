@@ -0,0 +1,53 @@
+import torch
+
+
+def _world_tree(random_tree, seed):
+    return random_tree(seed=seed, frac=0.25, radius=0.8, center=[0.1, -0.2, 0.3])
+
+
+def _reference_leaf(tree, pt):
+    # One point at a time, following the child links from the root
+    N = tree.N
+    node = 0
+    pos = [min(max(c, 0.0), 1.0 - 1e-10) for c in pt.tolist()]
+    while True:
+        xyz = []
+        for k in range(3):
+            pos[k] *= N
+            i = min(int(pos[k]), N - 1)
+            pos[k] -= i
+            xyz.append(i)
+        skip = int(tree.child[node, xyz[0], xyz[1], xyz[2]])
+        if skip == 0:
+            return ((node * N + xyz[0]) * N + xyz[1]) * N + xyz[2]
+        node += skip
+
+
+def test_forward_matches_reference(random_tree):
+    tree = _world_tree(random_tree, 0)
+    pts = torch.rand(500, 3, generator=torch.Generator().manual_seed(1)) * 2.0 - 1.0
+    vals, flat = tree(pts, cuda=False, want_node_ids=True)
+    ref = torch.tensor([_reference_leaf(tree, p) for p in tree.world2tree(pts)])
+    assert torch.equal(flat, ref)
+    assert torch.equal(vals, tree.data.view(-1, tree.data_dim)[ref])
+
+
+def test_chunked_threaded_query_matches(random_tree):
+    tree = _world_tree(random_tree, 2)
+    pts = torch.rand(3000, 3, generator=torch.Generator().manual_seed(3))
+    expected = tree(pts, cuda=False, world=False)
+    tree.cpu_query_chunk = 257
+    tree.cpu_query_threads = 4
+    assert torch.equal(tree(pts, cuda=False, world=False), expected)
+
+
+def test_set_writes_the_queried_leaves(random_tree):
+    tree = _world_tree(random_tree, 4)
+    leaves = tree._all_leaves().long()[::3]
+    # One point per leaf, at its center
+    size = float(tree.N) ** (-1.0 - tree.parent_depth[leaves[:, 0], 1].float())
+    pts = tree.tree2world(tree._calc_corners(leaves, cuda=False) + 0.5 * size[:, None])
+    vals = torch.randn(leaves.size(0), tree.data_dim)
+    tree.set(pts, vals, cuda=False)
+    assert torch.equal(tree.data.data[(*leaves.T,)], vals)
+    assert torch.equal(tree(pts, cuda=False), vals)
@@ -0,0 +1,44 @@
+import pytest
+import torch
+
+
+def _fragmented_tree(random_tree, seed=0):
+    tree = random_tree(seed=seed, depth_limit=5)
+    g = torch.Generator().manual_seed(seed)
+    tree.merge(torch.randperm(tree.n_frontier, generator=g)[:tree.n_frontier // 3])
+    return tree
+
+
+@pytest.mark.parametrize("policy", ["morton", "bfs"])
+def test_reorder_keeps_queries(policy, random_tree):
+    tree = _fragmented_tree(random_tree)
+    pts = torch.rand(2000, 3, generator=torch.Generator().manual_seed(1))
+    before = tree(pts, cuda=False).detach().clone()
+    n_live = tree.n_internal - tree.fragmentation_stats()['n_free']
+    data = tree.data.data.clone()
+
+    order = tree.reorder(policy)
+
+    assert order.numel() == n_live == tree.n_internal
+    assert tree.fragmentation_stats()['n_free'] == 0
+    assert torch.equal(tree.data.data[:n_live], data[order])
+    assert torch.equal(tree(pts, cuda=False), before)
+    # Parents before children
+    parents = torch.div(tree.parent_depth[1:n_live, 0].long(), tree.N ** 3,
+                        rounding_mode='floor')
+    assert (parents < torch.arange(1, n_live)).all()
+    tree.check_integrity()
+    tree.check_index_consistency()
+
+
+def test_morton_subtrees_are_contiguous(random_tree):
+    tree = _fragmented_tree(random_tree, seed=2)
+    tree.reorder('morton')
+    n = tree.n_internal
+    # Depth-first: each node's subtree is the range up to the next node
+    # at the same or a lower depth
+    depth = tree.parent_depth[:n, 1]
+    parents = torch.div(tree.parent_depth[1:n, 0].long(), tree.N ** 3,
+                        rounding_mode='floor')
+    for i, p in enumerate(parents.tolist(), start=1):
+        assert (depth[p + 1:i] >= depth[i]).all()
@@ -0,0 +1,62 @@
+import pytest
+import numpy as np
+import torch
+import svox
+
+from svox import treefile
+
+
+def _make_tree():
+    tree = svox.N3Tree(data_format="SH4", init_refine=1)
+    tree.refine(sel=(*tree._all_leaves()[:5].long().T,))
+    tree.data.data.copy_(torch.randn(tree.data.shape, generator=torch.Generator().manual_seed(0)))
+    return tree
+
+
+def _assert_same(a, b, atol=0.0):
+    n = a.n_internal
+    assert b.n_internal == n
+    assert torch.equal(a.child[:n], b.child[:n])
+    assert torch.equal(a.parent_depth[:n], b.parent_depth[:n])
+    assert torch.allclose(a.data.data[:n], b.data.data[:n], atol=atol, rtol=0)
+    assert repr(a.data_format) == repr(b.data_format)
+
+
+@pytest.mark.parametrize("codec", [None, "zlib"])
+def test_n3t_roundtrip(tmp_path, codec):
+    tree = _make_tree()
+    path = str(tmp_path / "tree.n3t")
+    tree.save(path, compress=codec or False)
+    assert treefile.is_tree_file(path)
+    _assert_same(tree, svox.N3Tree.load(path))
+
+
+def test_n3t_data_mapped_in_place(tmp_path):
+    tree = _make_tree()
+    path = str(tmp_path / "tree.n3t")
+    tree.save(path, compress=False)
+    z = treefile.load_fields(path)
+    assert isinstance(z["data"], np.memmap)
+    assert np.dtype(z._layout["data"]["dtype"]) == np.float32
+    data = treefile.to_tensor(z["data"], dtype=torch.float32)
+    assert data.data_ptr() == z["data"].ctypes.data
+
+
+def test_npz_n3t_convert(tmp_path):
+    tree = _make_tree()
+    src, dst = str(tmp_path / "tree.npz"), str(tmp_path / "tree.n3t")
+    tree.save(src, compress=False)
+    treefile.convert(src, dst)
+    # npz stores float16
+    _assert_same(tree, svox.N3Tree.load(dst), atol=1e-2)
+    _assert_same(svox.N3Tree.load(src), svox.N3Tree.load(dst))
+
+
+def test_default_save_keeps_n3t_mappable(tmp_path):
+    tree = _make_tree()
+    path = str(tmp_path / "tree.n3t")
+    tree.save(path)
+    assert "codec" not in treefile.load_fields(path)._layout["data"]
+    tree.save(path, compress=True)
+    assert "codec" in treefile.load_fields(path)._layout["data"]
+    _assert_same(tree, svox.N3Tree.load(path))